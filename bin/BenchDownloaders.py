@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import importlib.util
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import shlex
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import urllib.request
+import zlib
+import numpy as np
+import pandas as pd
+from aiohttp import web
+
+# Downloader scripts the harness can run, and how each one takes its input and output
+SCRIPTS = {
+    "ImgDownload": ("ImgDownload.py", "--input_path", "--output_tar", ".tar.gz"),
+    "ImgDownloadBW": ("ImgDownloadBW.py", "--input", "--output", ".tar"),
+    "ImgDownloadOptimized": ("ImgDownloadOptimized.py", "--input", "--output", ".tar")
+}
+# Edge lengths of the pre-encoded image bodies; larger bodies are padded up from the biggest that fits
+IMAGE_SIDES = [16, 32, 64, 128, 256, 512, 1024]
+
+def parse_args():
+    """
+    Parse user inputs from arguments using argparse.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark: run the downloader scripts end to end against a local stand-in image server and report req/s, MB/s, CPU and RSS.")
+
+    parser.add_argument("--scripts", type=str, nargs="+", default=list(SCRIPTS), choices=list(SCRIPTS), help="Downloader scripts to benchmark.")
+    parser.add_argument("--rows", type=int, default=2000, help="Rows in the generated input parquet (default: 2000).")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per script (default: 1).")
+    parser.add_argument("--hosts", type=int, default=4, help="Stand-in hosts, one port each (default: 4).")
+    parser.add_argument("--port", type=int, default=8810, help="Port of the first stand-in host (default: 8810).")
+    parser.add_argument("--latency_ms", type=float, default=20.0, help="Median response latency of the fastest host in ms (default: 20).")
+    parser.add_argument("--latency_sigma", type=float, default=0.5, help="Log-normal sigma of the response latency (default: 0.5).")
+    parser.add_argument("--latency_spread", type=float, default=2.0, help="Each further host is this many times slower than the previous one (default: 2.0).")
+    parser.add_argument("--body_kb", type=float, default=100.0, help="Median body size in KB (default: 100).")
+    parser.add_argument("--body_sigma", type=float, default=0.8, help="Log-normal sigma of the body size (default: 0.8).")
+    parser.add_argument("--max_body_kb", type=int, default=4096, help="Largest body served in KB (default: 4096).")
+    parser.add_argument("--rate_429", type=float, default=0.02, help="Fraction of requests answered with 429 (default: 0.02).")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After seconds sent with 429/503, negative to omit the header (default: 1).")
+    parser.add_argument("--rate_5xx", type=float, default=0.01, help="Fraction of requests answered with 502/503/504 (default: 0.01).")
+    parser.add_argument("--rate_timeout", type=float, default=0.001, help="Fraction of requests that hang for --hang_seconds (default: 0.001).")
+    parser.add_argument("--hang_seconds", type=float, default=10.0, help="How long a timed-out request hangs (default: 10).")
+    parser.add_argument("--stale_extension", type=float, default=0.05, help="Fraction of URLs whose listed .jpg is missing and only the .png exists (default: 0.05).")
+    parser.add_argument("--no_extension", type=float, default=0.05, help="Fraction of URLs without a file extension (default: 0.05).")
+    parser.add_argument("--host_profiles", type=str, default=None, help="JSON file with a list of per-host overrides of the settings above (e.g. [{\"latency_ms\": 200, \"rate_429\": 0.2}]).")
+    parser.add_argument("--timeout", type=int, default=5, help="--timeout passed to the scripts that take one (default: 5).")
+    parser.add_argument("--bw_args", type=str, default="", help="Extra arguments for ImgDownloadBW.py.")
+    parser.add_argument("--optimized_args", type=str, default="--progress silent", help="Extra arguments for ImgDownloadOptimized.py (default: '--progress silent').")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the input and the server (default: 0).")
+    parser.add_argument("--serve", action="store_true", help="Only run the stand-in server until interrupted.")
+    parser.add_argument("--baseline", type=str, default=None, help="Earlier results JSON to compare against.")
+    parser.add_argument("--output", type=str, default=None, help="Optional path to write the results as JSON.")
+
+    return parser.parse_args()
+
+def host_profiles(args):
+    """
+    Settings for every stand-in host: the CLI values, host i slowed down by latency_spread**i,
+    then the --host_profiles overrides (cycled when there are fewer than hosts).
+    """
+    overrides = []
+    if args.host_profiles:
+        with open(args.host_profiles, 'r') as f:
+            overrides = json.load(f)
+    profiles = []
+    for host in range(args.hosts):
+        profile = {
+            "latency_ms": args.latency_ms * args.latency_spread ** host,
+            "latency_sigma": args.latency_sigma,
+            "body_kb": args.body_kb,
+            "body_sigma": args.body_sigma,
+            "rate_429": args.rate_429,
+            "retry_after": args.retry_after,
+            "rate_5xx": args.rate_5xx,
+            "rate_timeout": args.rate_timeout,
+            "hang_seconds": args.hang_seconds
+        }
+        if overrides:
+            profile.update(overrides[host % len(overrides)])
+        profiles.append(profile)
+    return profiles
+
+def is_stale(photo_id, stale_extension):
+    """Same answer in the generator and the server: this photo only exists as .png"""
+    return zlib.crc32(str(photo_id).encode()) % 10000 < stale_extension * 10000
+
+def make_input(path, rows, hosts, port, stale_extension, no_extension, seed):
+    """
+    Rows spread evenly over the hosts, with the configured share of stale and missing extensions.
+    """
+    rng = np.random.default_rng(seed)
+    urls = []
+    for photo_id in range(rows):
+        host_port = port + photo_id % hosts
+        name = "original" if rng.random() < no_extension else "original.jpg"
+        urls.append(f"http://127.0.0.1:{host_port}/photos/{photo_id}/{name}")
+    df = pd.DataFrame({
+        "photo_url": urls,
+        "taxon_name": [f"species {i % 50}" for i in range(rows)]
+    })
+    df.to_parquet(path)
+    return df
+
+def encode_images(seed):
+    """
+    Real JPEG and PNG encodings of a textured gradient at every size in IMAGE_SIDES, smallest
+    first, so served bodies decode, validate and transform like real downloads.
+    """
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    images = {"jpeg": [], "png": []}
+    for side in IMAGE_SIDES:
+        ramp = np.linspace(0, 255, side)
+        gradient = np.stack([np.add.outer(ramp, ramp) / 2, np.tile(ramp, (side, 1)), np.tile(ramp[:, None], (1, side))], axis=-1)
+        pixels = np.clip(gradient + rng.normal(0, 24, gradient.shape), 0, 255).astype(np.uint8)
+        for image_format in images:
+            encoded = io.BytesIO()
+            Image.fromarray(pixels).save(encoded, image_format.upper(), **({"quality": 90} if image_format == "jpeg" else {}))
+            images[image_format].append(encoded.getvalue())
+    return images
+
+def pad_image(encoded, image_format, size, filler):
+    """
+    Grow an encoded image to about size bytes without changing what it decodes to: comment
+    segments right after the JPEG SOI marker, or a private ancillary chunk before the PNG IEND.
+    """
+    missing = size - len(encoded)
+    if image_format == "jpeg":
+        segments = []
+        while missing > 4:
+            payload = min(missing - 4, 65533)
+            segments.append(b"\xff\xfe" + (payload + 2).to_bytes(2, "big") + filler[:payload])
+            missing -= payload + 4
+        return encoded[:2] + b"".join(segments) + encoded[2:]
+    if missing > 12:
+        data = filler[:missing - 12]
+        chunk = len(data).to_bytes(4, "big") + b"paDd" + data + zlib.crc32(b"paDd" + data).to_bytes(4, "big")
+        return encoded[:-12] + chunk + encoded[-12:]
+    return encoded
+
+def serve(port, profiles, stale_extension, max_body_kb, seed):
+    """
+    Stand-in image hosts: one port per profile, each with its own latency and body-size
+    distributions and injected 429/5xx/hanging responses. GET and HEAD are both served.
+    Bodies are real JPEG/PNG images, the largest encoding that fits each size bucket padded
+    up to it, so validation and transforms see the same work as on real downloads.
+    """
+    rng = random.Random(seed)
+    images = encode_images(seed)
+    filler = np.random.default_rng(seed).integers(0, 256, max_body_kb * 1024, dtype=np.uint8).tobytes()
+    bodies = {}  # (format, size bucket) -> padded body
+    stats = {"requests": 0, "bytes": 0, "statuses": {}}
+
+    def body_for(image_format, size):
+        # Size buckets about 13% apart keep the number of distinct padded bodies small
+        bucket = round(math.log(size) * 8)
+        if (image_format, bucket) not in bodies:
+            target = min(int(math.exp(bucket / 8)), max_body_kb * 1024)
+            fitting = [encoded for encoded in images[image_format] if len(encoded) <= target]
+            bodies[(image_format, bucket)] = pad_image(fitting[-1] if fitting else images[image_format][0], image_format, target, filler)
+        return bodies[(image_format, bucket)]
+
+    def respond(status, **kwargs):
+        stats["statuses"][str(status)] = stats["statuses"].get(str(status), 0) + 1
+        return web.Response(status=status, **kwargs)
+
+    async def image(request):
+        profile = profiles[request.url.port - port]
+        stats["requests"] += 1
+        await asyncio.sleep(rng.lognormvariate(math.log(profile["latency_ms"] / 1000), profile["latency_sigma"]))
+
+        draw = rng.random()
+        retry_after = {"Retry-After": str(profile["retry_after"])} if profile["retry_after"] >= 0 else {}
+        if draw < profile["rate_429"]:
+            return respond(429, headers=retry_after)
+        draw -= profile["rate_429"]
+        if draw < profile["rate_5xx"]:
+            status = rng.choice([502, 503, 504])
+            return respond(status, headers=retry_after if status == 503 else {})
+        draw -= profile["rate_5xx"]
+        if draw < profile["rate_timeout"]:
+            await asyncio.sleep(profile["hang_seconds"])
+
+        photo_id, name = request.match_info["id"], request.match_info["name"]
+        ext = os.path.splitext(name)[1]
+        if is_stale(photo_id, stale_extension):
+            if ext != ".png":
+                return respond(404)
+            image_format = "png"
+        elif ext in ["", ".jpg"]:
+            image_format = "jpeg"
+        else:
+            return respond(404)
+
+        size = int(rng.lognormvariate(math.log(profile["body_kb"] * 1024), profile["body_sigma"]))
+        body = body_for(image_format, min(max(size, 1024), max_body_kb * 1024))
+        if request.method == "GET":
+            stats["bytes"] += len(body)
+        return respond(200, body=body, content_type=f"image/{image_format}")
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    async def reset_stats(request):
+        stats.update({"requests": 0, "bytes": 0, "statuses": {}})
+        return web.json_response(stats)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/_stats", get_stats)
+        app.router.add_post("/_reset", reset_stats)
+        app.router.add_get("/photos/{id}/{name}", image)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        for host in range(len(profiles)):
+            await web.TCPSite(runner, "127.0.0.1", port + host).start()
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+def server_request(port, path, method="GET"):
+    with urllib.request.urlopen(urllib.request.Request(f"http://127.0.0.1:{port}{path}", method=method), timeout=10) as response:
+        return json.load(response)
+
+def wait_for_server(port, attempts=50):
+    for _ in range(attempts):
+        try:
+            return server_request(port, "/_stats")
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Stand-in server did not start on port {port}")
+
+def count_images(tar_path):
+    """Images stored as <root>/<class>/<file>; manifests and overviews are not counted"""
+    try:
+        with tarfile.open(tar_path, "r:*") as tar:
+            return sum(1 for member in tar if member.isfile() and member.name.count("/") >= 2)
+    except (OSError, tarfile.TarError):
+        return 0
+
+def run_script(name, args, input_path, workdir, run):
+    """
+    Run one downloader as a child process in its own directory, measuring wall time and its
+    CPU and peak RSS through wait4 (which includes any worker processes it reaped).
+    """
+    script, input_flag, output_flag, suffix = SCRIPTS[name]
+    output_path = os.path.join(workdir, f"{name}_{run}{suffix}")
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script), input_flag, input_path, output_flag, output_path]
+    if name != "ImgDownload":
+        command += ["--timeout", str(args.timeout)]
+    command += shlex.split({"ImgDownloadBW": args.bw_args, "ImgDownloadOptimized": args.optimized_args}.get(name, ""))
+
+    server_request(args.port, "/_reset", method="POST")
+    with open(os.path.join(workdir, f"{name}_{run}.log"), 'w') as log:
+        wall_start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - wall_start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    served = server_request(args.port, "/_stats")
+
+    images = count_images(output_path)
+    cpu = usage.ru_utime + usage.ru_stime
+    return {
+        "script": name,
+        "run": run,
+        "exit_code": process.returncode,
+        "rows": args.rows,
+        "images_stored": images,
+        "requests_served": served["requests"],
+        "statuses_served": served["statuses"],
+        "wall_seconds": round(wall, 3),
+        "rows_per_second": round(args.rows / wall, 1),
+        "requests_per_second": round(served["requests"] / wall, 1),
+        "mb_per_second": round(served["bytes"] / wall / 1e6, 3),
+        "cpu_seconds": round(cpu, 3),
+        "cpu_ms_per_image": round(cpu / images * 1000, 3) if images else None,
+        "max_rss_mb": round(usage.ru_maxrss / 1024, 1)
+    }
+
+def compare(results, baseline_path):
+    """
+    Print the change of each script's median throughput and CPU against an earlier results file.
+    """
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+
+    def medians(runs):
+        by_script = {}
+        for result in runs:
+            by_script.setdefault(result["script"], []).append(result)
+        return {
+            script: {metric: float(np.median([run[metric] for run in runs if run[metric] is not None] or [0])) for metric in ["requests_per_second", "mb_per_second", "cpu_seconds", "max_rss_mb"]}
+            for script, runs in by_script.items()
+        }
+
+    current, previous = medians(results), medians(baseline["results"])
+    print(f"\nAgainst {baseline_path}:")
+    for script, metrics in current.items():
+        if script not in previous:
+            continue
+        changes = [
+            f"{metric} {(value - previous[script][metric]) / previous[script][metric] * 100:+.1f}%"
+            for metric, value in metrics.items() if previous[script][metric]
+        ]
+        print(f"  {script}: {', '.join(changes)}")
+
+def main():
+    args = parse_args()
+    if importlib.util.find_spec("PIL") is None:
+        print("Error: the stand-in hosts need Pillow to encode their image bodies")
+        sys.exit(1)
+    profiles = host_profiles(args)
+    context = multiprocessing.get_context("spawn")
+    server = context.Process(target=serve, args=(args.port, profiles, args.stale_extension, args.max_body_kb, args.seed), daemon=True)
+    server.start()
+    wait_for_server(args.port)
+
+    if args.serve:
+        print(f"Serving {args.hosts} stand-in hosts on ports {args.port}-{args.port + args.hosts - 1}, e.g. http://127.0.0.1:{args.port}/photos/1/original.jpg")
+        try:
+            server.join()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix="bench_downloaders_")
+    input_path = os.path.join(workdir, "input.parquet")
+    make_input(input_path, args.rows, args.hosts, args.port, args.stale_extension, args.no_extension, args.seed)
+    print(f"{args.rows} rows over {args.hosts} hosts, outputs and logs in {workdir}")
+    print(f"{'script':>22} {'run':>4} {'stored':>7} {'wall s':>8} {'req/s':>8} {'MB/s':>8} {'cpu s':>7} {'rss MB':>7}")
+    try:
+        for run in range(args.repeat):
+            for name in args.scripts:
+                result = run_script(name, args, input_path, workdir, run)
+                results.append(result)
+                print(f"{name:>22} {run:>4} {result['images_stored']:>7} {result['wall_seconds']:>8.2f} {result['requests_per_second']:>8.1f} "
+                      f"{result['mb_per_second']:>8.2f} {result['cpu_seconds']:>7.2f} {result['max_rss_mb']:>7.1f}")
+    finally:
+        server.terminate()
+        server.join()
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+                "rows": args.rows,
+                "hosts": profiles,
+                "stale_extension": args.stale_extension,
+                "no_extension": args.no_extension,
+                "results": results
+            }, f, indent=2)
+        print(f"Wrote results to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import time
+import aiohttp
+from aiohttp import web
+from ImgDownloadOptimized import EVENT_LOOPS, run_event_loop
+
+def parse_args():
+    """
+    Parse user inputs from arguments using argparse.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark: request throughput and client CPU per event loop backend against a local HTTP stand-in.")
+
+    parser.add_argument("--loops", type=str, nargs="+", default=EVENT_LOOPS, choices=EVENT_LOOPS, help="Event loop backends to benchmark.")
+    parser.add_argument("--requests", type=int, default=20000, help="Requests per run (default: 20000).")
+    parser.add_argument("--concurrency", type=int, default=200, help="Concurrent requests (default: 200).")
+    parser.add_argument("--body_size", type=int, default=2048, help="Response body size in bytes (default: 2048).")
+    parser.add_argument("--port", type=int, default=8799, help="Port for the local stand-in server (default: 8799).")
+    parser.add_argument("--output", type=str, default=None, help="Optional path to write the results as JSON.")
+
+    return parser.parse_args()
+
+def serve(port, body_size):
+    """
+    Stand-in image host: every GET returns the same small JPEG-sized body.
+    """
+    body = b"\xff\xd8\xff" + b"\0" * (body_size - 3)
+
+    async def image(request):
+        return web.Response(body=body, content_type="image/jpeg")
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", image)
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
+
+async def fetch_all(port, requests, concurrency):
+    """
+    Issue the requests from a fixed pool of workers, the way the downloaders do.
+    """
+    next_request = iter(range(requests))
+    completed = 0
+
+    async def worker(session):
+        nonlocal completed
+        for n in next_request:
+            async with session.get(f"http://127.0.0.1:{port}/{n}/photo.jpg") as response:
+                await response.read()
+                completed += 1
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+        return completed, time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+def run_client(event_loop, port, requests, concurrency, results):
+    """Runs in its own process so each backend starts from a fresh interpreter"""
+    results.put(run_event_loop(fetch_all(port, requests, concurrency), event_loop))
+
+async def wait_for_server(port, attempts=50):
+    for _ in range(attempts):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"Stand-in server did not start on port {port}")
+
+def main():
+    args = parse_args()
+    context = multiprocessing.get_context("spawn")
+    server = context.Process(target=serve, args=(args.port, args.body_size), daemon=True)
+    server.start()
+    asyncio.run(wait_for_server(args.port))
+
+    results = []
+    print(f"{'loop':>8} {'requests':>9} {'wall s':>8} {'req/s':>9} {'cpu s/10k':>10}")
+    try:
+        for event_loop in args.loops:
+            if event_loop == "uvloop" and importlib.util.find_spec("uvloop") is None:
+                print(f"{event_loop:>8} skipped: uvloop is not installed")
+                results.append({"event_loop": event_loop, "skipped": "uvloop is not installed"})
+                continue
+            queue = context.Queue()
+            client = context.Process(target=run_client, args=(event_loop, args.port, args.requests, args.concurrency, queue))
+            client.start()
+            completed, wall, cpu = queue.get()
+            client.join()
+            result = {
+                "event_loop": event_loop,
+                "requests": completed,
+                "wall_seconds": round(wall, 3),
+                "requests_per_second": round(completed / wall, 1),
+                "cpu_seconds_per_10k_requests": round(cpu / completed * 10000, 3),
+            }
+            results.append(result)
+            print(f"{event_loop:>8} {completed:>9} {wall:>8.2f} {result['requests_per_second']:>9.1f} {result['cpu_seconds_per_10k_requests']:>10.3f}")
+    finally:
+        server.terminate()
+        server.join()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"concurrency": args.concurrency, "body_size": args.body_size, "results": results}, f, indent=2)
+        print(f"Wrote results to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+from SplitParquet import lpt_partition
+
+def parse_args():
+    """
+    Parse user inputs from arguments using argparse.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark SplitParquet grouping on Zipf-distributed class counts: the per-row greedy loop vs. the heap LPT partitioner, with and without swap refinement.")
+
+    parser.add_argument("--classes", type=int, nargs="+", default=[10000, 100000, 500000], help="Numbers of classes to benchmark.")
+    parser.add_argument("--groups", type=int, nargs="+", default=[100, 3000], help="Numbers of groups to benchmark.")
+    parser.add_argument("--zipf", type=float, default=1.2, help="Zipf exponent of the class counts (default: 1.2).")
+    parser.add_argument("--max_count", type=int, default=2000, help="Cap on a single class count (default: 2000).")
+    parser.add_argument("--refine_rounds", type=int, default=200, help="Swap rounds for the refined run (default: 200).")
+    parser.add_argument("--legacy_max_classes", type=int, default=20000, help="Skip the legacy loop above this many classes, it is O(rows x groups) (default: 20000).")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0).")
+    parser.add_argument("--output", type=str, default=None, help="Optional path to write the results as JSON.")
+
+    return parser.parse_args()
+
+def legacy_grouping(num_partitions, df, count):
+    """
+    The old greedy_grouping loop: iterrows plus an argmin over a Python list per row.
+    """
+    sorted_df = df.sort_values(by=count, ascending=False).reset_index(drop=True)
+    partition_sums = [0 for _ in range(num_partitions)]
+    group_ids = []
+    for _, row in sorted_df.iterrows():
+        min_partition_idx = np.argmin(partition_sums)
+        partition_sums[min_partition_idx] += row[count]
+        group_ids.append(min_partition_idx + 1)
+    return sorted_df[count].to_numpy(), np.array(group_ids)
+
+def imbalance(counts, group_ids, num_partitions):
+    loads = np.bincount(group_ids, weights=counts, minlength=num_partitions + 1)[1:]
+    return int(loads.max()), int(loads.min()), float(loads.max() / max(loads.min(), 1))
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    results = []
+
+    print(f"{'classes':>8} {'groups':>7} {'method':>12} {'seconds':>9} {'max':>10} {'min':>10} {'max/min':>9}")
+    for classes in args.classes:
+        counts = np.minimum(rng.zipf(args.zipf, classes), args.max_count)
+        for groups in args.groups:
+            runs = []
+            if classes <= args.legacy_max_classes:
+                df = pd.DataFrame({"Count": counts})
+                start = time.perf_counter()
+                legacy_counts, legacy_ids = legacy_grouping(groups, df, "Count")
+                runs.append(("legacy", time.perf_counter() - start, legacy_counts, legacy_ids))
+            start = time.perf_counter()
+            group_ids = lpt_partition(counts, groups)
+            runs.append(("lpt", time.perf_counter() - start, counts, group_ids))
+            start = time.perf_counter()
+            group_ids = lpt_partition(counts, groups, args.refine_rounds)
+            runs.append(("lpt+refine", time.perf_counter() - start, counts, group_ids))
+
+            for method, seconds, run_counts, run_ids in runs:
+                largest, smallest, ratio = imbalance(run_counts, run_ids, groups)
+                results.append({
+                    "classes": classes,
+                    "groups": groups,
+                    "method": method,
+                    "seconds": round(seconds, 4),
+                    "max_group": largest,
+                    "min_group": smallest,
+                    "max_min_ratio": round(ratio, 5)
+                })
+                print(f"{classes:>8} {groups:>7} {method:>12} {seconds:>9.3f} {largest:>10} {smallest:>10} {ratio:>9.4f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"zipf": args.zipf, "max_count": args.max_count, "refine_rounds": args.refine_rounds, "results": results}, f, indent=2)
+        print(f"Wrote results to {args.output}")
+
+if __name__ == '__main__':
+    main()
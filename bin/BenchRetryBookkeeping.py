@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+from ImgDownloadOptimized import RetryScheduler, parse_retry_budgets
+
+def parse_args():
+    """
+    Parse user inputs from arguments using argparse.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark retry bookkeeping in ImgDownloadOptimized: per-key DataFrame lookups vs. its RetryScheduler.")
+
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5000, 10000, 20000, 40000, 80000, 500000], help="Batch sizes (rows) to benchmark.")
+    parser.add_argument("--error_fraction", type=float, default=0.5, help="Fraction of rows that hit a retryable error (default: 0.5).")
+    parser.add_argument("--max_failures_per_row", type=int, default=3, help="Each failing row fails between 1 and this many times (default: 3).")
+    parser.add_argument("--max_retry_attempts", type=int, default=3, help="Retry budget per error class, as in ImgDownloadOptimized (default: 3).")
+    parser.add_argument("--legacy_max_rows", type=int, default=40000, help="Skip the legacy approach above this many rows, it is quadratic (default: 40000).")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0).")
+    parser.add_argument("--output", type=str, default=None, help="Optional path to write the results as JSON.")
+
+    return parser.parse_args()
+
+def make_batch(rows):
+    """
+    Build a batch shaped like a split parquet group.
+    """
+    return pd.DataFrame({
+        "photo_url": [f"https://example.org/photos/{i}/original.jpg" for i in range(rows)],
+        "species_name": [f"species_{i % 500}" for i in range(rows)],
+    })
+
+def legacy_retry_rows(df_batch, failed_keys):
+    """
+    The old bookkeeping: a boolean scan per failed key, then a DataFrame rebuilt from a list of rows.
+    """
+    retry_rows = []
+    for key in failed_keys:
+        original_row = df_batch.loc[df_batch.index == key]
+        if not original_row.empty:
+            retry_rows.append(original_row.iloc[0])
+    return pd.DataFrame(retry_rows)
+
+def make_failures(rng, failed_indexes, max_failures_per_row):
+    """
+    Synthetic error pattern: every failing row fails one or more times with a mix of
+    error classes, and the failures arrive in completion order, not row order.
+    """
+    counts = rng.integers(1, max_failures_per_row + 1, size=len(failed_indexes))
+    indexes = rng.permutation(np.repeat(failed_indexes, counts))
+    retry_classes = rng.choice(["throttled", "timeout", "server_error"], size=len(indexes), p=[0.5, 0.3, 0.2])
+    return list(zip(indexes.tolist(), retry_classes.tolist()))
+
+def scheduler_retry_positions(urls, batch_positions, failures, budgets):
+    """
+    The current bookkeeping, run through RetryScheduler itself: every failure is scheduled,
+    workers take a ready row back with pop_ready after every other completion, and the rows
+    still waiting are drained into positions in one step, as when a shutdown cuts a batch short.
+    """
+    scheduler = RetryScheduler(budgets, base_delay=0.0, max_delay=0.0)
+    popped = []
+    for step, (index, retry_class) in enumerate(failures):
+        scheduler.schedule(index, urls[batch_positions[index]], retry_class)
+        if step % 2:
+            index = scheduler.pop_ready()
+            if index is not None:
+                popped.append(index)
+    waiting = scheduler.drain()
+    return popped, batch_positions[np.array(sorted(waiting), dtype=np.int64)], scheduler
+
+def time_call(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    budgets = parse_retry_budgets([], args.max_retry_attempts)
+    results = []
+
+    print(f"{'rows':>10} {'errors':>10} {'legacy s':>10} {'scheduler s':>12} {'sched us/err':>13} {'exhausted':>10}")
+    for rows in args.sizes:
+        df_batch = make_batch(rows)
+        failed_indexes = rng.permutation(rows)[:int(rows * args.error_fraction)]
+        failures = make_failures(rng, failed_indexes, args.max_failures_per_row)
+        failed_keys = df_batch.index.to_numpy()[failed_indexes]
+
+        legacy_seconds = None
+        if rows <= args.legacy_max_rows:
+            legacy_seconds, legacy = time_call(legacy_retry_rows, df_batch, failed_keys)
+
+        # The downloader pulls the columns out once, then every attempt is positions into them
+        batch_positions = np.arange(rows)
+        urls = df_batch["photo_url"].to_numpy()
+        scheduler_seconds, (popped, retry_positions, scheduler) = time_call(scheduler_retry_positions, urls, batch_positions, failures, budgets)
+
+        # Every failing row was queued at least once, whether it came back or is still waiting
+        retried_urls = set(urls[popped]) | set(urls[retry_positions])
+        if legacy_seconds is not None:
+            assert set(legacy["photo_url"]) == retried_urls
+        exhausted = sum(scheduler.exhausted.values())
+
+        results.append({
+            "rows": rows,
+            "errors": len(failures),
+            "rows_failed": len(failed_indexes),
+            "legacy_seconds": round(legacy_seconds, 4) if legacy_seconds is not None else None,
+            "scheduler_seconds": round(scheduler_seconds, 6),
+            "scheduler_us_per_error": round(scheduler_seconds / max(len(failures), 1) * 1e6, 3),
+            "budget_exhausted": exhausted,
+        })
+        legacy_str = f"{legacy_seconds:.3f}" if legacy_seconds is not None else "skipped"
+        print(f"{rows:>10} {len(failures):>10} {legacy_str:>10} {scheduler_seconds:>12.4f} {results[-1]['scheduler_us_per_error']:>13.3f} {exhausted:>10}")
+
+    # Linear scaling shows up as a flat per-error cost across sizes (the heap adds a log factor)
+    print("\nScaling per doubling of rows (2.0 = linear, 4.0 = quadratic):")
+    for previous, current in zip(results, results[1:]):
+        if current["rows"] != previous["rows"] * 2:
+            continue
+        parts = []
+        if previous["legacy_seconds"] and current["legacy_seconds"]:
+            parts.append(f"legacy x{current['legacy_seconds'] / previous['legacy_seconds']:.2f}")
+        parts.append(f"scheduler x{current['scheduler_seconds'] / max(previous['scheduler_seconds'], 1e-9):.2f}")
+        print(f"  {previous['rows']} -> {current['rows']}: {', '.join(parts)}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"error_fraction": args.error_fraction, "max_failures_per_row": args.max_failures_per_row, "budgets": budgets, "results": results}, f, indent=2)
+        print(f"Wrote results to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import time
+from ImgDownloadOptimized import TokenBucket
+
+def parse_args():
+    """
+    Parse user inputs from arguments using argparse.
+    """
+    parser = argparse.ArgumentParser(description="Microbenchmark: CPU time per granted token for the polling and event-driven token buckets.")
+
+    parser.add_argument("--waiters", type=int, nargs="+", default=[1, 100, 1000], help="Numbers of concurrent waiters to benchmark.")
+    parser.add_argument("--rate", type=float, default=1000.0, help="Bucket rate in tokens per second (default: 1000).")
+    parser.add_argument("--capacity", type=int, default=10, help="Bucket capacity (default: 10).")
+    parser.add_argument("--tokens", type=int, default=3000, help="Tokens to grant per run (default: 3000).")
+    parser.add_argument("--output", type=str, default=None, help="Optional path to write the results as JSON.")
+
+    return parser.parse_args()
+
+class PollingTokenBucket:
+    """
+    The previous implementation: every waiter wakes every 10 ms to check for a token.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.time()
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(0.01)
+
+    def _refill(self):
+        now = time.time()
+        elapsed = now - self.last_refill
+        new_tokens = elapsed * self.rate
+        self.tokens = min(self.capacity, self.tokens + new_tokens)
+        self.last_refill = now
+
+async def run_bucket(bucket, waiters, tokens):
+    """
+    Have waiters compete for tokens until the total has been granted.
+    """
+    granted = 0
+
+    async def waiter():
+        nonlocal granted
+        while granted < tokens:
+            await bucket.acquire()
+            granted += 1
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    tasks = [asyncio.create_task(waiter()) for _ in range(waiters)]
+    await asyncio.gather(*tasks)
+    return time.process_time() - cpu_start, time.perf_counter() - wall_start, granted
+
+async def benchmark(args):
+    results = []
+    print(f"{'bucket':>14} {'waiters':>8} {'granted':>8} {'wall s':>8} {'tokens/s':>9} {'cpu us/token':>13}")
+    for waiters in args.waiters:
+        for name, bucket_class in [("polling", PollingTokenBucket), ("event-driven", TokenBucket)]:
+            # Start empty so every token is paced by the rate
+            bucket = bucket_class(rate=args.rate, capacity=args.capacity)
+            bucket.tokens = 0
+            cpu, wall, granted = await run_bucket(bucket, waiters, args.tokens)
+            result = {
+                "bucket": name,
+                "waiters": waiters,
+                "granted": granted,
+                "wall_seconds": round(wall, 3),
+                "granted_per_second": round(granted / wall, 1),
+                "cpu_us_per_token": round(cpu / granted * 1e6, 2),
+            }
+            results.append(result)
+            print(f"{name:>14} {waiters:>8} {granted:>8} {wall:>8.2f} {result['granted_per_second']:>9.1f} {result['cpu_us_per_token']:>13.2f}")
+    return results
+
+def main():
+    args = parse_args()
+    results = asyncio.run(benchmark(args))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"rate": args.rate, "capacity": args.capacity, "tokens": args.tokens, "results": results}, f, indent=2)
+        print(f"Wrote results to {args.output}")
+
+if __name__ == '__main__':
+    main()
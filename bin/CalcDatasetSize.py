@@ -1,4 +1,5 @@
 import os
+import json
 import argparse
 import asyncio
 import aiohttp
@@ -19,8 +20,107 @@ def parse_args():
         help='url column',
         default='url'
     )
+    parser.add_argument(
+        '--extension_cache',
+        type=str,
+        help='JSON file where learned URL-pattern -> extension mappings are loaded from and saved to',
+        default=None
+    )
+    parser.add_argument(
+        '--sizes_output',
+        type=str,
+        help='Optional parquet file for the per-URL size estimates (url column plus size_kb, 0 when unresolved), e.g. for SplitParquet --size_estimates',
+        default=None
+    )
+    parser.add_argument(
+        '--event_loop',
+        type=str,
+        choices=['asyncio', 'uvloop'],
+        help='Event loop implementation; uvloop falls back to asyncio when not installed',
+        default='asyncio'
+    )
     return parser.parse_args()
 
+class ExtensionCache:
+    """
+    Learns which file extension actually resolves for URLs that share a host and path shape
+    (path segments containing digits are wildcarded, so photos/123/original.jpg and
+    photos/456/original.jpg share a pattern). The learned winner is only tried before the
+    original URL for patterns whose original URLs mostly went stale, and the mapping can be
+    persisted between runs.
+    """
+    def __init__(self, path=None, max_failed_probes=20):
+        self.path = path
+        self.max_failed_probes = max_failed_probes
+        self.patterns = {}  # pattern -> {extension: times it resolved}
+        self.failed_probes = {}  # pattern -> probes where no candidate resolved
+        self.originals = {}  # pattern -> [original URL resolved, original URL went stale]
+        self.hits = 0
+        self.misses = 0
+        self.probes = 0
+        self.probe_wins = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    saved = json.load(f)
+                self.patterns = saved.get('patterns', {})
+                self.failed_probes = saved.get('failed_probes', {})
+                self.originals = saved.get('originals', {})
+                print(f"Loaded {len(self.patterns)} learned extension patterns from {path}")
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Warning: Could not load extension cache '{path}': {e}")
+
+    @staticmethod
+    def pattern(url):
+        parts = urlsplit(str(url))
+        base, _ = os.path.splitext(parts.path)
+        segments = ['#' if any(c.isdigit() for c in segment) else segment for segment in base.split('/')]
+        return parts.netloc + '/'.join(segments)
+
+    def lookup(self, url):
+        """
+        Return the extension that has resolved most often for this URL's pattern, if any.
+        """
+        counts = self.patterns.get(self.pattern(url))
+        if not counts:
+            return None
+        return max(counts, key=counts.get)
+
+    def learn(self, url, ext):
+        counts = self.patterns.setdefault(self.pattern(url), {})
+        counts[ext] = counts.get(ext, 0) + 1
+
+    def record_original(self, url, resolved):
+        counts = self.originals.setdefault(self.pattern(url), [0, 0])
+        counts[0 if resolved else 1] += 1
+
+    def goes_stale(self, url):
+        """
+        True when this pattern's original URLs have more often needed another extension than not.
+        """
+        resolved, stale = self.originals.get(self.pattern(url), (0, 0))
+        return stale > resolved
+
+    def should_probe(self, url):
+        """
+        Stop probing patterns where probing keeps finding nothing (genuinely missing files).
+        """
+        return self.failed_probes.get(self.pattern(url), 0) < self.max_failed_probes
+
+    def probe_failed(self, url):
+        pattern = self.pattern(url)
+        self.failed_probes[pattern] = self.failed_probes.get(pattern, 0) + 1
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'w') as f:
+                json.dump({'patterns': self.patterns, 'failed_probes': self.failed_probes, 'originals': self.originals}, f, indent=2)
+            print(f"Saved {len(self.patterns)} learned extension patterns to {self.path}")
+        except OSError as e:
+            print(f"Warning: Could not save extension cache '{self.path}': {e}")
+
 async def estimate_image_size(session, url):
     try:
         # Send a HEAD request to get headers only
@@ -60,27 +160,89 @@ async def handle_url_without_extension(session, url):
     except Exception:
         return None
 
-async def try_different_extensions(session, url, unresolved_urls):
+async def race_extensions(session, urls_by_ext):
+    """
+    Probe all candidate URLs with concurrent HEAD requests and return the first extension that
+    answers 200 with its size (None when there is no Content-Length), plus the candidates
+    whose server refused HEAD (405/501).
+    """
+    async def probe(ext, candidate_url):
+        async with session.head(candidate_url, allow_redirects=True) as response:
+            size_kb = None
+            if response.status == 200 and 'Content-Length' in response.headers:
+                size_kb = int(response.headers['Content-Length']) / 1024
+            return ext, response.status, size_kb
+
+    tasks = [asyncio.create_task(probe(ext, candidate_url)) for ext, candidate_url in urls_by_ext.items()]
+    no_head = []
+    try:
+        for future in asyncio.as_completed(tasks):
+            try:
+                ext, status, size_kb = await future
+            except Exception:
+                continue
+            if status == 200:
+                return ext, size_kb, []
+            if status in [405, 501]:
+                no_head.append(ext)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return None, None, no_head
+
+async def try_different_extensions(session, url, unresolved_urls, extension_cache=None):
+    url_parts = urlsplit(url)
+    if '.' in url_parts.path:
+        base, current_ext = url_parts.path.rsplit('.', 1)
+        current_ext = f".{current_ext}"
+    else:
+        base = url_parts.path
+        current_ext = ''
+
+    def with_ext(ext):
+        return urlunsplit((url_parts.scheme, url_parts.netloc, f"{base}{ext}", url_parts.query, url_parts.fragment))
+
+    # Start with the extension that resolved for similar URLs, if this pattern's originals tend to go stale
+    learned_ext = extension_cache.lookup(url) if extension_cache else None
+    tried_learned = bool(learned_ext) and learned_ext != current_ext and extension_cache.goes_stale(url)
+    if tried_learned:
+        size_kb = await estimate_image_size(session, with_ext(learned_ext))
+        if size_kb is not None:
+            extension_cache.learn(url, learned_ext)
+            extension_cache.hits += 1
+            return size_kb
+        extension_cache.misses += 1
+
     size_kb = await estimate_image_size(session, url)
     if size_kb is not None:
+        if extension_cache:
+            extension_cache.learn(url, current_ext)
+            extension_cache.record_original(url, True)
         return size_kb
 
-    # Try different extensions if the original URL does not work
+    # Race cheap HEAD probes for the other extensions instead of estimating each one in full
     extensions = ['.JPG', '.jpeg', '.JPEG', '.jpg', '.png', '.gif', '.pdf']
-    url_parts = urlsplit(url)
-    
-    for ext in extensions:
-        if '.' in url_parts.path:
-            base, current_ext = url_parts.path.rsplit('.', 1)
-        else:
-            base = url_parts.path
-            current_ext = ''
-        new_url = urlunsplit((url_parts.scheme, url_parts.netloc, f"{base}{ext}", url_parts.query, url_parts.fragment))
-        #print(f"Retrying with {new_url}...")
-        
-        size_kb = await estimate_image_size(session, new_url)
+    if not extension_cache or extension_cache.should_probe(url):
+        candidates = {ext: with_ext(ext) for ext in extensions if ext != current_ext and not (tried_learned and ext == learned_ext)}
+        if extension_cache:
+            extension_cache.probes += 1
+        ext, size_kb, no_head = await race_extensions(session, candidates)
+        if ext and size_kb is None:
+            # Resolved without a Content-Length: only the winner gets the ranged GET
+            size_kb = await estimate_image_size(session, with_ext(ext))
+        # Servers that refuse HEAD still get the old one-by-one estimate
+        for candidate in no_head:
+            if size_kb is not None:
+                break
+            ext, size_kb = candidate, await estimate_image_size(session, with_ext(candidate))
         if size_kb is not None:
+            if extension_cache:
+                extension_cache.learn(url, ext)
+                extension_cache.record_original(url, False)
+                extension_cache.probe_wins += 1
             return size_kb
+        if extension_cache:
+            extension_cache.probe_failed(url)
 
     # If no extension works, try handling URL without extension
     size_kb = await handle_url_without_extension(session, url)
@@ -91,24 +253,44 @@ async def try_different_extensions(session, url, unresolved_urls):
     print(f"Could not determine size for {url}")
     return 0
 
-async def get_total_size(urls):
+async def get_total_size(urls, extension_cache=None):
     unresolved_urls = []
     async with aiohttp.ClientSession() as session:
-        tasks = [try_different_extensions(session, url, unresolved_urls) for url in urls]
+        tasks = [try_different_extensions(session, url, unresolved_urls, extension_cache) for url in urls]
         sizes_kb = await asyncio.gather(*tasks)
 
     total_size_kb = sum(sizes_kb)
     total_size_mb = total_size_kb / 1024
     total_size_gb = total_size_mb / 1024
-    return total_size_kb, total_size_mb, total_size_gb, len(unresolved_urls)
+    return total_size_kb, total_size_mb, total_size_gb, len(unresolved_urls), sizes_kb
 
-async def run(urls):
-    total_size_kb, total_size_mb, total_size_gb, unresolved_count = await get_total_size(urls)
+async def run(urls, extension_cache=None, sizes_output=None, url_column='url'):
+    total_size_kb, total_size_mb, total_size_gb, unresolved_count, sizes_kb = await get_total_size(urls, extension_cache)
     print(f"Total Size: {total_size_mb:.2f} MB ({total_size_gb:.2f} GB)")
     print(f"Total unresolved URLs: {unresolved_count}")
+    if sizes_output:
+        pd.DataFrame({url_column: list(urls), 'size_kb': sizes_kb}).to_parquet(sizes_output, index=False)
+        print(f"Saved per-URL size estimates to {sizes_output}")
 
-async def main():
-    args = parse_args()
+def run_event_loop(coro, event_loop="asyncio"):
+    """
+    Run coro to completion on the chosen event loop implementation.
+    uvloop is optional; when it is not installed the default asyncio loop is used.
+    """
+    if event_loop == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            print("uvloop is not installed, falling back to the default asyncio event loop")
+        else:
+            if hasattr(uvloop, "run"):
+                return uvloop.run(coro)
+            uvloop.install()
+    return asyncio.run(coro)
+
+async def main(args=None):
+    if args is None:
+        args = parse_args()
     directory = args.directory
 
     df = pd.DataFrame()  # Initialize an empty DataFrame
@@ -129,7 +311,10 @@ async def main():
         return
 
     df = df.reset_index(drop=True)
-    await run(df[args.url_column])
+    extension_cache = ExtensionCache(args.extension_cache)
+    await run(df[args.url_column], extension_cache, args.sizes_output, args.url_column)
+    extension_cache.save()
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    args = parse_args()
+    run_event_loop(main(args), args.event_loop)
\ No newline at end of file
@@ -10,6 +10,8 @@ import time
 import mimetypes
 import argparse
 import json
+import io
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from tqdm.asyncio import tqdm
 import signal
@@ -28,9 +30,17 @@ def parse_args():
     parser.add_argument("--concurrent_downloads", type=int, default=1000, help="Number of concurrent downloads (default: 50).")
     parser.add_argument("--timeout", type=int, default=30, help="Download timeout in seconds (default: 30).")
     parser.add_argument("--max_file_size", type=int, default=500*1024*1024, help="Maximum file size in bytes (default: 500MB).")
+    parser.add_argument("--output_mode", type=str, default="folder", choices=["folder", "tar_stream"], help="'folder' stages files on disk and tars them at the end, 'tar_stream' appends them to the output tar as they arrive (default: folder).")
+    parser.add_argument("--archive_compression", type=str, default="none", choices=list(ARCHIVE_COMPRESSION), help="Compression for the output tar (default: none).")
+    parser.add_argument("--writer_threads", type=int, default=8, help="Threads writing downloads to disk; tar_stream always uses one (default: 8).")
+    parser.add_argument("--writer_queue_size", type=int, default=256, help="Maximum pending writes before downloads wait on disk (default: 256).")
+    parser.add_argument("--event_loop", type=str, default="asyncio", choices=["asyncio", "uvloop"], help="Event loop implementation; uvloop falls back to asyncio when not installed (default: asyncio).")
 
     return parser.parse_args()
 
+# Maps --archive_compression to the tarfile stream mode used to open the output
+ARCHIVE_COMPRESSION = {"none": "w|", "gz": "w|gz", "bz2": "w|bz2", "xz": "w|xz"}
+
 # Global flag for graceful shutdown
 shutdown_flag = False
 
@@ -42,7 +52,95 @@ def signal_handler(sig, frame):
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
-async def download_image_with_extensions(session, semaphore, row, output_folder, url_col, class_col, total_bytes, timeout, max_file_size):
+class TarStreamWriter:
+    """
+    Appends each download straight to the output tar so the staging folder is never created.
+    Members keep the same <output_folder>/<class>/<file> layout as the folder mode tar.
+    """
+    def __init__(self, output_path, output_folder, compression="none"):
+        self.root = os.path.basename(output_folder)
+        self.tar = tarfile.open(output_path, ARCHIVE_COMPRESSION[compression])
+        self.known_dirs = set()
+        self.members = 0
+        self._add_dir(self.root)
+
+    def _add_dir(self, arcname):
+        info = tarfile.TarInfo(arcname)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        info.mtime = time.time()
+        self.tar.addfile(info)
+        self.known_dirs.add(arcname)
+
+    def write(self, class_name, file_name, content):
+        """
+        Append one file to the archive and return its size.
+        """
+        class_dir = f"{self.root}/{class_name}"
+        if class_dir not in self.known_dirs:
+            self._add_dir(class_dir)
+        info = tarfile.TarInfo(f"{class_dir}/{file_name}")
+        info.size = len(content)
+        info.mode = 0o644
+        info.mtime = time.time()
+        self.tar.addfile(info, io.BytesIO(content))
+        self.members += 1
+        return info.size
+
+    def close(self):
+        self.tar.close()
+
+class WriterPool:
+    """
+    Runs the blocking writes on a thread pool so the event loop never waits on disk. At most
+    queue_size writes may be pending; once the queue is full, downloads wait for a slot,
+    which bounds the bodies held in memory and throttles network reads to disk speed.
+    """
+    def __init__(self, threads=8, queue_size=256):
+        self.threads = threads
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="writer")
+        self.slots = asyncio.Semaphore(queue_size)
+        self.pending = 0
+        self.max_pending = 0
+
+    async def run(self, fn, *args):
+        async with self.slots:
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+            finally:
+                self.pending -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def get_stats(self):
+        return {
+            "threads": self.threads,
+            "queue_size": self.queue_size,
+            "max_pending": self.max_pending
+        }
+
+async def monitor_event_loop_lag(lag_stats, interval=0.5):
+    """
+    Measure how late the event loop wakes up from a fixed sleep. Sustained lag means
+    something is blocking the loop and stalling every open socket.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        scheduled = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - scheduled)
+        lag_stats['samples'] += 1
+        lag_stats['total'] += lag
+        lag_stats['max'] = max(lag_stats['max'], lag)
+
+# Class directories already created by the writer threads
+created_dirs = set()
+
+async def download_image_with_extensions(session, semaphore, row, output_folder, url_col, class_col, total_bytes, timeout, max_file_size, tar_writer=None, writer_pool=None):
     """Download an image asynchronously with retries for different file extensions, tracking actual stored size."""
     
     global shutdown_flag
@@ -67,17 +165,28 @@ async def download_image_with_extensions(session, semaphore, row, output_folder,
                 # Check file size before saving
                 if len(content) > max_file_size:
                     return False, "File too large"
+
+                # Streamed archives get the bytes directly, no file on disk
+                if tar_writer is not None:
+                    total_bytes.append(tar_writer.write(class_name, os.path.basename(file_path), content))
+                    return True, None
                 
-                # Ensure directory exists
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                # Ensure directory exists (once per class)
+                class_dir = os.path.dirname(file_path)
+                if class_dir not in created_dirs:
+                    os.makedirs(class_dir, exist_ok=True)
+                    created_dirs.add(class_dir)
                 
                 with open(file_path, 'wb') as f:
-                    f.write(content)
-                file_size = os.path.getsize(file_path)  # Get actual stored size
+                    file_size = f.write(content)
                 total_bytes.append(file_size)  # Track real disk size
                 return True, None
             except Exception as e:
                 return False, str(e)
+
+        async def save_off_loop(content, file_path):
+            """Run the blocking write on the writer threads so the event loop keeps serving sockets"""
+            return await writer_pool.run(save_and_track, content, file_path)
         
         # If no extension, determine it dynamically
         if not original_ext:
@@ -90,7 +199,7 @@ async def download_image_with_extensions(session, semaphore, row, output_folder,
                         file_name = f"{base_url.split('/')[-2]}{ext}"
                         file_path = os.path.join(output_folder, class_name, file_name)
 
-                        success, error = save_and_track(content, file_path)
+                        success, error = await save_off_loop(content, file_path)
                         if success:
                             return key, file_name, class_name, None
                         else:
@@ -111,7 +220,7 @@ async def download_image_with_extensions(session, semaphore, row, output_folder,
                 async with session.get(image_url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
                     if response.status == 200:
                         content = await response.read()
-                        success, error = save_and_track(content, file_path)
+                        success, error = await save_off_loop(content, file_path)
                         if success:
                             return key, file_name, class_name, None
                         else:
@@ -136,7 +245,7 @@ async def download_image_with_extensions(session, semaphore, row, output_folder,
                     async with session.get(new_url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
                         if response.status == 200:
                             content = await response.read()
-                            success, error = save_and_track(content, file_path)
+                            success, error = await save_off_loop(content, file_path)
                             if success:
                                 return key, file_name, class_name, None
                             else:
@@ -149,10 +258,27 @@ async def download_image_with_extensions(session, semaphore, row, output_folder,
         # If all extensions fail
         return key, None, class_name, "All download attempts failed"
 
-async def main():
+def run_event_loop(coro, event_loop="asyncio"):
+    """
+    Run coro to completion on the chosen event loop implementation.
+    uvloop is optional; when it is not installed the default asyncio loop is used.
+    """
+    if event_loop == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            print("uvloop is not installed, falling back to the default asyncio event loop")
+        else:
+            if hasattr(uvloop, "run"):
+                return uvloop.run(coro)
+            uvloop.install()
+    return asyncio.run(coro)
+
+async def main(args=None):
     global shutdown_flag
     
-    args = parse_args()
+    if args is None:
+        args = parse_args()
 
     input = args.input
     output_path = args.output
@@ -161,6 +287,8 @@ async def main():
     concurrent_downloads = args.concurrent_downloads
     timeout = args.timeout
     max_file_size = args.max_file_size
+    output_mode = args.output_mode
+    archive_compression = args.archive_compression
 
     # Validate inputs
     if not os.path.exists(input):
@@ -211,11 +339,22 @@ async def main():
 
     print(f"Processing {filtered_count} images with {concurrent_downloads} concurrent downloads")
 
+    # The tarfile is not thread-safe, so a streamed archive gets a single writer thread
+    writer_pool = WriterPool(1 if output_mode == "tar_stream" else args.writer_threads, args.writer_queue_size)
+    tar_writer = None
+    if output_mode == "tar_stream":
+        tar_writer = TarStreamWriter(output_path, output_folder, archive_compression)
+        print(f"Streaming downloads into {output_path} (compression: {archive_compression})")
+
     semaphore = asyncio.Semaphore(concurrent_downloads)
     total_bytes = []  # List to track total bytes downloaded
 
     start_time = time.monotonic()  # Start timer
 
+    # Watch for anything that blocks the event loop
+    lag_stats = {'samples': 0, 'total': 0.0, 'max': 0.0}
+    lag_task = asyncio.create_task(monitor_event_loop_lag(lag_stats))
+
     # Configure session with connection pooling and limits
     connector = aiohttp.TCPConnector(
         limit=concurrent_downloads * 2,  # Total connection pool size
@@ -233,7 +372,7 @@ async def main():
         tasks = [
             download_image_with_extensions(
                 session, semaphore, row, output_folder, url_col, class_col, 
-                total_bytes, timeout, max_file_size
+                total_bytes, timeout, max_file_size, tar_writer, writer_pool
             ) 
             for _, row in df.iterrows()
         ]
@@ -262,6 +401,9 @@ async def main():
             print("Download interrupted by user")
             shutdown_flag = True
 
+    lag_task.cancel()
+    writer_pool.shutdown()
+    mean_lag = lag_stats['total'] / lag_stats['samples'] if lag_stats['samples'] else 0.0
     total_time = time.monotonic() - start_time  # Total time taken
     total_downloaded = sum(total_bytes)  # Total bytes downloaded
     total_errors = len(error_details)
@@ -310,6 +452,13 @@ async def main():
         "execution_info": {
             "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
             "shutdown_requested": shutdown_flag
+        },
+        "performance": {
+            "writer": writer_pool.get_stats(),
+            "event_loop_lag_ms": {
+                "mean": round(mean_lag * 1000, 2),
+                "max": round(lag_stats['max'] * 1000, 2)
+            }
         }
     }
     
@@ -340,12 +489,26 @@ async def main():
         print(f"  - Avg Speed: {avg_speed / 1e6:.2f} MB/s")
     else:
         print("  - No successful downloads to compute bandwidth statistics.")
+    print(f"  - Event loop lag: mean {mean_lag * 1000:.1f} ms, max {lag_stats['max'] * 1000:.1f} ms")
 
+    # Streamed archives are already written, only decide whether to keep them
+    if tar_writer is not None:
+        tar_writer.close()
+        if successful_downloads > 0 and not shutdown_flag:
+            tar_size = os.path.getsize(output_path)
+            print(f"Created tar archive: {Path(output_path).resolve()} ({tar_size / 1e6:.2f} MB, {tar_writer.members} files streamed)")
+        else:
+            os.remove(output_path)
+            if shutdown_flag:
+                print("Shutdown was requested, discarding partial tar archive")
+            elif successful_downloads == 0:
+                print("No successful downloads, discarding empty tar archive")
+            sys.exit(1 if total_errors > 0 else 0)
     # Only create tar if we have successful downloads and no shutdown was requested
-    if successful_downloads > 0 and not shutdown_flag and os.path.exists(output_folder):
+    elif successful_downloads > 0 and not shutdown_flag and os.path.exists(output_folder):
         try:
             print(f"\nCreating tar archive: {output_path}")
-            with tarfile.open(output_path, "w") as tar:
+            with tarfile.open(output_path, ARCHIVE_COMPRESSION[archive_compression]) as tar:
                 tar.add(output_folder, arcname=os.path.basename(output_folder))
 
             full_path = Path(output_path).resolve()
@@ -366,4 +529,5 @@ async def main():
         sys.exit(1 if total_errors > 0 else 0)
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    args = parse_args()
+    run_event_loop(main(args), args.event_loop)
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
 import sys
 import aiohttp
@@ -10,8 +13,26 @@ import time
 import mimetypes
 import argparse
 import json
+import hashlib
+import io
+import tempfile
+import threading
+import collections
+import contextlib
+import contextvars
+import heapq
+import itertools
+import email.utils
+import multiprocessing
+import importlib.util
+import zlib
+import random
+import shlex
+import subprocess
+from urllib.parse import urlsplit
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
-from tqdm.asyncio import tqdm
 import signal
 import shutil
 
@@ -26,6 +47,38 @@ def signal_handler(sig, frame):
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
+OUTPUT_MODES = ["folder", "tar_stream", "webdataset", "parquet"]
+# Error reported for URLs skipped because their host's circuit breaker is open
+HOST_PARKED_ERROR = "Host circuit open"
+# Statuses on the original URL that suggest a stale extension worth probing
+STALE_EXTENSION_STATUSES = [404, 410]
+# Maps --archive_compression to the tarfile stream mode used to open the output
+ARCHIVE_COMPRESSION = {"none": "w|", "gz": "w|gz", "bz2": "w|bz2", "xz": "w|xz"}
+# Event loop implementations accepted by --event_loop
+EVENT_LOOPS = ["asyncio", "uvloop"]
+# Progress output: a bar on stderr, JSON lines on stdout, or nothing
+PROGRESS_MODES = ["tty", "json", "silent"]
+# Image validation: magic bytes only, header parse, or a full decode
+VALIDATION_LEVELS = ["magic", "header", "full"]
+# Prefix of every validation rejection, so they group together in error_breakdown
+INVALID_IMAGE_ERROR = "Invalid image"
+# Re-encode targets for --transcode_format and the file extension they are stored under
+TRANSCODE_EXTENSIONS = {"jpeg": ".jpg", "webp": ".webp"}
+IMAGE_MAGIC = [
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+    (b"%PDF", "pdf")
+]
+# Retryable error classes, each with its own per-row retry budget (--retry_budget CLASS=N)
+RETRY_CLASSES = ["throttled", "timeout", "server_error", "invalid_image", "host_parked"]
+# Completion manifest, stored at the root of the output folder/tar
+MANIFEST_NAME = "manifest.jsonl"
+
 def parse_args():
     """
     Parse user inputs from arguments using argparse.
@@ -45,8 +98,52 @@ def parse_args():
     parser.add_argument("--rate_limit", type=float, default=100.0, help="Initial rate limit in requests per second (default: 100.0).")
     parser.add_argument("--rate_capacity", type=int, default=200, help="Token bucket capacity (default: 200).")
     parser.add_argument("--enable_rate_limiting", action="store_true", help="Enable token bucket rate limiting.")
-    parser.add_argument("--max_retry_attempts", type=int, default=3, help="Maximum retry attempts for 429 errors (default: 3).")
-    parser.add_argument("--retry_delay", type=float, default=2.0, help="Delay between retry attempts in seconds (default: 2.0).")
+    parser.add_argument("--byte_rate_limit", type=float, default=0.0, help="Cap download bandwidth in bytes per second, 0 to disable (default: 0).")
+    parser.add_argument("--max_retry_attempts", type=int, default=3, help="Maximum attempts per row for each retryable error class: 429, timeout, 5xx, invalid image, parked host (default: 3).")
+    parser.add_argument("--retry_delay", type=float, default=2.0, help="Delay before a row's first retry in seconds, doubled (with jitter) on every further retry (default: 2.0).")
+    parser.add_argument("--retry_max_delay", type=float, default=60.0, help="Longest delay before a retry, also caps Retry-After (default: 60.0).")
+    parser.add_argument("--retry_budget", type=str, nargs="+", default=[], help=f"Override retries per row for an error class as CLASS=N, CLASS one of {RETRY_CLASSES} (default: max_retry_attempts - 1 each).")
+    parser.add_argument("--per_host_scheduling", action="store_true", help="Give every host its own adaptive rate, concurrency window and circuit breaker.")
+    parser.add_argument("--host_rate_limit", type=float, default=20.0, help="Initial per-host rate in requests per second (default: 20.0).")
+    parser.add_argument("--host_max_concurrency", type=int, default=20, help="Maximum concurrent connections per host (default: 20).")
+    parser.add_argument("--circuit_failure_threshold", type=int, default=10, help="Consecutive 429/5xx/timeouts before a host's circuit opens (default: 10).")
+    parser.add_argument("--circuit_cooldown", type=float, default=30.0, help="Seconds a host's URLs stay parked once its circuit opens (default: 30.0).")
+    parser.add_argument("--extension_cache", type=str, default=None, help="JSON file where learned URL-pattern -> extension mappings are loaded from and saved to.")
+    parser.add_argument("--output_mode", type=str, default="folder", choices=OUTPUT_MODES, help="Where downloads go: 'folder' stages files on disk and tars them at the end, 'tar_stream' appends them to the output tar as they arrive, 'webdataset' streams <key>.<ext> + <key>.json samples into fixed-size shards, 'parquet' writes rows with an image bytes column (default: folder).")
+    parser.add_argument("--stream_chunk_size", type=int, default=0, help="Stream response bodies in chunks of this many bytes, rejecting oversized files as soon as they cross max_file_size (default: 0, read whole bodies).")
+    parser.add_argument("--writer_threads", type=int, default=8, help="Threads used for disk/tar writes (default: 8).")
+    parser.add_argument("--writer_queue_size", type=int, default=256, help="Maximum pending writes before downloads wait on disk (default: 256).")
+    parser.add_argument("--shard_max_size", type=int, default=1_000_000_000, help="webdataset mode: start a new shard once this many bytes are written (default: 1000000000).")
+    parser.add_argument("--shard_max_samples", type=int, default=0, help="webdataset mode: start a new shard after this many samples, 0 for no limit (default: 0).")
+    parser.add_argument("--shard_close_command", type=str, default=None, help="webdataset mode: command run on each closed shard, with {path} replaced by the shard path (e.g. an upload).")
+    parser.add_argument("--parquet_row_group_mb", type=int, default=128, help="parquet mode: image megabytes buffered per row group (default: 128).")
+    parser.add_argument("--archive_compression", type=str, default="none", choices=list(ARCHIVE_COMPRESSION), help="Compression for the output tar (default: none).")
+    parser.add_argument("--resume", action="store_true", help="Keep what an earlier attempt stored (staging folder, previous tar and its manifest) and only download the remaining rows. Implies --manifest, so pass it on the first attempt too.")
+    parser.add_argument("--manifest", action="store_true", help="Record every stored file (key, size, sha256) in a completion manifest that a later --resume picks up from.")
+    parser.add_argument("--manifest_sync_every", type=int, default=256, help="Completed rows between fsyncs of the completion manifest (default: 256).")
+    parser.add_argument("--dedupe_urls", action="store_true", help="Fetch each canonical URL once and fill in every other row that references it.")
+    parser.add_argument("--dedupe_content", action="store_true", help="Store byte-identical images from different URLs once, as hardlinks to the first copy.")
+    parser.add_argument("--processes", type=int, default=1, help="Shard the input by host across this many download processes and merge their output (default: 1).")
+    parser.add_argument("--event_loop", type=str, default="asyncio", choices=EVENT_LOOPS, help="Event loop implementation; uvloop falls back to asyncio when not installed (default: asyncio).")
+    parser.add_argument("--progress", type=str, default="tty", choices=PROGRESS_MODES, help="Progress output: 'tty' bar on stderr, 'json' line per interval on stdout, or 'silent' (default: tty).")
+    parser.add_argument("--progress_interval", type=float, default=1.0, help="Seconds between progress updates (default: 1.0).")
+    parser.add_argument("--validate_images", action="store_true", help="Reject empty, non-image, truncated and undersized bodies before they are stored (rejections are retried).")
+    parser.add_argument("--validation_level", type=str, default="full", choices=VALIDATION_LEVELS, help="'magic' checks the file signature, 'header' also parses the header, 'full' decodes the whole image (default: full).")
+    parser.add_argument("--validation_workers", type=int, default=4, help="Processes used to decode images for validation (default: 4).")
+    parser.add_argument("--min_image_width", type=int, default=0, help="Reject images narrower than this many pixels (default: 0).")
+    parser.add_argument("--min_image_height", type=int, default=0, help="Reject images shorter than this many pixels (default: 0).")
+    parser.add_argument("--transform_images", action="store_true", help="Downscale and re-encode images before they are stored.")
+    parser.add_argument("--resize_max_side", type=int, default=0, help="Downscale so the longest side is at most this many pixels, 0 to disable (default: 0).")
+    parser.add_argument("--resize_shortest_side", type=int, default=0, help="Downscale so the shortest side is at most this many pixels, 0 to disable (default: 0).")
+    parser.add_argument("--transcode_format", type=str, default="jpeg", choices=list(TRANSCODE_EXTENSIONS), help="Format transformed images are stored in (default: jpeg).")
+    parser.add_argument("--transcode_quality", type=int, default=90, help="Encoder quality for transformed images (default: 90).")
+    parser.add_argument("--strip_exif", action="store_true", help="Drop EXIF metadata from transformed images (orientation is applied first).")
+    parser.add_argument("--transform_workers", type=int, default=0, help="Processes used for transforms, 0 for one per available core (default: 0).")
+    parser.add_argument("--request_metrics", action="store_true", help="Time every request's phases (queue, dns, connect, ttfb, body, rate_limit, validate, transform, store) into per-host and per-status latency histograms in the overview.")
+    parser.add_argument("--metrics_log", type=str, default=None, help="JSON lines file for interval latency summaries (implies --request_metrics).")
+    parser.add_argument("--metrics_interval", type=float, default=10.0, help="Seconds between --metrics_log lines (default: 10.0).")
+    parser.add_argument("--event_log", type=str, default=None, help="JSON lines file for a sample of per-request timing events (implies --request_metrics).")
+    parser.add_argument("--event_sample_rate", type=float, default=0.01, help="Fraction of requests written to --event_log (default: 0.01).")
 
     args = parser.parse_args()
     
@@ -86,8 +183,52 @@ def load_json_config(config_path):
         'rate_limit': 100.0,
         'rate_capacity': 200,
         'enable_rate_limiting': False,
+        'byte_rate_limit': 0.0,
         'max_retry_attempts': 3,
-        'retry_delay': 2.0
+        'retry_delay': 2.0,
+        'retry_max_delay': 60.0,
+        'retry_budget': [],
+        'per_host_scheduling': False,
+        'host_rate_limit': 20.0,
+        'host_max_concurrency': 20,
+        'circuit_failure_threshold': 10,
+        'circuit_cooldown': 30.0,
+        'extension_cache': None,
+        'output_mode': 'folder',
+        'archive_compression': 'none',
+        'shard_max_size': 1_000_000_000,
+        'shard_max_samples': 0,
+        'shard_close_command': None,
+        'parquet_row_group_mb': 128,
+        'stream_chunk_size': 0,
+        'writer_threads': 8,
+        'writer_queue_size': 256,
+        'resume': False,
+        'manifest': False,
+        'manifest_sync_every': 256,
+        'dedupe_urls': False,
+        'dedupe_content': False,
+        'processes': 1,
+        'event_loop': 'asyncio',
+        'progress': 'tty',
+        'progress_interval': 1.0,
+        'validate_images': False,
+        'validation_level': 'full',
+        'validation_workers': 4,
+        'min_image_width': 0,
+        'min_image_height': 0,
+        'transform_images': False,
+        'resize_max_side': 0,
+        'resize_shortest_side': 0,
+        'transcode_format': 'jpeg',
+        'transcode_quality': 90,
+        'strip_exif': False,
+        'transform_workers': 0,
+        'request_metrics': False,
+        'metrics_log': None,
+        'metrics_interval': 10.0,
+        'event_log': None,
+        'event_sample_rate': 0.01
     }
     
     # Check required fields
@@ -113,8 +254,52 @@ def load_json_config(config_path):
         'rate_limit': (int, float),
         'rate_capacity': int,
         'enable_rate_limiting': bool,
+        'byte_rate_limit': (int, float),
         'max_retry_attempts': int,
-        'retry_delay': (int, float)
+        'retry_delay': (int, float),
+        'retry_max_delay': (int, float),
+        'retry_budget': list,
+        'per_host_scheduling': bool,
+        'host_rate_limit': (int, float),
+        'host_max_concurrency': int,
+        'circuit_failure_threshold': int,
+        'circuit_cooldown': (int, float),
+        'extension_cache': (str, type(None)),
+        'output_mode': str,
+        'archive_compression': str,
+        'shard_max_size': int,
+        'shard_max_samples': int,
+        'shard_close_command': (str, type(None)),
+        'parquet_row_group_mb': int,
+        'stream_chunk_size': int,
+        'writer_threads': int,
+        'writer_queue_size': int,
+        'resume': bool,
+        'manifest': bool,
+        'manifest_sync_every': int,
+        'dedupe_urls': bool,
+        'dedupe_content': bool,
+        'processes': int,
+        'event_loop': str,
+        'progress': str,
+        'progress_interval': (int, float),
+        'validate_images': bool,
+        'validation_level': str,
+        'validation_workers': int,
+        'min_image_width': int,
+        'min_image_height': int,
+        'transform_images': bool,
+        'resize_max_side': int,
+        'resize_shortest_side': int,
+        'transcode_format': str,
+        'transcode_quality': int,
+        'strip_exif': bool,
+        'transform_workers': int,
+        'request_metrics': bool,
+        'metrics_log': (str, type(None)),
+        'metrics_interval': (int, float),
+        'event_log': (str, type(None)),
+        'event_sample_rate': (int, float)
     }
     
     for field, expected_type in type_validators.items():
@@ -123,12 +308,50 @@ def load_json_config(config_path):
                 print(f"Error: Field '{field}' must be of type {expected_type.__name__ if not isinstance(expected_type, tuple) else ' or '.join(t.__name__ for t in expected_type)}.")
                 sys.exit(1)
     
+    if config_data['output_mode'] not in OUTPUT_MODES:
+        print(f"Error: Field 'output_mode' must be one of {OUTPUT_MODES}.")
+        sys.exit(1)
+    if config_data['archive_compression'] not in ARCHIVE_COMPRESSION:
+        print(f"Error: Field 'archive_compression' must be one of {list(ARCHIVE_COMPRESSION)}.")
+        sys.exit(1)
+    if config_data['event_loop'] not in EVENT_LOOPS:
+        print(f"Error: Field 'event_loop' must be one of {EVENT_LOOPS}.")
+        sys.exit(1)
+    if config_data['progress'] not in PROGRESS_MODES:
+        print(f"Error: Field 'progress' must be one of {PROGRESS_MODES}.")
+        sys.exit(1)
+    if config_data['validation_level'] not in VALIDATION_LEVELS:
+        print(f"Error: Field 'validation_level' must be one of {VALIDATION_LEVELS}.")
+        sys.exit(1)
+    if config_data['transcode_format'] not in TRANSCODE_EXTENSIONS:
+        print(f"Error: Field 'transcode_format' must be one of {list(TRANSCODE_EXTENSIONS)}.")
+        sys.exit(1)
+
     # Convert to argparse.Namespace for compatibility
     return argparse.Namespace(**config_data)
 
+def run_event_loop(coro, event_loop="asyncio"):
+    """
+    Run coro to completion on the chosen event loop implementation.
+    uvloop is optional; when it is not installed the default asyncio loop is used.
+    """
+    if event_loop == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            print("uvloop is not installed, falling back to the default asyncio event loop")
+        else:
+            if hasattr(uvloop, "run"):
+                return uvloop.run(coro)
+            uvloop.install()
+    return asyncio.run(coro)
+
 class TokenBucket:
     """
     A token bucket implementation for rate limiting.
+    Waiters are served in FIFO order and sleep exactly until enough tokens have
+    accumulated (one timer for the whole queue) instead of polling. Tokens can stand
+    for requests or for bytes; acquire(n) takes n of them at once.
     """
     def __init__(self, rate, capacity):
         """
@@ -140,35 +363,100 @@ class TokenBucket:
         self.rate = rate
         self.capacity = capacity
         self.tokens = capacity
-        self.last_refill = time.time()
+        self.last_refill = time.monotonic()
+        self.waiters = collections.deque()  # (amount, future) in arrival order
+        self.timer = None
 
-    async def acquire(self):
+    async def acquire(self, amount=1):
         """
-        Wait until a token is available and consume it.
+        Wait until amount tokens are available and consume them.
+        Requests larger than the capacity wait for a full bucket and leave it in debt.
         """
-        while True:
-            self._refill()
-            if self.tokens >= 1:
-                self.tokens -= 1
-                return
-            await asyncio.sleep(0.01)  # Wait a short time before checking again
+        self._refill()
+        if not self.waiters and self.tokens >= min(amount, self.capacity):
+            self.tokens -= amount
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append((amount, waiter))
+        self._schedule()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if not waiter.done() or waiter.cancelled():
+                self._forget(waiter)
+            else:
+                # Granted just as we were cancelled: hand the tokens back
+                self.tokens += amount
+                self._grant()
+            raise
+
+    def _forget(self, waiter):
+        for entry in self.waiters:
+            if entry[1] is waiter:
+                self.waiters.remove(entry)
+                break
+        self._schedule()
+
+    def _grant(self):
+        """
+        Hand out tokens to queued waiters in order, stopping at the first that cannot be served.
+        """
+        self._refill()
+        while self.waiters:
+            amount, waiter = self.waiters[0]
+            if waiter.done():
+                self.waiters.popleft()
+                continue
+            if self.tokens < min(amount, self.capacity):
+                break
+            self.waiters.popleft()
+            self.tokens -= amount
+            waiter.set_result(None)
+        self._schedule()
+
+    def _on_timer(self):
+        self.timer = None
+        self._grant()
+
+    def _schedule(self):
+        """
+        Arm a single timer for the moment the head waiter can be served.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.waiters:
+            return
+        amount = self.waiters[0][0]
+        missing = min(amount, self.capacity) - self.tokens
+        delay = max(0.0, missing / self.rate) if self.rate > 0 else 1.0
+        self.timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
 
     def _refill(self):
         """
         Refill the bucket with tokens based on the elapsed time.
         """
-        now = time.time()
+        now = time.monotonic()
         elapsed = now - self.last_refill
         new_tokens = elapsed * self.rate
         self.tokens = min(self.capacity, self.tokens + new_tokens)
         self.last_refill = now
 
+    def set_rate(self, new_rate):
+        """
+        Change the refill rate, crediting tokens earned at the old rate first.
+        """
+        self._refill()
+        self.rate = new_rate
+        if self.waiters:
+            self._schedule()
+
     def adjust_rate(self, new_rate, reason=""):
         new_rate = max(1, new_rate)  # Minimum 1 request per second
         if abs(new_rate - self.rate) > 0.1:  # Only adjust if significant change
             reason_str = f" ({reason})" if reason else ""
             print(f"[Rate Limit] {self.rate:.2f} -> {new_rate:.2f} req/sec{reason_str}")
-            self.rate = new_rate
+            self.set_rate(new_rate)
 
     def get_rate(self):
         return self.rate
@@ -189,107 +477,1944 @@ async def gradually_increase_rate(token_bucket, max_rate, interval=5):
             # print(f"[Gradual Recovery] At maximum rate: {current_rate:.2f} req/sec")
             pass
 
+class HostParked(Exception):
+    """
+    Raised when a request's host has an open circuit.
+    """
+
+class HostState:
+    """
+    Scheduling state for one host: its own token bucket, an AIMD concurrency window,
+    and a circuit breaker that opens after repeated throttling/timeouts.
+    """
+    def __init__(self, rate, capacity, window):
+        self.bucket = TokenBucket(rate=rate, capacity=capacity)
+        self.window = float(window)
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.last_decrease = 0.0
+        self.requests = 0
+        self.successes = 0
+        self.throttled = 0
+        self.circuit_trips = 0
+
+class HostScheduler:
+    """
+    Per-host rate and concurrency control so one slow or throttling host cannot
+    slow down the others. Each host adapts independently, AIMD style:
+    successes grow its rate and window additively, 429/5xx/timeouts halve them.
+    A host that keeps failing has its circuit opened for a cooldown, during which
+    its URLs are parked and retried once the circuit closes again.
+    A slot covers one row, including any fallback-extension requests. Workers check
+    has_room before taking a slot, so a full host never holds a worker hostage.
+    """
+    def __init__(self, rate, capacity, max_window, failure_threshold=10, cooldown=30.0):
+        self.initial_rate = rate
+        self.max_rate = rate * 10
+        self.min_rate = 0.5
+        self.capacity = capacity
+        self.max_window = max_window
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.decrease_interval = 1.0
+        self.hosts = {}
+
+    def _state(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = HostState(self.initial_rate, self.capacity, max(1, self.max_window // 2))
+            self.hosts[host] = state
+        return state
+
+    async def acquire(self, host):
+        """
+        Wait for a free slot in the host's window and a token from its bucket.
+        Raises HostParked if the host's circuit is (or becomes) open while waiting.
+        """
+        state = self._state(host)
+        while state.in_flight >= int(state.window):
+            if state.open_until > time.monotonic():
+                raise HostParked(host)
+            waiter = asyncio.get_running_loop().create_future()
+            state.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in state.waiters:
+                    state.waiters.remove(waiter)
+                raise
+        if state.open_until > time.monotonic():
+            raise HostParked(host)
+        state.in_flight += 1
+        try:
+            await state.bucket.acquire()
+        except asyncio.CancelledError:
+            self.release(host)
+            raise
+        if state.open_until > time.monotonic():
+            self.release(host)
+            raise HostParked(host)
+        state.requests += 1
+
+    def release(self, host):
+        state = self.hosts[host]
+        state.in_flight -= 1
+        self._wake(state)
+
+    def _wake(self, state, everyone=False):
+        free = len(state.waiters) if everyone else int(state.window) - state.in_flight
+        while free > 0 and state.waiters:
+            waiter = state.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url):
+        host = urlsplit(str(url)).netloc
+        with request_phase("rate_limit"):
+            await self.acquire(host)
+        try:
+            yield
+        finally:
+            self.release(host)
+
+    def has_room(self, url):
+        """
+        True when a request to the URL's host can take a slot without waiting. A host whose
+        circuit is open also counts, its rows are parked right away instead of waiting.
+        """
+        state = self.hosts.get(urlsplit(str(url)).netloc)
+        if state is None:
+            return True
+        return state.in_flight < int(state.window) or state.open_until > time.monotonic()
+
+    def parked_for(self, url):
+        """
+        Seconds until the URL's host circuit closes again, 0 when it is not open.
+        """
+        state = self.hosts.get(urlsplit(str(url)).netloc)
+        return max(0.0, state.open_until - time.monotonic()) if state is not None else 0.0
+
+    def record(self, url, status_code, error):
+        """
+        Feed one finished request back into its host's rate and window.
+        """
+        host = urlsplit(str(url)).netloc
+        state = self._state(host)
+        is_throttled = status_code == 429 or status_code in [502, 503, 504] or "Timeout" in str(error)
+        if is_throttled:
+            now = time.monotonic()
+            state.throttled += 1
+            state.consecutive_failures += 1
+            # A burst of failures from one congested moment counts as a single decrease
+            if now - state.last_decrease >= self.decrease_interval:
+                state.last_decrease = now
+                state.window = max(1.0, state.window / 2)
+                state.bucket.set_rate(max(self.min_rate, state.bucket.rate / 2))
+            if state.consecutive_failures >= self.failure_threshold and state.open_until <= now:
+                state.open_until = now + self.cooldown
+                state.circuit_trips += 1
+                print(f"\n[Circuit Open] {host}: {state.consecutive_failures} consecutive failures, parking its URLs for {self.cooldown:.0f}s")
+                # Everyone queued for this host parks instead of waiting out the cooldown
+                self._wake(state, everyone=True)
+        else:
+            # Any answer that is not throttling means the host is healthy
+            state.consecutive_failures = 0
+            if error is None:
+                state.successes += 1
+                state.window = min(float(self.max_window), state.window + 1 / state.window)
+                state.bucket.set_rate(min(self.max_rate, state.bucket.rate + 1 / state.bucket.rate))
+                self._wake(state)
+
+    def get_stats(self, top=50):
+        busiest = sorted(self.hosts.items(), key=lambda item: item[1].requests, reverse=True)[:top]
+        return {
+            "hosts_seen": len(self.hosts),
+            "hosts": {
+                host: {
+                    "requests": state.requests,
+                    "successes": state.successes,
+                    "throttled": state.throttled,
+                    "circuit_trips": state.circuit_trips,
+                    "final_rate": round(state.bucket.rate, 2),
+                    "final_window": round(state.window, 2)
+                }
+                for host, state in busiest
+            }
+        }
+
+def clean_class_name(label):
+    """Turn a label into the class folder name used inside the output"""
+    return str(label).replace("'", "").replace(" ", "_").replace("/", "_")
+
+def canonical_url(url):
+    """
+    Normalize the parts of a URL that do not change what is fetched: surrounding
+    whitespace, scheme/host case and the fragment.
+    """
+    parts = urlsplit(str(url).strip())
+    return f"{parts.scheme.lower()}://{parts.netloc.lower()}{parts.path}" + (f"?{parts.query}" if parts.query else "")
+
+class UrlDeduplicator:
+    """
+    Collapses rows that share a canonical URL so each URL is fetched once. The first row
+    for a URL is scheduled; once it is stored, the other rows are filled in from it
+    (a hardlink, or just a manifest reference when they land on the same file).
+    """
+    def __init__(self, urls):
+        codes, _ = pd.factorize(np.array([canonical_url(url) for url in urls], dtype=object))
+        _, first = np.unique(codes, return_index=True)
+        self.primary_positions = np.sort(first)
+        duplicate_positions = np.flatnonzero(~np.isin(np.arange(len(codes)), first))
+        self.duplicates = collections.defaultdict(list)
+        for position in duplicate_positions:
+            self.duplicates[first[codes[position]]].append(position)
+        self.duplicate_rows = len(duplicate_positions)
+        self.fanned_out = 0
+        self.bytes_saved = 0
+
+    def duplicate_keys(self, position, keys):
+        return [keys[duplicate] for duplicate in self.duplicates.get(position, [])]
+
+    async def fan_out(self, position, file_name, class_name, keys, labels, writer):
+        """
+        Give every duplicate of a stored row its own entry; returns how many rows were filled in.
+        """
+        filled = 0
+        for duplicate in self.duplicates.get(position, []):
+            size = await writer.link(clean_class_name(labels[duplicate]), file_name, f"{class_name}/{file_name}", keys[duplicate])
+            self.bytes_saved += size
+            filled += 1
+        self.fanned_out += filled
+        return filled
+
+    def get_stats(self):
+        return {
+            "unique_urls": len(self.primary_positions),
+            "duplicate_url_rows": self.duplicate_rows,
+            # Duplicates of a URL that failed share its failure, so only filled-in rows count as saved
+            "requests_saved": self.fanned_out,
+            "rows_filled_from_duplicates": self.fanned_out,
+            "download_bytes_saved": self.bytes_saved
+        }
+
+class ProgressReporter:
+    """
+    Progress from aggregated counters, rendered on a timer instead of per completion.
+    Workers only bump counters (record); the render task turns them into a TTY bar
+    on stderr, one JSON line per interval on stdout, or nothing at all.
+    """
+    def __init__(self, mode="tty", interval=1.0):
+        self.mode = mode
+        self.interval = interval
+        self.renders = 0
+        self.begin(0, [])
+
+    def begin(self, total, total_bytes, retry_scheduler=None):
+        self.total = total
+        self.retry_scheduler = retry_scheduler
+        self.total_bytes = total_bytes  # The shared size list; summed incrementally at render time
+        self.bytes_seen = len(total_bytes)
+        self.bytes = 0
+        self.completed = 0
+        self.successes = 0
+        self.status_counts = {}
+        self.started = time.monotonic()
+
+    def record(self, status_code, success, finished=True):
+        # Rows queued for a retry count towards the status breakdown but are not completed yet
+        self.completed += finished
+        self.successes += success
+        self.status_counts[status_code] = self.status_counts.get(status_code, 0) + 1
+
+    def _collect_bytes(self):
+        seen = len(self.total_bytes)
+        self.bytes += sum(self.total_bytes[self.bytes_seen:seen])
+        self.bytes_seen = seen
+
+    def render(self, final=False):
+        if self.mode == "silent":
+            return
+        self._collect_bytes()
+        self.renders += 1
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        retries = sum(self.retry_scheduler.scheduled.values()) if self.retry_scheduler else 0
+        retry_queue = self.retry_scheduler.pending if self.retry_scheduler else 0
+        if self.mode == "json":
+            print(json.dumps({
+                "event": "progress",
+                "elapsed_seconds": round(elapsed, 2),
+                "completed": self.completed,
+                "total": self.total,
+                "successes": self.successes,
+                "errors": self.completed - self.successes,
+                "retries": retries,
+                "retry_queue": retry_queue,
+                "bytes": self.bytes,
+                "requests_per_second": round(self.completed / elapsed, 1),
+                "mb_per_second": round(self.bytes / elapsed / 1e6, 3),
+                "status_counts": {str(status): count for status, count in sorted(self.status_counts.items())},
+                "final": final
+            }), flush=True)
+        else:
+            percent = self.completed / self.total * 100 if self.total else 100.0
+            filled = int(percent / 5)
+            statuses = " ".join(f"{status or 'err'}:{count}" for status, count in sorted(self.status_counts.items()))
+            line = (f"\r[{'#' * filled}{'.' * (20 - filled)}] {self.completed}/{self.total} "
+                    f"{percent:5.1f}% | {self.completed / elapsed:.0f} req/s | {self.bytes / elapsed / 1e6:.2f} MB/s | "
+                    f"retries {retries} ({retry_queue} queued) | {statuses}")
+            sys.stderr.write(line + ("\n" if final else ""))
+            sys.stderr.flush()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.render()
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of durations in microseconds: each power of two is split into
+    2**precision linear sub-buckets, so every recorded value keeps a relative error
+    below 2**-precision at a fixed, small memory cost. Buckets are kept sparse.
+    """
+    def __init__(self, precision=5):
+        self.precision = precision
+        self.counts = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _index(self, micros):
+        value = int(micros)
+        if value < (1 << self.precision):
+            return value
+        shift = value.bit_length() - self.precision - 1
+        return ((shift + 1) << self.precision) + (value >> shift) - (1 << self.precision)
+
+    def _lowest(self, index):
+        if index < (1 << self.precision):
+            return index
+        shift = (index >> self.precision) - 1
+        return ((index & ((1 << self.precision) - 1)) + (1 << self.precision)) << shift
+
+    def record(self, seconds):
+        micros = seconds * 1e6
+        self.counts[self._index(micros)] += 1
+        self.count += 1
+        self.total += micros
+        self.max = max(self.max, micros)
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        target = max(1, int(np.ceil(self.count * percent / 100)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._lowest(index), self.max)
+        return self.max
+
+    def summary(self):
+        """Milliseconds, rounded for the overview"""
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count / 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50) / 1000, 3),
+            "p90_ms": round(self.percentile(90) / 1000, 3),
+            "p99_ms": round(self.percentile(99) / 1000, 3),
+            "p999_ms": round(self.percentile(99.9) / 1000, 3),
+            "max_ms": round(self.max / 1000, 3)
+        }
+
+class RequestTiming:
+    """
+    Phase durations (seconds) for one row. A row can take several HTTP requests
+    (extension fallbacks, HEAD probes), their phases add up.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.http_requests = 0
+        self.reused_connections = 0
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+# The timing of the row the current task is downloading, read by the trace hooks and phase timers
+REQUEST_TIMING = contextvars.ContextVar("request_timing", default=None)
+# Retry-After of the last throttled response for the row the current task is downloading
+RETRY_AFTER = contextvars.ContextVar("retry_after", default=None)
+
+@contextlib.contextmanager
+def request_phase(phase):
+    """
+    Charge the time spent in the block to a phase of the current row, if metrics are on.
+    """
+    timing = REQUEST_TIMING.get()
+    if timing is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(phase, time.perf_counter() - started)
+
+class RequestMetrics:
+    """
+    Per-request phase timings, aggregated into latency histograms per host and per status.
+    Network phases come from aiohttp trace hooks: queue (waiting for a pooled connection),
+    dns, connect (TCP plus TLS, aiohttp does not report them apart) and ttfb (request sent
+    to response headers). Internal timers add body, rate_limit, probe (the HEAD race for a
+    stale extension), validate, transform and store, and total covers the whole row. Optionally emits interval summaries as JSON
+    lines and a sampled per-request event log.
+    """
+    def __init__(self, log_path=None, interval=10.0, event_log_path=None, event_sample_rate=0.01, top_hosts=20):
+        self.interval = interval
+        self.event_sample_rate = event_sample_rate
+        self.top_hosts = top_hosts
+        self.hosts = collections.defaultdict(lambda: collections.defaultdict(LatencyHistogram))
+        self.statuses = collections.defaultdict(lambda: collections.defaultdict(LatencyHistogram))
+        self.overall = collections.defaultdict(LatencyHistogram)
+        self.window = collections.defaultdict(LatencyHistogram)
+        self.window_statuses = collections.Counter()
+        self.host_requests = collections.Counter()
+        self.http_requests = 0
+        self.reused_connections = 0
+        self.events_logged = 0
+        self.started = time.monotonic()
+        self.log = open(log_path, 'a') if log_path else None
+        self.event_log = open(event_log_path, 'a') if event_log_path else None
+
+    def trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_queued_start.append(self._mark("queue"))
+        trace_config.on_connection_queued_end.append(self._charge("queue"))
+        trace_config.on_dns_resolvehost_start.append(self._mark("dns"))
+        trace_config.on_dns_resolvehost_end.append(self._charge("dns"))
+        trace_config.on_connection_create_start.append(self._mark("connect"))
+        trace_config.on_connection_create_end.append(self._charge("connect"))
+        trace_config.on_connection_reuseconn.append(self._on_reuseconn)
+        trace_config.on_request_headers_sent.append(self._mark("ttfb"))
+        trace_config.on_request_end.append(self._charge("ttfb"))
+        return trace_config
+
+    @staticmethod
+    def _mark(phase):
+        async def hook(session, context, params):
+            setattr(context, phase, time.perf_counter())
+        return hook
+
+    @staticmethod
+    def _charge(phase):
+        async def hook(session, context, params):
+            timing = REQUEST_TIMING.get()
+            started = getattr(context, phase, None)
+            if timing is not None and started is not None:
+                timing.add(phase, time.perf_counter() - started)
+        return hook
+
+    async def _on_request_start(self, session, context, params):
+        timing = REQUEST_TIMING.get()
+        if timing is not None:
+            timing.http_requests += 1
+
+    async def _on_reuseconn(self, session, context, params):
+        timing = REQUEST_TIMING.get()
+        if timing is not None:
+            timing.reused_connections += 1
+
+    def begin(self):
+        """Start timing a row in the calling task"""
+        timing = RequestTiming()
+        REQUEST_TIMING.set(timing)
+        return timing
+
+    def record(self, key, url, result, timing, attempt):
+        REQUEST_TIMING.set(None)
+        timing.add("total", time.perf_counter() - timing.started)
+        status = str(result[4] or "error")
+        host = urlsplit(str(url)).netloc
+        self.http_requests += timing.http_requests
+        self.reused_connections += timing.reused_connections
+        self.host_requests[host] += 1
+        self.window_statuses[status] += 1
+        for phase, seconds in timing.phases.items():
+            self.hosts[host][phase].record(seconds)
+            self.statuses[status][phase].record(seconds)
+            self.overall[phase].record(seconds)
+            self.window[phase].record(seconds)
+        if self.event_log is not None and random.random() < self.event_sample_rate:
+            self.events_logged += 1
+            raw_key = key.item() if isinstance(key, np.generic) else key
+            self.event_log.write(json.dumps({
+                "time": round(time.time(), 3),
+                "key": raw_key,
+                "url": str(url),
+                "host": host,
+                "attempt": attempt,
+                "status": result[4],
+                "error": result[3],
+                "http_requests": timing.http_requests,
+                "reused_connections": timing.reused_connections,
+                "phases_ms": {phase: round(seconds * 1000, 3) for phase, seconds in timing.phases.items()}
+            }) + "\n")
+
+    def emit(self):
+        """Write one JSON line summarizing the rows finished since the previous line"""
+        if self.log is not None and self.window_statuses:
+            self.log.write(json.dumps({
+                "event": "latency",
+                "elapsed_seconds": round(time.monotonic() - self.started, 2),
+                "rows": sum(self.window_statuses.values()),
+                "statuses": dict(self.window_statuses),
+                "phases": {phase: histogram.summary() for phase, histogram in self.window.items()}
+            }) + "\n")
+            self.log.flush()
+        self.window = collections.defaultdict(LatencyHistogram)
+        self.window_statuses = collections.Counter()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.emit()
+
+    def close(self):
+        self.emit()
+        for handle in (self.log, self.event_log):
+            if handle is not None:
+                handle.close()
+        self.log = self.event_log = None
+
+    def get_stats(self):
+        busiest = [host for host, _ in self.host_requests.most_common(self.top_hosts)]
+        return {
+            "http_requests": self.http_requests,
+            "reused_connections": self.reused_connections,
+            "sampled_events": self.events_logged,
+            "phases": {phase: histogram.summary() for phase, histogram in self.overall.items()},
+            "by_status": {
+                status: {phase: histogram.summary() for phase, histogram in phases.items()}
+                for status, phases in sorted(self.statuses.items())
+            },
+            "by_host": {
+                host: {phase: histogram.summary() for phase, histogram in self.hosts[host].items()}
+                for host in busiest
+            }
+        }
+
+def parse_retry_after(value):
+    """
+    Seconds to wait from a Retry-After header (delta-seconds or an HTTP date), None if absent or malformed.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def note_retry_after(response):
+    """Remember a throttled response's Retry-After for the row the current task is downloading"""
+    if response.status in [429, 503]:
+        RETRY_AFTER.set(parse_retry_after(response.headers.get('Retry-After')))
+
+def classify_retry(status_code, error):
+    """
+    The retryable error class of a failed row, or None when retrying would not help.
+    """
+    error = str(error)
+    if error == HOST_PARKED_ERROR:
+        return "host_parked"
+    if status_code == 429 or "429" in error:
+        return "throttled"
+    if status_code in [502, 503, 504]:
+        return "server_error"
+    if "Timeout" in error or status_code == 0:
+        return "timeout"
+    # Error pages and cut-off bodies are often transient; an undersized image is not
+    if error.startswith(INVALID_IMAGE_ERROR) and not error.endswith("below minimum size"):
+        return "invalid_image"
+    return None
+
+def parse_retry_budgets(budget_args, max_retry_attempts):
+    """
+    Retries per row for each error class: max_retry_attempts - 1 unless overridden by CLASS=N.
+    """
+    budgets = {retry_class: max(0, max_retry_attempts - 1) for retry_class in RETRY_CLASSES}
+    for budget in budget_args or []:
+        retry_class, _, count = budget.partition("=")
+        if retry_class not in budgets or not count.isdigit():
+            raise ValueError(f"Invalid retry budget '{budget}', expected CLASS=N with CLASS one of {RETRY_CLASSES}")
+        budgets[retry_class] = int(count)
+    return budgets
+
+class RetryScheduler:
+    """
+    Delay queue for rows that failed with a retryable error: a heap keyed on the time each
+    row may be tried again. The delay grows exponentially per row with jitter, is never
+    shorter than the server's Retry-After, and waits out an open host circuit. Every error
+    class has its own retry budget per row. Workers take ready retries before fresh rows,
+    so retries interleave with new work instead of waiting for the batch to drain.
+    """
+    def __init__(self, budgets, base_delay=2.0, max_delay=60.0, host_scheduler=None):
+        self.budgets = budgets
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.host_scheduler = host_scheduler
+        self.heap = []  # (ready time, sequence, batch index)
+        self.sequence = itertools.count()
+        self.retries = {}  # batch index -> Counter of retries per error class, only for retried rows
+        self.changed = asyncio.Event()
+        self.scheduled = collections.Counter()
+        self.exhausted = collections.Counter()
+        self.retry_after_honored = 0
+        self.total_delay = 0.0
+
+    @property
+    def pending(self):
+        return len(self.heap)
+
+    def attempt(self, index):
+        """1 for a fresh row, plus one per retry so far"""
+        retries = self.retries.get(index)
+        return 1 + (sum(retries.values()) if retries else 0)
+
+    def schedule(self, index, url, retry_class, retry_after=None):
+        """
+        Queue a row for another try; False once its budget for this error class is spent.
+        """
+        retries = self.retries.setdefault(index, collections.Counter())
+        if retries[retry_class] >= self.budgets.get(retry_class, 0):
+            self.exhausted[retry_class] += 1
+            return False
+        retries[retry_class] += 1
+        backoff = min(self.max_delay, self.base_delay * 2 ** (sum(retries.values()) - 1))
+        delay = random.uniform(backoff / 2, backoff)
+        if retry_after is not None:
+            self.retry_after_honored += 1
+            delay = max(delay, min(retry_after, self.max_delay))
+        if self.host_scheduler is not None:
+            delay = max(delay, self.host_scheduler.parked_for(url))
+        heapq.heappush(self.heap, (time.monotonic() + delay, next(self.sequence), index))
+        self.scheduled[retry_class] += 1
+        self.total_delay += delay
+        self.changed.set()
+        return True
+
+    def pop_ready(self):
+        """The next row whose delay has passed, or None"""
+        if self.heap and self.heap[0][0] <= time.monotonic():
+            return heapq.heappop(self.heap)[2]
+        return None
+
+    def drain(self):
+        """Batch indexes still waiting, e.g. when a shutdown cut the run short"""
+        indexes = [entry[2] for entry in self.heap]
+        self.heap = []
+        return indexes
+
+    def notify(self):
+        self.changed.set()
+
+    async def wait(self):
+        """
+        Sleep until the earliest retry is ready or the queue changes.
+        """
+        self.changed.clear()
+        # Wake at least once a second so a shutdown request is noticed
+        delay = min(1.0, max(0.0, self.heap[0][0] - time.monotonic())) if self.heap else 1.0
+        try:
+            await asyncio.wait_for(self.changed.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    def get_stats(self):
+        retried = sum(self.scheduled.values())
+        return {
+            "budgets": self.budgets,
+            "retries_scheduled": dict(self.scheduled),
+            "budget_exhausted": dict(self.exhausted),
+            "rows_retried": len([retries for retries in self.retries.values() if retries]),
+            "retry_after_honored": self.retry_after_honored,
+            "mean_delay_seconds": round(self.total_delay / retried, 3) if retried else 0.0
+        }
+
 async def download_batch_with_retries(
         session, 
-        df_batch, 
-        output_folder, 
-        url_col, 
-        class_col, 
+        keys, 
+        urls, 
+        labels, 
+        batch_positions, 
+        writer, 
         total_bytes, 
         timeout, 
         max_file_size, 
         token_bucket, 
         enable_rate_limiting,
         concurrent_downloads,
-        attempt_number=1
+        retry_scheduler=None,
+        chunk_size=0,
+        host_scheduler=None,
+        byte_bucket=None,
+        extension_cache=None,
+        deduplicator=None,
+        reporter=None,
+        metrics=None
     ):
     """
-    Download a batch of images and return successful downloads and 429 errors for retry.
+    Download a batch of images, retrying 429s, timeouts and other transient failures as they happen.
+    The batch is given as positions into the key/url/label column arrays, so retry bookkeeping
+    never touches a DataFrame. A fixed pool of concurrent_downloads workers pulls rows lazily,
+    taking rows whose retry delay has passed before fresh ones, so only that many requests
+    exist at a time no matter how large the batch is and the pool never drains between retries.
+    With per-host scheduling a row whose host window is full is set aside on that host's queue
+    and the worker moves on, so a slow host cannot tie up the pool while other hosts have room.
+    Returns successful downloads, the final error of every failed row, and the positions
+    still waiting for a retry when a shutdown cut the batch short.
     """
     global shutdown_flag
-    semaphore = asyncio.Semaphore(concurrent_downloads)
-    
-    tasks = [
-        download_image(
-            session, semaphore, row, output_folder, url_col, class_col, 
-            total_bytes, timeout, max_file_size, token_bucket
-        ) 
-        for _, row in df_batch.iterrows()
-    ]
+
+    total = len(batch_positions)
+    next_index = iter(range(total))  # Shared by all workers, each next() hands out one row
+    fresh_exhausted = False
+    in_flight = 0
+    deferred = {}  # host -> batch indexes set aside while its window was full
+    deferred_count = 0
     
     error_details = []
-    retry_rows = []  # Renamed to include both 429 and timeout errors
     successful_downloads = 0
+    if retry_scheduler is None:
+        retry_scheduler = RetryScheduler(parse_retry_budgets([], 3), host_scheduler=host_scheduler)
     
-    print(f"\n--- Attempt #{attempt_number} - Processing {len(tasks)} images ---")
+    print(f"\n--- Processing {total} images ---")
     if enable_rate_limiting and token_bucket:
         print(f"Current rate limit: {token_bucket.get_rate():.2f} req/sec")
-    
-    try:
-        for future in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=f"Downloading (attempt {attempt_number})"):
-            if shutdown_flag:
-                print("Shutdown requested, cancelling remaining downloads...")
-                break
-                
-            key, file_name, class_name, error, status_code = await future
-            if error:
+
+    def handle_result(index, position, result, retry_after):
+        """
+        Returns True when the row is finished, False when it was queued for a retry.
+        """
+        nonlocal successful_downloads
+        key, file_name, class_name, error, status_code = result
+        if error:
+            # Adaptive rate control based on error type; with per-host scheduling
+            # each host backs off on its own and the global rate is left alone
+            if token_bucket and enable_rate_limiting and host_scheduler is None:
+                if status_code == 429 or "429" in str(error):  # Rate limited
+                    new_rate = token_bucket.get_rate() * 0.5  # Reduce rate by 50%
+                    token_bucket.adjust_rate(new_rate, "HTTP 429 rate limited")
+                elif "Timeout" in str(error) or status_code == 0:  # Timeout errors
+                    new_rate = token_bucket.get_rate() * 0.6  # Reduce rate by 40%
+                    token_bucket.adjust_rate(new_rate, "timeout error")
+                elif status_code in [503, 502, 504]:  # Server errors
+                    new_rate = token_bucket.get_rate() * 0.75  # Reduce rate by 25%
+                    token_bucket.adjust_rate(new_rate, f"HTTP {status_code} server error")
+
+            retry_class = classify_retry(status_code, error)
+            if retry_class and not shutdown_flag and retry_scheduler.schedule(index, urls[position], retry_class, retry_after):
+                return False
+
+            error_details.append({
+                'key': key,
+                'file_name': file_name,
+                'class': class_name,
+                'error': error,
+                'status_code': status_code
+            })
+        else:
+            successful_downloads += 1
+        return True
+
+    async def handle_duplicates(position, result):
+        # Rows sharing this URL get the same final outcome without another request
+        nonlocal successful_downloads
+        key, file_name, class_name, error, status_code = result
+        if error:
+            for duplicate_key in deduplicator.duplicate_keys(position, keys):
                 error_details.append({
-                    'key': key,
+                    'key': duplicate_key,
                     'file_name': file_name,
                     'class': class_name,
                     'error': error,
-                    'status_code': status_code
+                    'status_code': status_code,
+                    'duplicate_of': key
                 })
-                
-                # Check if this is a 429 error or timeout error for retry
-                is_429_error = status_code == 429 or "429" in str(error)
-                is_timeout_error = "Timeout" in str(error) or status_code == 0
-                
-                if is_429_error or is_timeout_error:
-                    # Find the original row for retry
-                    original_row = df_batch.loc[df_batch.index == key]
-                    if not original_row.empty:
-                        retry_rows.append(original_row.iloc[0])
-                
-                # Adaptive rate control based on error type
-                if token_bucket and enable_rate_limiting:
-                    if status_code == 429 or "429" in str(error):  # Rate limited
-                        new_rate = token_bucket.get_rate() * 0.5  # Reduce rate by 50%
-                        token_bucket.adjust_rate(new_rate, "HTTP 429 rate limited")
-                    elif "Timeout" in str(error) or status_code == 0:  # Timeout errors
-                        new_rate = token_bucket.get_rate() * 0.6  # Reduce rate by 40%
-                        token_bucket.adjust_rate(new_rate, "timeout error")
-                    elif status_code in [503, 502, 504]:  # Server errors
-                        new_rate = token_bucket.get_rate() * 0.75  # Reduce rate by 25%
-                        token_bucket.adjust_rate(new_rate, f"HTTP {status_code} server error")
-                
-                # Only print errors that won't be retried in real-time
-                if not (is_429_error or is_timeout_error):
-                    print(f"\n[ERROR] Key: {key}, Error: {error}, Status Code: {status_code}")
-            else:
-                successful_downloads += 1
+        else:
+            filled = await deduplicator.fan_out(position, file_name, class_name, keys, labels, writer)
+            successful_downloads += filled  # Added after the await so concurrent updates are not lost
+
+    def next_deferred():
+        nonlocal deferred_count
+        for host, waiting in deferred.items():
+            if host_scheduler.has_room(urls[batch_positions[waiting[0]]]):
+                index = waiting.popleft()
+                if not waiting:
+                    del deferred[host]
+                deferred_count -= 1
+                return index
+        return None
+
+    def next_row():
+        nonlocal fresh_exhausted, deferred_count
+        while True:
+            index = retry_scheduler.pop_ready()
+            if index is None and deferred_count:
+                index = next_deferred()
+                if index is not None:
+                    return index
+            if index is None and not fresh_exhausted:
+                index = next(next_index, None)
+                fresh_exhausted = index is None
+            if index is None or host_scheduler is None:
+                return index
+            url = urls[batch_positions[index]]
+            if host_scheduler.has_room(url):
+                return index
+            # Set the row aside on its host's queue instead of waiting for a slot
+            deferred.setdefault(urlsplit(str(url)).netloc, collections.deque()).append(index)
+            deferred_count += 1
+
+    async def worker():
+        nonlocal in_flight
+        while not shutdown_flag:
+            index = next_row()
+            if index is None:
+                if fresh_exhausted and not retry_scheduler.pending and not deferred_count and in_flight == 0:
+                    retry_scheduler.notify()  # Let the other idle workers see that the batch is done
+                    break
+                await retry_scheduler.wait()
+                continue
+            in_flight += 1
+            try:
+                position = batch_positions[index]
+                timing = metrics.begin() if metrics is not None else None
+                RETRY_AFTER.set(None)
+                result = await download_image(
+                    session, keys[position], urls[position], labels[position], writer,
+                    total_bytes, timeout, max_file_size, token_bucket, chunk_size, host_scheduler, byte_bucket,
+                    extension_cache
+                )
+                if timing is not None:
+                    metrics.record(keys[position], urls[position], result, timing, retry_scheduler.attempt(index))
+                finished = handle_result(index, position, result, RETRY_AFTER.get())
+                reporter.record(result[4], result[3] is None, finished)
+                if finished and deduplicator is not None:
+                    await handle_duplicates(position, result)
+            finally:
+                in_flight -= 1
+            if deferred_count or (fresh_exhausted and in_flight == 0):
+                retry_scheduler.notify()  # A host slot just freed up, or the batch may be done
+
+    # Errors are tallied into the progress counters and the final breakdown rather than printed one by one
+    if reporter is None:
+        reporter = ProgressReporter()
+    reporter.begin(total, total_bytes, retry_scheduler)
+    render_task = asyncio.create_task(reporter.run())
+    workers = [asyncio.create_task(worker()) for _ in range(min(concurrent_downloads, total))]
+    try:
+        await asyncio.gather(*workers)
     except KeyboardInterrupt:
         print("Download interrupted by user")
         shutdown_flag = True
+    finally:
+        render_task.cancel()
+        reporter.render(final=True)
+
+    if shutdown_flag:
+        print("Shutdown requested, cancelling remaining downloads...")
     
-    return successful_downloads, error_details, retry_rows
+    # Rows still waiting out a retry delay or a host slot, taken in one vectorized step
+    waiting = retry_scheduler.drain() + [index for indexes in deferred.values() for index in indexes]
+    retry_positions = batch_positions[np.array(sorted(waiting), dtype=np.int64)]
+    return successful_downloads, error_details, retry_positions
+
+class ExtensionCache:
+    """
+    Learns which file extension actually resolves for URLs that share a host and path shape
+    (path segments containing digits are wildcarded, so photos/123/original.jpg and
+    photos/456/original.jpg share a pattern). The learned winner is only tried before the
+    original URL for patterns whose original URLs mostly went stale, and the mapping can be
+    persisted between runs.
+    """
+    def __init__(self, path=None, max_failed_probes=20):
+        self.path = path
+        self.max_failed_probes = max_failed_probes
+        self.patterns = {}  # pattern -> {extension: times it resolved}
+        self.failed_probes = {}  # pattern -> probes where no candidate resolved
+        self.originals = {}  # pattern -> [original URL resolved, original URL went stale]
+        self.hits = 0
+        self.misses = 0
+        self.probes = 0
+        self.probe_wins = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    saved = json.load(f)
+                self.patterns = saved.get('patterns', {})
+                self.failed_probes = saved.get('failed_probes', {})
+                self.originals = saved.get('originals', {})
+                print(f"Loaded {len(self.patterns)} learned extension patterns from {path}")
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Warning: Could not load extension cache '{path}': {e}")
+
+    @staticmethod
+    def pattern(url):
+        parts = urlsplit(str(url))
+        base, _ = os.path.splitext(parts.path)
+        segments = ['#' if any(c.isdigit() for c in segment) else segment for segment in base.split('/')]
+        return parts.netloc + '/'.join(segments)
+
+    def lookup(self, url):
+        """
+        Return the extension that has resolved most often for this URL's pattern, if any.
+        """
+        counts = self.patterns.get(self.pattern(url))
+        if not counts:
+            return None
+        return max(counts, key=counts.get)
+
+    def learn(self, url, ext):
+        counts = self.patterns.setdefault(self.pattern(url), {})
+        counts[ext] = counts.get(ext, 0) + 1
+
+    def record_original(self, url, resolved):
+        counts = self.originals.setdefault(self.pattern(url), [0, 0])
+        counts[0 if resolved else 1] += 1
+
+    def goes_stale(self, url):
+        """
+        True when this pattern's original URLs have more often needed another extension than not.
+        """
+        resolved, stale = self.originals.get(self.pattern(url), (0, 0))
+        return stale > resolved
+
+    def should_probe(self, url):
+        """
+        Stop probing patterns where probing keeps finding nothing (genuinely missing files).
+        """
+        return self.failed_probes.get(self.pattern(url), 0) < self.max_failed_probes
+
+    def probe_failed(self, url):
+        pattern = self.pattern(url)
+        self.failed_probes[pattern] = self.failed_probes.get(pattern, 0) + 1
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'w') as f:
+                json.dump({'patterns': self.patterns, 'failed_probes': self.failed_probes, 'originals': self.originals}, f, indent=2)
+            print(f"Saved {len(self.patterns)} learned extension patterns to {self.path}")
+        except OSError as e:
+            print(f"Warning: Could not save extension cache '{self.path}': {e}")
+
+    def get_stats(self):
+        return {
+            "learned_patterns": len(self.patterns),
+            "learned_winner_hits": self.hits,
+            "learned_winner_misses": self.misses,
+            "probe_races": self.probes,
+            "probe_race_wins": self.probe_wins
+        }
+
+class CompletionManifest:
+    """
+    Durable record of every stored row (key, file, bytes, sha256) as JSON lines, so a
+    retried or preempted task only downloads what is still missing. Lines are appended
+    as files are stored and fsynced in batches rather than once per file.
+    """
+    def __init__(self, path, sync_every=256, sync_interval=5.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.entries = {}
+        self.lock = threading.Lock()  # Records arrive from the writer threads
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.syncs = 0
+        self.recorded = 0
+        self.previously_completed = 0
+
+    def load(self, lines):
+        """
+        Merge manifest lines; a torn last line left by a crash is skipped.
+        """
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                self.entries[str(entry['key'])] = entry
+            except (ValueError, KeyError, TypeError):
+                continue
+
+    def load_file(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.load(f)
+
+    def retain(self, is_stored):
+        """
+        Keep only entries whose file actually survived the previous attempt.
+        """
+        self.entries = {key: entry for key, entry in self.entries.items() if is_stored(entry)}
+        self.previously_completed = len(self.entries)
+
+    def completed_keys(self):
+        return set(self.entries)
+
+    def open(self):
+        """
+        Rewrite the surviving entries (atomically, so a crash here loses nothing) and append from there.
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+        self.file = open(self.path, 'a')
+
+    def record(self, key, member, size, checksum, duplicate_of=None):
+        entry = {
+            "key": key.item() if isinstance(key, np.generic) else key,
+            "file": member,
+            "bytes": size,
+            "sha256": checksum
+        }
+        if duplicate_of is not None:
+            entry["duplicate_of"] = duplicate_of
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            self.entries[str(entry['key'])] = entry
+            self.file.write(line)
+            self.recorded += 1
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.syncs += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self._sync()
+                self.file.close()
+                self.file = None
+
+    def get_stats(self):
+        return {
+            "manifest": self.path,
+            "previously_completed": self.previously_completed,
+            "recorded": self.recorded,
+            "fsyncs": self.syncs
+        }
+
+def sniff_image_format(header):
+    """
+    Identify an image container from its first bytes; None when it is not a known format.
+    """
+    for magic, image_format in IMAGE_MAGIC:
+        if header.startswith(magic):
+            return image_format
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header[4:8] == b"ftyp" and header[8:12] in (b"heic", b"heix", b"mif1", b"avif"):
+        return "heif"
+    return None
+
+def inspect_image(source, level="full", min_width=0, min_height=0):
+    """
+    Validate one image given as bytes or a file path; returns None or a rejection reason.
+    Runs in the validation process pool, so the decode never touches the event loop.
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            source = f.read()
+    if not source:
+        return f"{INVALID_IMAGE_ERROR}: empty body"
+    image_format = sniff_image_format(source[:16])
+    if image_format is None:
+        head = source[:512].lstrip().lower()
+        if head.startswith(b"<!doctype") or head.startswith(b"<html") or head.startswith(b"<?xml"):
+            return f"{INVALID_IMAGE_ERROR}: HTML/XML page"
+        return f"{INVALID_IMAGE_ERROR}: unknown format"
+    # Formats Pillow does not decode out of the box only get the magic-byte check
+    if level == "magic" or image_format in ("pdf", "heif"):
+        return None
+
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(source)) as image:
+            width, height = image.size
+            if level == "full":
+                image.load()
+    except Image.DecompressionBombError:
+        return f"{INVALID_IMAGE_ERROR}: decompression bomb"
+    except Exception:
+        # Only once the decode failed: valid JPEGs may carry trailers (motion photos, maker data) after the EOI marker
+        if image_format == "jpeg" and b"\xff\xd9" not in source[-1024:]:
+            return f"{INVALID_IMAGE_ERROR}: truncated"
+        return f"{INVALID_IMAGE_ERROR}: corrupt or truncated"
+    if width < min_width or height < min_height:
+        return f"{INVALID_IMAGE_ERROR}: below minimum size"
+    return None
+
+class ImageValidator:
+    """
+    Rejects bodies that are not usable images before they reach the output: empty bodies,
+    HTML pages served with a 200, unknown formats, truncated or undecodable files and
+    images under the minimum size. Decoding runs in a process pool; the magic-byte sniff
+    of in-memory bodies happens inline because it is cheaper than shipping them to a worker.
+    """
+    def __init__(self, level="full", min_width=0, min_height=0, workers=4):
+        if level != "magic" and importlib.util.find_spec("PIL") is None:
+            print("Pillow is not installed, image validation falls back to magic-byte checks")
+            level = "magic"
+        self.level = level
+        self.min_width = min_width
+        self.min_height = min_height
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        # Start the workers now so their interpreter start-up overlaps the first requests
+        for _ in range(workers):
+            self.executor.submit(int)
+        self.checked = 0
+        self.rejected = 0
+        self.decode_seconds = 0.0
+
+    async def check(self, source):
+        """
+        Validate bytes (or a file path for bodies streamed to disk); returns None or the rejection reason.
+        """
+        self.checked += 1
+        if isinstance(source, bytes) and (self.level == "magic" or not source):
+            error = inspect_image(source, "magic")  # Only a header sniff, cheap enough for the loop
+        else:
+            start = time.monotonic()
+            error = await asyncio.get_running_loop().run_in_executor(
+                self.executor, inspect_image, source, self.level, self.min_width, self.min_height
+            )
+            self.decode_seconds += time.monotonic() - start
+        if error:
+            self.rejected += 1
+        return error
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def get_stats(self):
+        return {
+            "level": self.level,
+            "workers": self.workers,
+            "checked": self.checked,
+            "rejected": self.rejected,
+            "mean_check_ms": round(self.decode_seconds / self.checked * 1000, 2) if self.checked else 0.0
+        }
+
+def transform_image(source, max_side=0, shortest_side=0, image_format="jpeg", quality=90, strip_exif=False):
+    """
+    Downscale and re-encode one image given as bytes or a file path.
+    Returns (content, error, seconds); runs in the transform process pool.
+    """
+    start = time.process_time()
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            source = f.read()
+
+    from PIL import Image, ImageOps
+    try:
+        with Image.open(io.BytesIO(source)) as image:
+            width, height = image.size
+            scale = 1.0
+            if shortest_side and min(width, height) > shortest_side:
+                scale = shortest_side / min(width, height)
+            if max_side and max(width, height) * scale > max_side:
+                scale = max_side / max(width, height)
+            target = (max(1, round(width * scale)), max(1, round(height * scale)))
+            # Orientations 5-8 turn the image by 90/270 degrees once the EXIF tag is baked in
+            transposed = strip_exif and image.getexif().get(0x0112, 1) in (5, 6, 7, 8)
+            same_format = (image.format or "").lower() == image_format
+
+            # Nothing to change: keep the original bytes rather than re-encoding them
+            if scale == 1.0 and same_format and not strip_exif:
+                return source, None, time.process_time() - start
+
+            # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale, which is far cheaper than a full decode
+            if scale < 1.0:
+                image.draft("RGB", target)
+            image.load()
+            exif = image.info.get("exif")
+            if strip_exif:
+                # Bake the orientation into the pixels before the tag that carries it is dropped
+                image = ImageOps.exif_transpose(image)
+                exif = None
+            if transposed:
+                target = (target[1], target[0])
+            if image.size != target:
+                image = image.resize(target, Image.LANCZOS)
+            if image.mode not in ("RGB", "L") and not (image_format == "webp" and image.mode == "RGBA"):
+                image = image.convert("RGBA" if image_format == "webp" and "A" in image.mode else "RGB")
+
+            output = io.BytesIO()
+            save_options = {"quality": quality}
+            if exif:
+                save_options["exif"] = exif
+            image.save(output, format=image_format.upper(), **save_options)
+    except Exception:
+        return None, f"{INVALID_IMAGE_ERROR}: corrupt or truncated", time.process_time() - start
+
+    return output.getvalue(), None, time.process_time() - start
+
+def available_cores():
+    """Cores this process may run on (respects the task's CPU affinity where the OS exposes it)"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+class ImageTransformer:
+    """
+    Shrinks images between download and archive: downscale so the longest side is at most
+    max_side and/or the shortest side at most shortest_side, then re-encode as JPEG or WebP.
+    Work runs in a process pool; at most two images per worker are in flight, and the
+    downloads waiting behind that limit are the backpressure on the network stage.
+    """
+    def __init__(self, max_side=0, shortest_side=0, image_format="jpeg", quality=90, strip_exif=False, workers=0):
+        self.max_side = max_side
+        self.shortest_side = shortest_side
+        self.image_format = image_format
+        self.quality = quality
+        self.strip_exif = strip_exif
+        self.workers = workers or available_cores()
+        self.extension = TRANSCODE_EXTENSIONS[image_format]
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        for _ in range(self.workers):
+            self.executor.submit(int)
+        self.slots = asyncio.Semaphore(self.workers * 2)
+        self.transformed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.worker_seconds = 0.0
+        self.started = None
+        self.finished = None
+
+    def output_name(self, file_name):
+        return os.path.splitext(file_name)[0] + self.extension
+
+    async def transform(self, source, source_size):
+        """
+        Transform bytes (or a file path for streamed bodies); returns (content, error).
+        """
+        async with self.slots:
+            if self.started is None:
+                self.started = time.monotonic()
+            content, error, seconds = await asyncio.get_running_loop().run_in_executor(
+                self.executor, transform_image, source, self.max_side, self.shortest_side,
+                self.image_format, self.quality, self.strip_exif
+            )
+            self.finished = time.monotonic()
+        self.worker_seconds += seconds
+        if error is None:
+            self.transformed += 1
+            self.bytes_in += source_size
+            self.bytes_out += len(content)
+        return content, error
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def get_stats(self):
+        elapsed = (self.finished - self.started) if self.started and self.finished else 0.0
+        return {
+            "workers": self.workers,
+            "format": self.image_format,
+            "quality": self.quality,
+            "max_side": self.max_side,
+            "shortest_side": self.shortest_side,
+            "strip_exif": self.strip_exif,
+            "images": self.transformed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "bytes_saved": self.bytes_in - self.bytes_out,
+            "images_per_second": round(self.transformed / elapsed, 1) if elapsed > 0 else 0.0,
+            "input_mb_per_second": round(self.bytes_in / elapsed / 1e6, 2) if elapsed > 0 else 0.0,
+            "mean_cpu_ms": round(self.worker_seconds / self.transformed * 1000, 2) if self.transformed else 0.0
+        }
+
+class FolderWriter:
+    """
+    Writes each download to output_folder/<class>/<file> for tarring at the end.
+    Class directories are created once and remembered, so each file costs a single open/write.
+    """
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        self.created_dirs = set()
+
+    def _class_dir(self, class_name):
+        class_dir = os.path.join(self.output_folder, class_name)
+        if class_dir not in self.created_dirs:
+            os.makedirs(class_dir, exist_ok=True)
+            self.created_dirs.add(class_dir)
+        return class_dir
+
+    def write(self, class_name, file_name, content, key=None, checksum=None):
+        """
+        Store one file and return the number of bytes written.
+        key and checksum describe the sample for sinks that store per-sample metadata.
+        """
+        file_path = os.path.join(self._class_dir(class_name), file_name)
+        with open(file_path, 'wb') as f:
+            return f.write(content)
+
+    def begin(self, class_name, file_name):
+        """
+        Open a handle that streamed chunks are written to; the file only appears once committed.
+        """
+        file_path = os.path.join(self._class_dir(class_name), file_name)
+        handle = open(file_path + ".part", 'wb')
+        handle.final_path = file_path
+        return handle
+
+    def commit(self, handle):
+        size = handle.tell()
+        handle.close()
+        os.replace(handle.name, handle.final_path)
+        return size
+
+    def abort(self, handle):
+        handle.close()
+        if os.path.exists(handle.name):
+            os.remove(handle.name)
+
+    def link(self, class_name, file_name, target):
+        """
+        Point class_name/file_name at an already stored file (target is relative to the folder).
+        Hardlinks are tarred as link members, so duplicates cost no space in the archive either.
+        """
+        file_path = os.path.join(self._class_dir(class_name), file_name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        try:
+            os.link(os.path.join(self.output_folder, target), file_path)
+        except OSError:
+            shutil.copyfile(os.path.join(self.output_folder, target), file_path)
+
+    def add_manifest(self, manifest_path):
+        # The manifest already lives in the folder, so it is tarred with it
+        pass
+
+    def close(self):
+        pass
+
+class TarStreamWriter:
+    """
+    Appends each download straight to the output tar so the staging folder is never created.
+    Members keep the same <output_folder>/<class>/<file> layout that create_tar_archive produces.
+    """
+    def __init__(self, output_path, output_folder, compression="none", spool_size=64*1024):
+        self.output_path = output_path
+        self.spool_size = spool_size
+        self.root = os.path.basename(output_folder)
+        self.tar = tarfile.open(output_path, ARCHIVE_COMPRESSION[compression])
+        self.lock = threading.Lock()  # tarfile is not thread-safe; writer threads take turns appending
+        self.known_dirs = set()
+        self.members = 0
+        self._add_dir(self.root)
+
+    def _add_dir(self, arcname):
+        info = tarfile.TarInfo(arcname)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        info.mtime = time.time()
+        self.tar.addfile(info)
+        self.known_dirs.add(arcname)
+
+    def _append(self, class_name, file_name, size, fileobj):
+        class_dir = f"{self.root}/{class_name}"
+        info = tarfile.TarInfo(f"{class_dir}/{file_name}")
+        info.size = size
+        info.mode = 0o644
+        info.mtime = time.time()
+        with self.lock:
+            if class_dir not in self.known_dirs:
+                self._add_dir(class_dir)
+            self.tar.addfile(info, fileobj)
+            self.members += 1
+        return size
+
+    def write(self, class_name, file_name, content, key=None, checksum=None):
+        """
+        Append one file to the archive and return its size.
+        """
+        return self._append(class_name, file_name, len(content), io.BytesIO(content))
+
+    def begin(self, class_name, file_name):
+        """
+        Tar headers need the member size up front, so streamed chunks are spooled
+        (in memory up to spool_size, then to a temp file) until the body is complete.
+        """
+        handle = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        handle.member = (class_name, file_name)
+        return handle
+
+    def commit(self, handle):
+        class_name, file_name = handle.member
+        size = handle.tell()
+        handle.seek(0)
+        try:
+            return self._append(class_name, file_name, size, handle)
+        finally:
+            handle.close()
+
+    def abort(self, handle):
+        handle.close()
+
+    def link(self, class_name, file_name, target):
+        """
+        Add a hardlink member pointing at an already appended file.
+        """
+        class_dir = f"{self.root}/{class_name}"
+        info = tarfile.TarInfo(f"{class_dir}/{file_name}")
+        info.type = tarfile.LNKTYPE
+        info.linkname = f"{self.root}/{target}"
+        info.mode = 0o644
+        info.mtime = time.time()
+        with self.lock:
+            if class_dir not in self.known_dirs:
+                self._add_dir(class_dir)
+            self.tar.addfile(info)
+            self.members += 1
+
+    def add_manifest(self, manifest_path):
+        """
+        Close the manifest into the archive so a task re-queued elsewhere can resume from the tar alone.
+        """
+        info = tarfile.TarInfo(f"{self.root}/{MANIFEST_NAME}")
+        info.size = os.path.getsize(manifest_path)
+        info.mode = 0o644
+        info.mtime = time.time()
+        with open(manifest_path, 'rb') as f, self.lock:
+            self.tar.addfile(info, f)
+
+    def close(self):
+        self.tar.close()
+
+def output_stem(output_path):
+    """Output path without its archive suffixes: images.tar.gz -> images"""
+    stem = output_path
+    for suffix in (".gz", ".bz2", ".xz", ".tar", ".parquet"):
+        if stem.endswith(suffix):
+            stem = stem[:-len(suffix)]
+    return stem
+
+class WebDatasetWriter:
+    """
+    Writes WebDataset-style shards: flat tars of <key>.<ext> + <key>.json samples, rolling over
+    to a new shard once max_size bytes or max_samples samples are reached. Each shard is final
+    as soon as it closes, so close_command (e.g. an upload, with {path} filled in) can ship it
+    while later shards are still downloading.
+    """
+    stores_checksums = True  # Every sample's JSON carries its sha256
+
+    def __init__(self, output_path, sample_sources, max_size=1_000_000_000, max_samples=0, compression="none", close_command=None, spool_size=64*1024):
+        stem = output_stem(output_path)
+        self.pattern = stem + "-{:06d}" + (output_path[len(stem):] or ".tar")
+        self.sample_sources = sample_sources  # Row key -> (url, label) for the sample metadata
+        self.max_size = max_size
+        self.max_samples = max_samples
+        self.compression = compression
+        # Split once, then fill {path} into each argument: paths with spaces stay one argument and other braces are left alone
+        self.close_command = shlex.split(close_command) if close_command else None
+        self.spool_size = spool_size
+        self.lock = threading.Lock()
+        self.tar = None
+        self.current = None
+        self.shards = []
+        self.commands = []
+        self.members = 0
+
+    def _open_shard(self):
+        path = self.pattern.format(len(self.shards))
+        self.tar = tarfile.open(path, ARCHIVE_COMPRESSION[self.compression])
+        self.current = {"path": path, "samples": 0, "bytes": 0}
+
+    def _close_shard(self):
+        self.tar.close()
+        self.current["bytes"] = os.path.getsize(self.current["path"])
+        self.shards.append(self.current)
+        print(f"\nClosed shard {self.current['path']} ({self.current['samples']} samples, {self.current['bytes'] / 1e6:.2f} MB)")
+        if self.close_command:
+            self.commands.append(subprocess.Popen([arg.replace("{path}", self.current["path"]) for arg in self.close_command]))
+        self.tar = None
+        self.current = None
+
+    def _add_member(self, name, size, fileobj):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o644
+        info.mtime = time.time()
+        self.tar.addfile(info, fileobj)
+
+    def _append(self, key, class_name, file_name, size, fileobj, checksum):
+        url, label = self.sample_sources.get(key, (None, None))
+        raw_key = key.item() if isinstance(key, np.generic) else key
+        # WebDataset splits the sample key from the extension at the first dot
+        sample_key = str(raw_key).replace(".", "_").replace("/", "_")
+        extension = os.path.splitext(file_name)[1].lower() or ".jpg"
+        metadata = json.dumps({
+            "key": raw_key,
+            "url": url,
+            "label": None if label is None else str(label),
+            "class": class_name,
+            "file_name": file_name,
+            "size": size,
+            "sha256": checksum
+        }).encode()
+        sample_size = size + len(metadata) + 2048  # Two headers plus block padding, roughly
+        with self.lock:
+            # Roll over before a sample would push the shard past its size target
+            if self.tar is not None and self.current["bytes"] + sample_size > self.max_size:
+                self._close_shard()
+            if self.tar is None:
+                self._open_shard()
+            self._add_member(f"{sample_key}{extension}", size, fileobj)
+            self._add_member(f"{sample_key}.json", len(metadata), io.BytesIO(metadata))
+            self.members += 1
+            self.current["samples"] += 1
+            self.current["bytes"] += sample_size
+            if self.max_samples and self.current["samples"] >= self.max_samples:
+                self._close_shard()
+        return size
+
+    def write(self, class_name, file_name, content, key=None, checksum=None):
+        return self._append(key, class_name, file_name, len(content), io.BytesIO(content), checksum)
+
+    def begin(self, class_name, file_name):
+        handle = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        handle.member = (class_name, file_name)
+        return handle
+
+    def commit(self, handle):
+        key, class_name, file_name = handle.entry
+        size = handle.tell()
+        handle.seek(0)
+        try:
+            return self._append(key, class_name, file_name, size, handle, getattr(handle, 'digest', None))
+        finally:
+            handle.close()
+
+    def abort(self, handle):
+        handle.close()
+
+    def add_manifest(self, manifest_path):
+        # Shards hold samples only; the manifest stays next to them
+        pass
+
+    def close(self):
+        with self.lock:
+            if self.tar is not None:
+                self._close_shard()
+        for command in self.commands:
+            if command.wait() != 0:
+                print(f"Warning: shard close command exited with {command.returncode}: {command.args}")
+        self.commands = []
+
+    def get_stats(self):
+        return {
+            "shard_max_size": self.max_size,
+            "shard_max_samples": self.max_samples,
+            "samples": self.members,
+            "shards": self.shards
+        }
+
+class ParquetSampleWriter:
+    """
+    Writes downloads as rows of a parquet file: an image struct column ({bytes, path}, the layout
+    ImgReconstruct reads) plus label, class, url, key, size and sha256. Only stored downloads
+    become rows; failed ones are in the overview's error breakdown. Rows are buffered
+    until row_group_size bytes and then flushed as one row group, so memory stays bounded while
+    row groups stay large enough for fast sequential scans. Image bytes are already compressed
+    and are stored as-is; the small metadata columns use zstd.
+    """
+    stores_checksums = True  # Every row carries its sha256
+    writer_options = {
+        "compression": {"image.bytes": "NONE", "image.path": "ZSTD", "label": "ZSTD", "class": "ZSTD", "url": "ZSTD", "key": "ZSTD", "size": "ZSTD", "sha256": "ZSTD"},
+        "use_dictionary": ["label", "class"],
+        "write_statistics": ["label", "class", "key", "size"]
+    }
+
+    def __init__(self, output_path, sample_sources, row_group_size=128*1024*1024, spool_size=64*1024):
+        self.output_path = output_path
+        self.sample_sources = sample_sources  # Row key -> (url, label)
+        self.row_group_size = row_group_size
+        self.spool_size = spool_size
+        self.schema = pa.schema([
+            ("image", pa.struct([("bytes", pa.binary()), ("path", pa.string())])),
+            ("label", pa.string()),
+            ("class", pa.string()),
+            ("url", pa.string()),
+            ("key", pa.string()),
+            ("size", pa.int64()),
+            ("sha256", pa.string())
+        ])
+        self.writer = pq.ParquetWriter(output_path, self.schema, **self.writer_options)
+        self.lock = threading.Lock()  # Guards the row buffer
+        self.write_lock = threading.Lock()  # Row groups are written one at a time
+        self.rows = []
+        self.buffered = 0
+        self.members = 0
+        self.row_groups = 0
+
+    def _append(self, key, class_name, file_name, content, checksum):
+        url, label = self.sample_sources.get(key, (None, None))
+        raw_key = key.item() if isinstance(key, np.generic) else key
+        row = ({"bytes": content, "path": file_name}, None if label is None else str(label), class_name, url, None if raw_key is None else str(raw_key), len(content), checksum)
+        batch = None
+        with self.lock:
+            self.rows.append(row)
+            self.members += 1
+            self.buffered += len(content)
+            if self.buffered >= self.row_group_size:
+                batch, self.rows, self.buffered = self.rows, [], 0
+        if batch:
+            self._write_row_group(batch)
+        return len(content)
+
+    def _write_row_group(self, rows):
+        columns = list(zip(*rows))
+        table = pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, self.schema)], schema=self.schema)
+        with self.write_lock:
+            self.writer.write_table(table, row_group_size=len(rows))
+            self.row_groups += 1
+
+    def write(self, class_name, file_name, content, key=None, checksum=None):
+        return self._append(key, class_name, file_name, content, checksum)
+
+    def begin(self, class_name, file_name):
+        handle = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        handle.member = (class_name, file_name)
+        return handle
+
+    def commit(self, handle):
+        key, class_name, file_name = handle.entry
+        handle.seek(0)
+        try:
+            return self._append(key, class_name, file_name, handle.read(), getattr(handle, 'digest', None))
+        finally:
+            handle.close()
+
+    def abort(self, handle):
+        handle.close()
+
+    def add_manifest(self, manifest_path):
+        # The manifest stays next to the parquet file
+        pass
+
+    def close(self):
+        with self.lock:
+            batch, self.rows, self.buffered = self.rows, [], 0
+        if batch:
+            self._write_row_group(batch)
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def get_stats(self):
+        return {
+            "output": self.output_path,
+            "rows": self.members,
+            "row_groups": self.row_groups,
+            "row_group_size": self.row_group_size
+        }
+
+class WriterPool:
+    """
+    Runs all blocking writer calls (open/write/rename/tar append) on a thread pool so the
+    event loop never waits on disk. At most queue_size writes may be pending; once the
+    queue is full, downloads wait for a slot, which throttles network reads to disk speed.
+    With a manifest, each stored file is checksummed and recorded once it is complete;
+    with dedupe_content, a file whose checksum was already stored becomes a hardlink to it.
+    """
+    def __init__(self, sink, threads=8, queue_size=256, manifest=None, track_members=False, dedupe_content=False, validator=None, transformer=None):
+        self.sink = sink
+        self.validator = validator
+        self.transformer = transformer
+        self.manifest = manifest
+        self.dedupe_content = dedupe_content
+        self.hashing = manifest is not None or dedupe_content or getattr(sink, "stores_checksums", False)
+        self.stored = {} if track_members or dedupe_content else None  # member -> (size, checksum)
+        self.by_checksum = {}  # checksum -> first member stored with it
+        self.content_duplicates = 0
+        self.storage_bytes_saved = 0
+        self.threads = threads
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="writer")
+        self.slots = asyncio.Semaphore(queue_size)
+        self.pending = 0
+        self.max_pending = 0
+        self.completed = 0
+
+    async def _run(self, fn, *args):
+        async with self.slots:
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+            finally:
+                self.pending -= 1
+                self.completed += 1
+
+    def _record(self, key, class_name, file_name, size, checksum, duplicate_of=None):
+        member = f"{class_name}/{file_name}"
+        if self.stored is not None:
+            self.stored[member] = (size, checksum)
+            if checksum is not None and duplicate_of is None:
+                self.by_checksum.setdefault(checksum, member)
+        if self.manifest is not None and key is not None:
+            self.manifest.record(key, member, size, checksum, duplicate_of)
+
+    def _content_duplicate(self, class_name, file_name, checksum):
+        """
+        The member already holding this content, when it is stored under another name.
+        """
+        if not self.dedupe_content:
+            return None
+        target = self.by_checksum.get(checksum)
+        if target is None or target == f"{class_name}/{file_name}":
+            return None
+        return target
+
+    def _link(self, key, class_name, file_name, target):
+        size, checksum = self.stored[target]
+        if f"{class_name}/{file_name}" != target:
+            self.sink.link(class_name, file_name, target)
+        self._record(key, class_name, file_name, size, checksum, target)
+        return size
+
+    def _write(self, key, class_name, file_name, content):
+        checksum = hashlib.sha256(content).hexdigest() if self.hashing else None
+        target = self._content_duplicate(class_name, file_name, checksum)
+        if target is not None:
+            self.content_duplicates += 1
+            self.storage_bytes_saved += len(content)
+            self._link(key, class_name, file_name, target)
+            return len(content)
+        size = self.sink.write(class_name, file_name, content, key, checksum)
+        self._record(key, class_name, file_name, size, checksum)
+        return size
+
+    def _begin(self, key, class_name, file_name):
+        handle = self.sink.begin(class_name, file_name)
+        handle.entry = (key, class_name, file_name)
+        handle.checksum = hashlib.sha256() if self.hashing else None
+        return handle
+
+    def _write_chunk(self, handle, chunk):
+        handle.write(chunk)
+        if handle.checksum is not None:
+            handle.checksum.update(chunk)
+
+    def _commit(self, handle):
+        key, class_name, file_name = handle.entry
+        checksum = handle.checksum.hexdigest() if handle.checksum is not None else None
+        target = self._content_duplicate(class_name, file_name, checksum)
+        if target is not None:
+            size = handle.tell()
+            self.sink.abort(handle)
+            self.content_duplicates += 1
+            self.storage_bytes_saved += size
+            self._link(key, class_name, file_name, target)
+            return size
+        handle.digest = checksum
+        size = self.sink.commit(handle)
+        self._record(key, class_name, file_name, size, checksum)
+        return size
+
+    async def write(self, class_name, file_name, content, key=None):
+        return await self._run(self._write, key, class_name, file_name, content)
+
+    async def begin(self, class_name, file_name, key=None):
+        return await self._run(self._begin, key, class_name, file_name)
+
+    async def write_chunk(self, handle, chunk):
+        return await self._run(self._write_chunk, handle, chunk)
+
+    async def commit(self, handle):
+        return await self._run(self._commit, handle)
+
+    async def link(self, class_name, file_name, target, key=None):
+        return await self._run(self._link, key, class_name, file_name, target)
+
+    def _validation_source(self, handle):
+        # Bodies streamed to a named file are read by the validation worker itself
+        handle.flush()
+        if isinstance(getattr(handle, 'name', None), str):
+            return handle.name
+        position = handle.tell()
+        handle.seek(0)
+        content = handle.read()
+        handle.seek(position)
+        return content
+
+    async def validation_source(self, handle):
+        return await self._run(self._validation_source, handle)
+
+    def output_name(self, file_name):
+        """
+        Name a download is stored under; transformed images take their new format's extension.
+        """
+        if self.transformer is None:
+            return file_name
+        return self.transformer.output_name(file_name)
+
+    def abort(self, handle):
+        # Runs inline so it is safe to call while the download is being cancelled
+        try:
+            self.sink.abort(handle)
+        except Exception:
+            pass
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.manifest is not None:
+            self.manifest.close()
+            self.sink.add_manifest(self.manifest.path)
+        self.sink.close()
+
+    def get_stats(self):
+        return {
+            "writer_threads": self.threads,
+            "writer_queue_size": self.queue_size,
+            "max_pending_writes": self.max_pending,
+            "completed_writes": self.completed,
+            "content_duplicates": self.content_duplicates,
+            "storage_bytes_saved": self.storage_bytes_saved
+        }
+
+async def monitor_event_loop_lag(lag_stats, interval=0.5):
+    """
+    Measure how late the event loop wakes up from a fixed sleep. Sustained lag means
+    something is blocking the loop and stalling every open socket.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        scheduled = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - scheduled)
+        lag_stats['samples'] += 1
+        lag_stats['total'] += lag
+        lag_stats['max'] = max(lag_stats['max'], lag)
 
-def save_and_track(content, file_path, max_file_size, total_bytes):
-    """Helper function to write content to file and track size"""
+async def save_and_track(content, class_name, file_name, max_file_size, total_bytes, writer, key=None):
+    """Helper function to hand content to the output writer and track size"""
     try:
         # Check file size before saving
         if len(content) > max_file_size:
             return False, "File too large"
-            
-        # Ensure directory exists
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        
-        with open(file_path, 'wb') as f:
-            f.write(content)
-        file_size = os.path.getsize(file_path)  # Get actual stored size
-        total_bytes.append(file_size)  # Track real disk size
+
+        if writer.validator is not None:
+            with request_phase("validate"):
+                rejected = await writer.validator.check(content)
+            if rejected:
+                return False, rejected
+
+        if writer.transformer is not None:
+            with request_phase("transform"):
+                content, rejected = await writer.transformer.transform(content, len(content))
+            if rejected:
+                return False, rejected
+
+        with request_phase("store"):
+            file_size = await writer.write(class_name, file_name, content, key)
+        total_bytes.append(file_size)  # Track real stored size
+        return True, None
+    except Exception as e:
+        return False, str(e)
+
+async def store_response(response, class_name, file_name, max_file_size, total_bytes, writer, chunk_size=0, byte_bucket=None, key=None):
+    """
+    Store a 200 response body through the writer.
+    With chunk_size > 0 the body is streamed in bounded chunks and abandoned as soon as it
+    crosses max_file_size, so at most one chunk per request is held in memory.
+    A byte_bucket charges every byte received, capping download bandwidth.
+    """
+    # Reject on the advertised size before reading any of the body
+    if response.content_length is not None and response.content_length > max_file_size:
+        return False, "File too large"
+
+    if not chunk_size:
+        with request_phase("body"):
+            content = await response.read()
+        if byte_bucket:
+            with request_phase("rate_limit"):
+                await byte_bucket.acquire(len(content))
+        return await save_and_track(content, class_name, file_name, max_file_size, total_bytes, writer, key)
+
+    handle = None
+    try:
+        handle = await writer.begin(class_name, file_name, key)
+        received = 0
+        # Chunk writes and bandwidth waits have their own phases, body is the rest of the loop
+        timing = REQUEST_TIMING.get()
+        body_started = time.perf_counter()
+        charged = sum(timing.phases.get(phase, 0.0) for phase in ("store", "rate_limit")) if timing else 0.0
+        async for chunk in response.content.iter_chunked(chunk_size):
+            received += len(chunk)
+            if received > max_file_size:
+                writer.abort(handle)
+                return False, "File too large"
+            if byte_bucket:
+                with request_phase("rate_limit"):
+                    await byte_bucket.acquire(len(chunk))
+            with request_phase("store"):
+                await writer.write_chunk(handle, chunk)
+        if timing is not None:
+            charged = sum(timing.phases.get(phase, 0.0) for phase in ("store", "rate_limit")) - charged
+            timing.add("body", time.perf_counter() - body_started - charged)
+        if writer.validator is not None:
+            with request_phase("validate"):
+                rejected = await writer.validator.check(await writer.validation_source(handle))
+            if rejected:
+                writer.abort(handle)
+                return False, rejected
+        if writer.transformer is not None:
+            # The transformed image replaces the streamed original
+            with request_phase("transform"):
+                content, rejected = await writer.transformer.transform(await writer.validation_source(handle), received)
+            writer.abort(handle)
+            if rejected:
+                return False, rejected
+            with request_phase("store"):
+                file_size = await writer.write(class_name, file_name, content, key)
+            total_bytes.append(file_size)
+            return True, None
+        with request_phase("store"):
+            file_size = await writer.commit(handle)
+        total_bytes.append(file_size)  # Track real stored size
         return True, None
+    except (asyncio.CancelledError, asyncio.TimeoutError, aiohttp.ClientError):
+        # Let the caller classify network failures (timeouts are retried)
+        if handle is not None:
+            writer.abort(handle)
+        raise
     except Exception as e:
+        if handle is not None:
+            writer.abort(handle)
         return False, str(e)
 
 async def download_image_no_extensions(
@@ -299,36 +2424,73 @@ async def download_image_no_extensions(
         session, 
         timeout, 
         base_url, 
-        output_folder,
+        writer,
         max_file_size,
         total_bytes,
-        token_bucket=None
+        token_bucket=None,
+        chunk_size=0,
+        byte_bucket=None
     ):
     try:
         # Wait for token if rate limiting is enabled
         if token_bucket:
-            await token_bucket.acquire()
+            with request_phase("rate_limit"):
+                await token_bucket.acquire()
             
         async with session.get(image_url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
             if response.status == 200:
-                content = await response.read()
                 mime_type = response.headers.get('Content-Type')
                 ext = mimetypes.guess_extension(mime_type) or ".jpg"
-                file_name = f"{base_url.split('/')[-2]}{ext}"
-                file_path = os.path.join(output_folder, class_name, file_name)
-                success, error = save_and_track(content, file_path, max_file_size, total_bytes)
+                file_name = writer.output_name(f"{base_url.split('/')[-2]}{ext}")
+                success, error = await store_response(response, class_name, file_name, max_file_size, total_bytes, writer, chunk_size, byte_bucket, key)
                 
                 if success:
                     return key, file_name, class_name, None, response.status
                 else:
                     return key, None, class_name, error, response.status
             else:
+                note_retry_after(response)
                 return key, None, class_name, f"HTTP {response.status}", response.status
     except asyncio.TimeoutError:
         return key, None, class_name, "Timeout", 0
     except Exception as err:
         return key, None, class_name, str(err), 0
 
+async def race_extensions(session, base_url, candidates, timeout, token_bucket=None):
+    """
+    Probe all candidate extensions with concurrent HEAD requests and return the first
+    that answers 200, plus the candidates whose server refused HEAD (405/501).
+    """
+    # Probes overlap, so only the race as a whole is timed (the probe phase)
+    timing = REQUEST_TIMING.get()
+    if timing is not None:
+        timing.http_requests += len(candidates)
+
+    async def probe(ext):
+        REQUEST_TIMING.set(None)  # Each probe task has its own copy of the context
+        if token_bucket:
+            with request_phase("rate_limit"):
+                await token_bucket.acquire()
+        async with session.head(f"{base_url}{ext}", timeout=aiohttp.ClientTimeout(total=timeout), allow_redirects=True) as response:
+            return ext, response.status
+
+    tasks = [asyncio.create_task(probe(ext)) for ext in candidates]
+    no_head = []
+    try:
+        for future in asyncio.as_completed(tasks):
+            try:
+                ext, status = await future
+            except Exception:
+                continue
+            if status == 200:
+                return ext, []
+            if status in [405, 501]:
+                no_head.append(ext)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return None, no_head
+
 async def download_image_with_extensions(
         key,
         image_url,
@@ -338,94 +2500,135 @@ async def download_image_with_extensions(
         session,
         timeout,
         base_url,
-        output_folder,
+        writer,
         max_file_size,
         total_bytes,
-        token_bucket=None
+        token_bucket=None,
+        chunk_size=0,
+        byte_bucket=None,
+        extension_cache=None
     ):
-    file_name = f"{base_url.split('/')[-2]}{original_ext}"
-    file_path = os.path.join(output_folder, class_name, file_name)
-    try:
+    async def get_and_store(url, ext):
+        file_name = writer.output_name(f"{base_url.split('/')[-2]}{ext}")
         # Wait for token if rate limiting is enabled
         if token_bucket:
-            await token_bucket.acquire()
+            with request_phase("rate_limit"):
+                await token_bucket.acquire()
             
-        async with session.get(image_url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
             if response.status == 200:
-                content = await response.read()
-                success, error = save_and_track(content, file_path, max_file_size, total_bytes)
+                success, error = await store_response(response, class_name, file_name, max_file_size, total_bytes, writer, chunk_size, byte_bucket, key)
                 if success:
+                    if extension_cache:
+                        extension_cache.learn(image_url, ext)
                     return key, file_name, class_name, None, response.status
                 else:
                     return key, None, class_name, error, response.status
             else:
+                note_retry_after(response)
                 return key, None, class_name, f"HTTP {response.status}", response.status
+
+    # Start with the extension that resolved for similar URLs, if this pattern's originals tend to go stale
+    learned_ext = extension_cache.lookup(image_url) if extension_cache else None
+    tried_learned = bool(learned_ext) and learned_ext != original_ext and extension_cache.goes_stale(image_url)
+    if tried_learned:
+        try:
+            result = await get_and_store(f"{base_url}{learned_ext}", learned_ext)
+            if result[3] is None:
+                extension_cache.hits += 1
+                return result
+            extension_cache.misses += 1
+            if result[4] == 429:
+                return result  # Throttled, don't spend more requests on this host now
+        except asyncio.TimeoutError:
+            return key, None, class_name, "Timeout", 0
+        except Exception:
+            extension_cache.misses += 1
+
+    result = None
+    try:
+        result = await get_and_store(image_url, original_ext)
+        if result[3] is None and extension_cache:
+            extension_cache.record_original(image_url, True)
+        # Only a missing file suggests a stale extension worth probing
+        if result[3] is None or result[4] not in STALE_EXTENSION_STATUSES:
+            return result
     except asyncio.TimeoutError:
         return key, None, class_name, "Timeout", 0
-    except Exception as err:
+    except Exception:
         pass
     
-    # Try fallback extensions only if original failed due to connection issues
-    for ext in fallback_extensions:
-        if ext == original_ext or shutdown_flag:
-            continue
-        new_url = f"{base_url}{ext}"
-        file_name = f"{base_url.split('/')[-2]}{ext}"
-        file_path = os.path.join(output_folder, class_name, file_name)
-        
+    candidates = [ext for ext in fallback_extensions if ext != original_ext and not (tried_learned and ext == learned_ext)]
+    if shutdown_flag or not candidates or (extension_cache and not extension_cache.should_probe(image_url)):
+        return result or (key, None, class_name, "All download attempts failed", 0)
+
+    # Race cheap HEAD probes for the remaining extensions instead of GETting them one by one
+    if extension_cache:
+        extension_cache.probes += 1
+    with request_phase("probe"):
+        resolved_ext, no_head = await race_extensions(session, base_url, candidates, timeout, token_bucket)
+    if resolved_ext:
+        if extension_cache:
+            extension_cache.probe_wins += 1
         try:
-            # Wait for token if rate limiting is enabled
-            if token_bucket:
-                await token_bucket.acquire()
-                
-            async with session.get(new_url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
-                if response.status == 200:
-                    content = await response.read()
-                    success, error = save_and_track(content, file_path, max_file_size, total_bytes)
-                    if success:
-                        return key, file_name, class_name, None, response.status
-                    else:
-                        return key, None, class_name, error, response.status
-                else:
-                    return key, None, class_name, f"HTTP {response.status}", response.status
+            fallback_result = await get_and_store(f"{base_url}{resolved_ext}", resolved_ext)
+            if fallback_result[3] is None and extension_cache:
+                extension_cache.record_original(image_url, False)
+            return fallback_result
         except asyncio.TimeoutError:
-            continue
+            return key, None, class_name, "Timeout", 0
+        except Exception as err:
+            return key, None, class_name, str(err), 0
+
+    # Servers that refuse HEAD still get the old one-by-one GET
+    for ext in no_head:
+        if shutdown_flag:
+            break
+        try:
+            fallback_result = await get_and_store(f"{base_url}{ext}", ext)
+            if fallback_result[3] is None:
+                if extension_cache:
+                    extension_cache.record_original(image_url, False)
+                return fallback_result
         except Exception:
             continue  # Try the next extension
 
-    return key, None, class_name, "All download attempts failed", 0
+    if extension_cache:
+        extension_cache.probe_failed(image_url)
+    return result or (key, None, class_name, "All download attempts failed", 0)
 
 async def download_image(
         session, 
-        semaphore, 
-        row, 
-        output_folder, 
-        url_col, 
-        class_col, 
+        key, 
+        image_url, 
+        label, 
+        writer, 
         total_bytes, 
         timeout, 
         max_file_size,
-        token_bucket=None
+        token_bucket=None,
+        chunk_size=0,
+        host_scheduler=None,
+        byte_bucket=None,
+        extension_cache=None
     ):
     """Download an image asynchronously with retries for different file extensions, tracking actual stored size."""
     
     global shutdown_flag
     if shutdown_flag:
-        return row.name, None, None, "Shutdown requested"
+        return key, None, None, "Shutdown requested", 0
     
     fallback_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.pdf']
 
-    async with semaphore:
-        key, image_url = row.name, row[url_col]
-        
-        # Validate URL
-        if pd.isna(image_url) or not str(image_url).strip():
-            return key, None, None, "Empty or invalid URL"
-        
-        # Clean class name
-        class_name = str(row[class_col]).replace("'", "").replace(" ", "_").replace("/", "_")
-        base_url, original_ext = os.path.splitext(str(image_url))
-        
+    # Validate URL
+    if pd.isna(image_url) or not str(image_url).strip():
+        return key, None, None, "Empty or invalid URL", 0
+    
+    # Clean class name
+    class_name = clean_class_name(label)
+    base_url, original_ext = os.path.splitext(str(image_url))
+
+    async def fetch():
         # If no extension, determine it dynamically
         if not original_ext:
             return await download_image_no_extensions(
@@ -435,10 +2638,12 @@ async def download_image(
                 session,
                 timeout,
                 base_url,
-                output_folder,
+                writer,
                 max_file_size,
                 total_bytes,
-                token_bucket
+                token_bucket,
+                chunk_size,
+                byte_bucket
             )
 
         else:
@@ -452,23 +2657,40 @@ async def download_image(
                 session,
                 timeout,
                 base_url,
-                output_folder,
+                writer,
                 max_file_size,
                 total_bytes,
-                token_bucket
+                token_bucket,
+                chunk_size,
+                byte_bucket,
+                extension_cache
             )
 
+    if host_scheduler is None:
+        return await fetch()
+
+    # Park URLs whose host circuit is open; the retry scheduler brings them back once it closes
+    try:
+        async with host_scheduler.slot(image_url):
+            result = await fetch()
+    except HostParked:
+        return key, None, class_name, HOST_PARKED_ERROR, 0
+    host_scheduler.record(image_url, result[4], result[3])
+    return result
+
 def validate_and_clean(
         input, 
         output_folder, 
         url_col, 
-        class_col
+        class_col,
+        keep_output=False
         ):
     if not os.path.exists(input):
         print(f"Error: Input file {input} not found")
         sys.exit(1)
     
-    if os.path.exists(output_folder):
+    # A resumed run keeps the staging folder from the earlier attempt
+    if os.path.exists(output_folder) and not keep_output:
         shutil.rmtree(output_folder)
     
     try:
@@ -506,6 +2728,84 @@ def validate_and_clean(
     
     return df, filtered_count
 
+def read_archive_members(archive_path, wanted):
+    """
+    Yield (name, data) for the intact files of a possibly truncated tar, with names
+    relative to its root folder. Only members for which wanted(name, size) holds are read.
+    """
+    try:
+        with tarfile.open(archive_path, "r|*") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name = member.name.split("/", 1)[-1]
+                if not wanted(name, member.size):
+                    continue
+                data = tar.extractfile(member).read()
+                if len(data) != member.size:
+                    break
+                yield name, data
+    except Exception as e:
+        # A torn archive fails in codec-specific ways; everything yielded so far is intact
+        print(f"Previous archive {archive_path} ends early ({e}), keeping the files read so far")
+
+def restore_previous_output(
+        output_mode,
+        output_folder,
+        previous_archive,
+        manifest,
+        sink
+    ):
+    """
+    Recover what an earlier attempt of this task already stored, so only the rest is downloaded.
+    Folder mode reuses the staging folder, or unpacks the previous tar when that is all that
+    travelled with the task. tar_stream mode copies the previous tar's recorded members into
+    the new one. The manifest is kept (or carried inside the tar) and trimmed to what survived.
+    """
+    manifest.load_file()
+
+    if output_mode == "tar_stream":
+        if previous_archive:
+            if not manifest.entries:
+                # No sidecar on this worker: use the manifest that was closed into the tar
+                for name, data in read_archive_members(previous_archive, lambda name, size: name == MANIFEST_NAME):
+                    manifest.load(data.decode().splitlines())
+            recorded_sizes = {entry['file']: entry['bytes'] for entry in manifest.entries.values()}
+            copied = set()
+            for name, data in read_archive_members(previous_archive, lambda name, size: recorded_sizes.get(name) == size):
+                class_name, file_name = name.split("/", 1)
+                sink.write(class_name, file_name, data)
+                copied.add(name)
+            # Hardlink members carry no data; recreate them once their target is back
+            for entry in manifest.entries.values():
+                if entry.get('duplicate_of') in copied and entry['file'] not in copied:
+                    class_name, file_name = entry['file'].split("/", 1)
+                    sink.link(class_name, file_name, entry['duplicate_of'])
+                    copied.add(entry['file'])
+            os.remove(previous_archive)
+        else:
+            copied = set()
+        manifest.retain(lambda entry: entry['file'] in copied)
+    else:
+        if previous_archive:
+            if not os.path.exists(output_folder):
+                for name, data in read_archive_members(previous_archive, lambda name, size: True):
+                    file_path = os.path.join(output_folder, name)
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    with open(file_path, 'wb') as f:
+                        f.write(data)
+                manifest.load_file()
+            os.remove(previous_archive)
+
+        def is_stored(entry):
+            try:
+                return os.path.getsize(os.path.join(output_folder, entry['file'])) == entry['bytes']
+            except OSError:
+                return False
+        manifest.retain(is_stored)
+
+    return manifest.completed_keys()
+
 def create_json_overview(
         input, 
         output_path, 
@@ -522,7 +2822,9 @@ def create_json_overview(
         total_downloaded,
         filtered_count,
         token_bucket=None,
-        enable_rate_limiting=False
+        enable_rate_limiting=False,
+        performance=None,
+        resumed_rows=None
     ):
 
     overview_data = {
@@ -553,6 +2855,13 @@ def create_json_overview(
         }
     }
 
+    # Rows an earlier attempt already stored are neither downloaded nor failed in this one
+    if resumed_rows is not None:
+        overview_data["download_summary"]["skipped_already_completed"] = resumed_rows
+
+    if performance:
+        overview_data["performance"] = performance
+
     if total_errors > 0:
         error_counts = {}
         for error_info in error_details:
@@ -578,11 +2887,12 @@ def create_tar_archive(
         output_folder,
         successful_downloads,
         total_errors,
+        archive_compression="none"
     ):
     if successful_downloads > 0 and not shutdown_flag and os.path.exists(output_folder):
         try:
             print(f"\nCreating tar archive: {output_path}")
-            with tarfile.open(output_path, "w") as tar:
+            with tarfile.open(output_path, ARCHIVE_COMPRESSION[archive_compression]) as tar:
                 tar.add(output_folder, arcname=os.path.basename(output_folder))
                 
             full_path = Path(output_path).resolve()
@@ -604,10 +2914,427 @@ def create_tar_archive(
     
     return None
 
-async def main():
+def finalize_stream_archive(
+        output_path,
+        writer,
+        successful_downloads,
+        total_errors
+    ):
+    """
+    Close the streamed tar, keeping the same keep/discard rules as create_tar_archive.
+    """
+    try:
+        writer.close()
+    except Exception as e:
+        print(f"Error finalizing tar archive: {e}")
+        sys.exit(1)
+
+    if successful_downloads > 0 and not shutdown_flag:
+        full_path = Path(output_path).resolve()
+        tar_size = os.path.getsize(output_path)
+        print(f"Created tar archive: {full_path} ({tar_size / 1e6:.2f} MB, {writer.sink.members} files streamed)")
+    elif successful_downloads > 0:
+        # The closed tar carries its manifest, so a rerun with --resume picks up from here
+        print(f"Shutdown was requested, keeping partial tar archive for --resume ({writer.sink.members} files)")
+        sys.exit(1)
+    else:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        if shutdown_flag:
+            print("Shutdown was requested, discarding partial tar archive")
+        elif successful_downloads == 0:
+            print("No successful downloads, discarding empty tar archive")
+        sys.exit(1 if total_errors > 0 else 0)
+
+    return None
+
+def finalize_webdataset(
+        writer,
+        successful_downloads,
+        total_errors
+    ):
+    """
+    Report the closed shards, keeping the same keep/discard rules as create_tar_archive.
+    Shards are already closed (and possibly uploaded) by the time this runs, so a shutdown keeps them.
+    """
+    shards = writer.sink.shards
+    if successful_downloads > 0 and not shutdown_flag:
+        total_size = sum(shard["bytes"] for shard in shards)
+        print(f"Created {len(shards)} shards ({total_size / 1e6:.2f} MB, {writer.sink.members} samples): {shards[0]['path']} .. {shards[-1]['path']}")
+    elif successful_downloads > 0:
+        print(f"Shutdown was requested, keeping {len(shards)} closed shards ({writer.sink.members} samples)")
+        sys.exit(1)
+    else:
+        for shard in shards:
+            if os.path.exists(shard["path"]):
+                os.remove(shard["path"])
+        if shutdown_flag:
+            print("Shutdown was requested, no samples were written")
+        elif successful_downloads == 0:
+            print("No successful downloads, no shards written")
+        sys.exit(1 if total_errors > 0 else 0)
+
+    return None
+
+def finalize_parquet_output(
+        output_path,
+        writer,
+        successful_downloads,
+        total_errors
+    ):
+    """
+    Report the parquet output, keeping the same keep/discard rules as create_tar_archive.
+    """
+    if successful_downloads > 0 and not shutdown_flag:
+        stats = writer.sink.get_stats()
+        print(f"Created parquet file: {Path(output_path).resolve()} ({os.path.getsize(output_path) / 1e6:.2f} MB, {stats['rows']} rows in {stats['row_groups']} row groups)")
+    elif successful_downloads > 0:
+        print(f"Shutdown was requested, keeping partial parquet file ({writer.sink.members} rows)")
+        sys.exit(1)
+    else:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        if shutdown_flag:
+            print("Shutdown was requested, no rows were written")
+        elif successful_downloads == 0:
+            print("No successful downloads, discarding empty parquet file")
+        sys.exit(1 if total_errors > 0 else 0)
+
+    return None
+
+def shard_by_host(urls, processes):
+    """
+    Assign every row to a shard by a stable hash of its URL's host, so all requests to
+    one host come from one process and per-host limits stay coherent.
+    """
+    hosts = pd.Series(urls).map(lambda url: urlsplit(str(url).strip()).netloc.lower())
+    codes, unique_hosts = pd.factorize(hosts)
+    host_shards = np.array([zlib.crc32(host.encode()) % processes for host in unique_hosts], dtype=np.int64)
+    return host_shards[codes], len(unique_hosts)
+
+def run_shard(shard_args):
+    """Process entry point for one shard: an ordinary single-process run on its own event loop"""
+    run_event_loop(main(shard_args), shard_args.event_loop)
+
+def merge_shard_archives(output_path, output_folder, shard_outputs, archive_compression="none"):
+    """
+    Copy the members of every shard tar into the final archive under a single root folder,
+    and combine the shard manifests into one. Returns the number of files merged.
+    """
+    root = os.path.basename(output_folder)
+    manifest_lines = []
+    known_dirs = set()
+    files = 0
+    with tarfile.open(output_path, ARCHIVE_COMPRESSION[archive_compression]) as merged:
+        for shard_output in shard_outputs:
+            if not os.path.exists(shard_output):
+                continue
+            shard_root = os.path.splitext(os.path.basename(shard_output))[0]
+            with tarfile.open(shard_output, "r|*") as shard:
+                for member in shard:
+                    relative = member.name.split("/", 1)[1] if "/" in member.name else ""
+                    if relative == MANIFEST_NAME:
+                        manifest_lines.extend(shard.extractfile(member).read().decode().splitlines())
+                        continue
+                    member.name = f"{root}/{relative}" if relative else root
+                    if member.isdir():
+                        if member.name not in known_dirs:
+                            known_dirs.add(member.name)
+                            merged.addfile(member)
+                        continue
+                    if member.islnk():
+                        member.linkname = root + member.linkname[len(shard_root):]
+                        merged.addfile(member)
+                    else:
+                        merged.addfile(member, shard.extractfile(member))
+                    files += 1
+
+        if manifest_lines:
+            content = ("\n".join(manifest_lines) + "\n").encode()
+            info = tarfile.TarInfo(f"{root}/{MANIFEST_NAME}")
+            info.size = len(content)
+            info.mode = 0o644
+            info.mtime = time.time()
+            merged.addfile(info, io.BytesIO(content))
+    return files
+
+def merge_shard_samples(output_mode, output_path, shard_outputs):
+    """
+    Combine the webdataset or parquet output of every shard into the layout a single process
+    would have written: WebDataset shards are renamed into one numbered sequence and parquet
+    files are copied row group by row group into one file. The shard manifests are combined
+    next to the output. Returns the final output files.
+    """
+    stem = output_stem(output_path)
+    manifest_lines = []
+    output_files = []
+    if output_mode == "webdataset":
+        pattern = stem + "-{:06d}" + (output_path[len(stem):] or ".tar")
+        for shard_output in shard_outputs:
+            shard_stem = output_stem(shard_output)
+            shard_pattern = shard_stem + "-{:06d}" + shard_output[len(shard_stem):]
+            index = 0
+            while os.path.exists(shard_pattern.format(index)):
+                os.replace(shard_pattern.format(index), pattern.format(len(output_files)))
+                output_files.append(pattern.format(len(output_files)))
+                index += 1
+        manifest_path = os.path.splitext(output_path)[0] + "_manifest.jsonl"
+    else:
+        output_files.append(stem + ".parquet")
+        writer = None
+        try:
+            for shard_output in shard_outputs:
+                shard_path = output_stem(shard_output) + ".parquet"
+                if not os.path.exists(shard_path):
+                    continue
+                shard_file = pq.ParquetFile(shard_path)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_files[0], shard_file.schema_arrow, **ParquetSampleWriter.writer_options)
+                for row_group in range(shard_file.num_row_groups):
+                    table = shard_file.read_row_group(row_group)
+                    writer.write_table(table, row_group_size=table.num_rows)
+                shard_file.close()
+                os.remove(shard_path)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            output_files = []
+        manifest_path = stem + "_manifest.jsonl"
+
+    for shard_output in shard_outputs:
+        shard_manifest = os.path.splitext(shard_output)[0] + "_manifest.jsonl"
+        if os.path.exists(shard_manifest):
+            with open(shard_manifest) as f:
+                manifest_lines.extend(f.read().splitlines())
+            os.remove(shard_manifest)
+    if manifest_lines:
+        with open(manifest_path, "w") as f:
+            f.write("\n".join(manifest_lines) + "\n")
+    return output_files
+
+def merge_shard_overviews(args, output_path, shard_outputs, filtered_count, total_time, processes, host_count, output_files=None):
+    """
+    Sum the shard overview files into one overview for the whole input.
+    Returns the merged successful and failed download counts.
+    """
+    successful_downloads = 0
+    total_errors = 0
+    resumed_rows = None
+    total_mb = 0.0
+    error_counts = {}
+    shard_performance = []
+    for shard_output in shard_outputs:
+        overview_path = os.path.splitext(shard_output)[0] + "_overview.json"
+        try:
+            with open(overview_path, 'r') as f:
+                shard_overview = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            print(f"Warning: No overview from shard {shard_output}")
+            continue
+        summary = shard_overview["download_summary"]
+        successful_downloads += summary["successful_downloads"]
+        total_errors += summary["failed_downloads"]
+        total_mb += summary["total_data_mb"]
+        if "skipped_already_completed" in summary:
+            resumed_rows = (resumed_rows or 0) + summary["skipped_already_completed"]
+        for error_type, count in shard_overview.get("error_breakdown", {}).items():
+            error_counts[error_type] = error_counts.get(error_type, 0) + count
+        shard_performance.append({
+            "shard": os.path.basename(shard_output),
+            "records": summary["total_records_processed"],
+            "successful_downloads": summary["successful_downloads"],
+            "total_time_seconds": summary["total_time_seconds"],
+            "performance": shard_overview.get("performance", {})
+        })
+
+    overview_data = {
+        "script_inputs": {
+            "input_file": args.input,
+            "output_file": output_path,
+            "url_column": args.url,
+            "label_column": args.label,
+            "concurrent_downloads": args.concurrent_downloads,
+            "timeout": args.timeout,
+            "max_file_size": args.max_file_size,
+            "rate_limiting_enabled": args.enable_rate_limiting,
+            "processes": processes
+        },
+        "download_summary": {
+            "total_records_processed": filtered_count,
+            "successful_downloads": successful_downloads,
+            "failed_downloads": total_errors,
+            "success_rate_percent": round((successful_downloads/(successful_downloads+total_errors)*100), 2) if (successful_downloads + total_errors) > 0 else 0,
+            "total_data_mb": round(total_mb, 2),
+            "total_time_seconds": round(total_time, 2),
+            "average_speed_mbps": round(total_mb / total_time, 2) if total_time > 0 else 0
+        },
+        "error_breakdown": error_counts,
+        "execution_info": {
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+            "shutdown_requested": shutdown_flag
+        },
+        "performance": {
+            "hosts_seen": host_count,
+            "shards": shard_performance
+        }
+    }
+    if resumed_rows is not None:
+        overview_data["download_summary"]["skipped_already_completed"] = resumed_rows
+    if output_files is not None:
+        overview_data["performance"][args.output_mode] = {"files": output_files}
+
+    json_filename = os.path.splitext(output_path)[0] + "_overview.json"
+    try:
+        with open(json_filename, 'w') as json_file:
+            json.dump(overview_data, json_file, indent=2)
+        print(f"Created overview file: {json_filename}")
+    except Exception as e:
+        print(f"Warning: Could not create overview JSON file: {e}")
+
+    return successful_downloads, total_errors
+
+def run_sharded(args):
+    """
+    Split the input by host across args.processes worker processes, each with its own
+    event loop and connector, then merge their archives and overviews into one output.
+    Global limits (concurrency, request and byte rates) are divided between the shards
+    that actually received rows; no process is started for an empty shard.
+    """
+    if args.output_mode == "webdataset" and args.shard_close_command:
+        # Each process would run the command on its own shard names before they are renumbered
+        print("Error: --shard_close_command cannot be combined with --processes > 1.")
+        sys.exit(1)
+
+    processes = args.processes
+    output_path = args.output
+    output_folder = os.path.splitext(os.path.basename(output_path))[0]
+    output_dir = os.path.dirname(output_path)
+    start_time = time.monotonic()
+
+    df, filtered_count = validate_and_clean(args.input, output_folder, args.url, args.label, keep_output=True)
+    shard_ids, host_count = shard_by_host(df[args.url].to_numpy(), processes)
+    shards = np.unique(shard_ids).tolist()
+    print(f"Sharding {filtered_count} rows from {host_count} hosts across {len(shards)} processes")
+
+    shard_dir = tempfile.mkdtemp(prefix=f"{output_folder}_shards_", dir=output_dir or ".")
+    shard_outputs = []
+    workers = []
+    context = multiprocessing.get_context("spawn")
+    for shard in shards:
+        shard_df = df[shard_ids == shard]
+        shard_output = os.path.join(output_dir, f"{output_folder}_shard{shard}.tar")
+        shard_outputs.append(shard_output)
+        shard_input = os.path.join(shard_dir, f"shard{shard}.parquet")
+        shard_df.to_parquet(shard_input)
+
+        # Shards stream into uncompressed tars; compression happens once, in the merge.
+        # WebDataset shards and parquet files are independent files already, so those are written directly.
+        shard_args = argparse.Namespace(**vars(args))
+        shard_args.input = shard_input
+        shard_args.output = shard_output
+        if args.output_mode not in ["webdataset", "parquet"]:
+            shard_args.output_mode = "tar_stream"
+            shard_args.archive_compression = "none"
+        shard_args.processes = 1
+        shard_args.concurrent_downloads = max(1, args.concurrent_downloads // len(shards))
+        shard_args.rate_limit = args.rate_limit / len(shards)
+        shard_args.rate_capacity = max(1, args.rate_capacity // len(shards))
+        shard_args.byte_rate_limit = args.byte_rate_limit / len(shards)
+        if args.extension_cache:
+            # Patterns are per host, so shards learn disjoint sets that are merged afterwards
+            shard_args.extension_cache = f"{args.extension_cache}.shard{shard}"
+            if os.path.exists(args.extension_cache):
+                shutil.copyfile(args.extension_cache, shard_args.extension_cache)
+        for log_arg in ["metrics_log", "event_log"]:
+            if getattr(args, log_arg):
+                log_base, log_ext = os.path.splitext(getattr(args, log_arg))
+                setattr(shard_args, log_arg, f"{log_base}_shard{shard}{log_ext}")
+        print(f"  - Shard {shard}: {len(shard_df)} rows -> {shard_output}")
+        process = context.Process(target=run_shard, args=(shard_args,), name=f"shard{shard}")
+        process.start()
+        workers.append(process)
+
+    # Pass a shutdown request on to the shards so each one stops gracefully and keeps its output
+    forwarded = False
+    while any(process.is_alive() for process in workers):
+        if shutdown_flag and not forwarded:
+            for process in workers:
+                if process.is_alive():
+                    process.terminate()
+            forwarded = True
+        for process in workers:
+            process.join(timeout=0.5)
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    failed_shards = [process.name for process in workers if process.exitcode not in (0, None)]
+    if failed_shards:
+        print(f"Shards that exited with errors: {failed_shards}")
+
+    if args.extension_cache:
+        extension_cache = ExtensionCache(args.extension_cache)
+        for shard in shards:
+            shard_cache_path = f"{args.extension_cache}.shard{shard}"
+            if os.path.exists(shard_cache_path):
+                shard_cache = ExtensionCache(shard_cache_path)
+                extension_cache.patterns.update(shard_cache.patterns)
+                extension_cache.failed_probes.update(shard_cache.failed_probes)
+                extension_cache.originals.update(shard_cache.originals)
+                os.remove(shard_cache_path)
+        extension_cache.save()
+
+    # Shard outputs are kept on shutdown so a rerun with --resume can pick each shard up again
+    output_files = None
+    if args.output_mode in ["webdataset", "parquet"] and not shutdown_flag:
+        try:
+            output_files = merge_shard_samples(args.output_mode, output_path, shard_outputs)
+        except Exception as e:
+            print(f"Error merging shard outputs: {e}")
+            sys.exit(1)
+
+    total_time = time.monotonic() - start_time
+    successful_downloads, total_errors = merge_shard_overviews(
+        args, output_path, shard_outputs, filtered_count, total_time, len(shards), host_count, output_files
+    )
+
+    if args.output_mode in ["webdataset", "parquet"]:
+        if output_files is not None:
+            for shard_output in shard_outputs:
+                overview_path = os.path.splitext(shard_output)[0] + "_overview.json"
+                if os.path.exists(overview_path):
+                    os.remove(overview_path)
+            print(f"Merged {len(workers)} shard outputs into {len(output_files)} {args.output_mode} file(s): {', '.join(output_files)}")
+        else:
+            print("Shutdown was requested, keeping shard outputs for --resume")
+        sys.exit(1 if shutdown_flag or (successful_downloads == 0 and total_errors > 0) else 0)
+
+    if successful_downloads > 0 and not shutdown_flag:
+        try:
+            print(f"\nMerging {len(workers)} shard archives into {output_path}")
+            files = merge_shard_archives(output_path, output_folder, shard_outputs, args.archive_compression)
+        except Exception as e:
+            print(f"Error merging shard archives: {e}")
+            sys.exit(1)
+        for shard_output in shard_outputs:
+            for path in [shard_output, os.path.splitext(shard_output)[0] + "_overview.json", os.path.splitext(shard_output)[0] + "_manifest.jsonl"]:
+                if os.path.exists(path):
+                    os.remove(path)
+        tar_size = os.path.getsize(output_path)
+        print(f"Created tar archive: {Path(output_path).resolve()} ({tar_size / 1e6:.2f} MB, {files} files from {len(workers)} shards)")
+        print(f"  - Successful downloads: {successful_downloads}")
+        print(f"  - Failed downloads: {total_errors}")
+        print(f"  - Time Taken: {total_time:.2f} sec")
+    else:
+        if shutdown_flag:
+            print("Shutdown was requested, keeping shard archives for --resume")
+        elif successful_downloads == 0:
+            print("No successful downloads, skipping tar creation")
+        sys.exit(1 if total_errors > 0 or shutdown_flag else 0)
+
+async def main(args=None):
     global shutdown_flag
     
-    args = parse_args()
+    if args is None:
+        args = parse_args()
     
     # Display configuration source
     if hasattr(args, 'config') and args.config:
@@ -627,10 +3354,100 @@ async def main():
     enable_rate_limiting = args.enable_rate_limiting
     max_retry_attempts = args.max_retry_attempts
     retry_delay = args.retry_delay
+    try:
+        retry_budgets = parse_retry_budgets(args.retry_budget, max_retry_attempts)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    output_mode = args.output_mode
+    archive_compression = args.archive_compression
+    chunk_size = args.stream_chunk_size
     output_folder = os.path.splitext(os.path.basename(output_path))[0]
 
     # Validate inputs
-    df, filtered_count = validate_and_clean(input, output_folder, url_col, class_col)
+    df, filtered_count = validate_and_clean(input, output_folder, url_col, class_col, keep_output=args.resume)
+
+    # The previous attempt's tar is set aside before a new one is opened at the same path
+    previous_archive = None
+    if args.resume and os.path.exists(output_path):
+        previous_archive = output_path + ".previous"
+        os.replace(output_path, previous_archive)
+
+    # Streamed archives skip the staging folder entirely
+    if output_mode == "parquet":
+        output_path = output_stem(output_path) + ".parquet"
+        sample_sources = dict(zip(df.index, zip(df[url_col], df[class_col])))
+        sink = ParquetSampleWriter(output_path, sample_sources, row_group_size=args.parquet_row_group_mb * 1024 * 1024, spool_size=chunk_size or 64*1024)
+        manifest_path = output_stem(output_path) + "_manifest.jsonl"
+        print(f"Writing image rows into {output_path} ({args.parquet_row_group_mb} MB row groups)")
+    elif output_mode == "webdataset":
+        sample_sources = dict(zip(df.index, zip(df[url_col], df[class_col])))
+        sink = WebDatasetWriter(
+            output_path,
+            sample_sources,
+            max_size=args.shard_max_size,
+            max_samples=args.shard_max_samples,
+            compression=archive_compression,
+            close_command=args.shard_close_command,
+            spool_size=chunk_size or 64*1024
+        )
+        manifest_path = os.path.splitext(output_path)[0] + "_manifest.jsonl"
+        print(f"Writing WebDataset shards {sink.pattern.format(0)}, ... (up to {args.shard_max_size / 1e6:.0f} MB each)")
+    elif output_mode == "tar_stream":
+        sink = TarStreamWriter(output_path, output_folder, archive_compression, spool_size=chunk_size or 64*1024)
+        manifest_path = os.path.splitext(output_path)[0] + "_manifest.jsonl"
+        print(f"Streaming downloads into {output_path} (compression: {archive_compression})")
+    else:
+        sink = FolderWriter(output_folder)
+        manifest_path = os.path.join(output_folder, MANIFEST_NAME)
+
+    # Checksumming every body and adding the manifest to the output is only worth it when resuming
+    manifest = None
+    if args.resume or args.manifest:
+        manifest = CompletionManifest(manifest_path, sync_every=args.manifest_sync_every)
+
+    # Each sample/row needs its own copy of the image, so there is nothing to link to
+    if output_mode in ["webdataset", "parquet"] and (args.dedupe_urls or args.dedupe_content):
+        print(f"Deduplication is not available with {output_mode} output, every row is fetched and stored")
+        args.dedupe_urls = args.dedupe_content = False
+
+    # Skip rows an earlier attempt of this task already stored
+    if args.resume and output_mode in ["webdataset", "parquet"]:
+        print(f"--resume is not supported with {output_mode} output, downloading every row")
+    elif args.resume:
+        completed_keys = restore_previous_output(output_mode, output_folder, previous_archive, manifest, sink)
+        if completed_keys:
+            df = df[~df.index.astype(str).isin(completed_keys)]
+            print(f"Resuming: {manifest.previously_completed} rows already completed, {len(df)} remaining")
+    if manifest is not None:
+        manifest.open()
+
+    validator = None
+    if args.validate_images:
+        validator = ImageValidator(args.validation_level, args.min_image_width, args.min_image_height, args.validation_workers)
+        print(f"Validating images ({validator.level}) with {args.validation_workers} worker processes")
+
+    transformer = None
+    if args.transform_images:
+        transformer = ImageTransformer(
+            args.resize_max_side,
+            args.resize_shortest_side,
+            args.transcode_format,
+            args.transcode_quality,
+            args.strip_exif,
+            args.transform_workers
+        )
+        print(f"Transforming images to {args.transcode_format} (quality {args.transcode_quality}) with {transformer.workers} worker processes")
+    writer = WriterPool(
+        sink,
+        threads=args.writer_threads,
+        queue_size=args.writer_queue_size,
+        manifest=manifest,
+        track_members=args.dedupe_urls,
+        dedupe_content=args.dedupe_content,
+        validator=validator,
+        transformer=transformer
+    )
     
     # Initialize token bucket if rate limiting is enabled
     token_bucket = None
@@ -640,13 +3457,50 @@ async def main():
     else:
         print(f"Processing {filtered_count} images with {concurrent_downloads} concurrent downloads (no rate limiting)")
 
+    # Bandwidth cap: one token per byte, with a second's worth of burst
+    byte_bucket = None
+    if args.byte_rate_limit > 0:
+        byte_bucket = TokenBucket(rate=args.byte_rate_limit, capacity=args.byte_rate_limit)
+        print(f"Capping download bandwidth at {args.byte_rate_limit / 1e6:.2f} MB/s")
+
+    host_scheduler = None
+    if args.per_host_scheduling:
+        host_scheduler = HostScheduler(
+            rate=args.host_rate_limit,
+            capacity=max(1, int(args.host_rate_limit * 2)),
+            max_window=args.host_max_concurrency,
+            failure_threshold=args.circuit_failure_threshold,
+            cooldown=args.circuit_cooldown
+        )
+        print(f"Per-host scheduling: {args.host_rate_limit:.1f} req/s and up to {args.host_max_concurrency} connections per host")
+
+    # Learned extensions for stale-extension URLs, optionally carried over from earlier runs
+    extension_cache = ExtensionCache(args.extension_cache)
+
     total_bytes = []  # List to track total bytes downloaded
     start_time = time.monotonic()  # Start timer
 
+    reporter = ProgressReporter(args.progress, args.progress_interval)
+
+    # Phase timings through aiohttp trace hooks plus internal timers
+    metrics = None
+    metrics_task = None
+    trace_configs = []
+    if args.request_metrics or args.metrics_log or args.event_log:
+        metrics = RequestMetrics(args.metrics_log, args.metrics_interval, args.event_log, args.event_sample_rate)
+        trace_configs.append(metrics.trace_config())
+        if args.metrics_log:
+            metrics_task = asyncio.create_task(metrics.run())
+        print("Collecting per-request phase timings")
+
+    # Watch for anything that blocks the event loop
+    lag_stats = {'samples': 0, 'total': 0.0, 'max': 0.0}
+    lag_task = asyncio.create_task(monitor_event_loop_lag(lag_stats))
+
     # Configure session with connection pooling and limits
     connector = aiohttp.TCPConnector(
         limit=concurrent_downloads * 2,  # Total connection pool size
-        limit_per_host=20,  # Max connections per host
+        limit_per_host=args.host_max_concurrency if host_scheduler else 20,  # Max connections per host
         ttl_dns_cache=300,  # DNS cache TTL
         use_dns_cache=True,
     )
@@ -662,66 +3516,89 @@ async def main():
     async with aiohttp.ClientSession(
         connector=connector,
         timeout=aiohttp.ClientTimeout(total=timeout*2),  # Overall session timeout
-        headers={'User-Agent': 'LDAWT-ImageDownloader/1.0'}
+        headers={'User-Agent': 'LDAWT-ImageDownloader/1.0'},
+        trace_configs=trace_configs
     ) as session:
         
-        # Initialize tracking variables
-        all_error_details = []
-        total_successful_downloads = 0
-        current_df = df.copy()
-        attempt = 1
-        
-        # Main download loop with retries
-        while attempt <= max_retry_attempts and not current_df.empty and not shutdown_flag:
-            # Download current batch
-            successful_downloads, error_details, retry_rows = await download_batch_with_retries(
-                session, current_df, output_folder, url_col, class_col, 
-                total_bytes, timeout, max_file_size, token_bucket, 
-                enable_rate_limiting, concurrent_downloads, attempt
-            )
-            
-            total_successful_downloads += successful_downloads
-            all_error_details.extend(error_details)
-            
-            # Count retry errors (429 and timeout) for this attempt
-            count_retry_errors = len(retry_rows)
-            # Count specific error types in error details
-            count_429 = sum(1 for error in error_details if error.get('status_code') == 429 or "429" in str(error.get('error', '')))
-            count_timeouts = sum(1 for error in error_details if "Timeout" in str(error.get('error', '')) or error.get('status_code') == 0)
-            non_retry_errors = len(error_details) - count_retry_errors
-            
-            print(f"\nAttempt #{attempt} Results:")
-            print(f"  - Successful downloads: {successful_downloads}")
-            print(f"  - Retry errors (429 + timeout): {count_retry_errors}")
-            print(f"  - Other errors: {non_retry_errors}")
-            
-            # Prepare for next attempt if there are retry errors
-            if retry_rows and attempt < max_retry_attempts and not shutdown_flag:
-                current_df = pd.DataFrame(retry_rows)
-                attempt += 1
-                print(f"\nWaiting {retry_delay} seconds before retry attempt...")
-                await asyncio.sleep(retry_delay)
-            else:
-                break
-        
-        # Final results
-        if retry_rows and attempt > max_retry_attempts:
-            print(f"\nReached maximum retry attempts ({max_retry_attempts}). {len(retry_rows)} items with retry errors will not be retried.")
-        elif not retry_rows:
-            print(f"\nAll downloads completed successfully or no retry errors remaining.")
-    
+        # Columns are pulled out once; the batch is positions into them
+        keys = df.index.to_numpy()
+        urls = df[url_col].to_numpy()
+        labels = df[class_col].to_numpy()
+        current_positions = np.arange(len(df))
+
+        # Only the first row per URL is scheduled; the rest follow its result
+        deduplicator = None
+        if args.dedupe_urls:
+            deduplicator = UrlDeduplicator(urls)
+            current_positions = deduplicator.primary_positions
+            print(f"URL dedup: {len(df)} rows reference {len(current_positions)} unique URLs ({deduplicator.duplicate_rows} duplicate rows)")
+
+        # Failed rows are retried individually as their backoff expires, alongside fresh rows
+        retry_scheduler = RetryScheduler(retry_budgets, retry_delay, args.retry_max_delay, host_scheduler)
+
+        successful_downloads, error_details, retry_positions = await download_batch_with_retries(
+            session, keys, urls, labels, current_positions, writer,
+            total_bytes, timeout, max_file_size, token_bucket, 
+            enable_rate_limiting, concurrent_downloads, retry_scheduler, chunk_size, host_scheduler, byte_bucket,
+            extension_cache, deduplicator, reporter, metrics
+        )
+
+        retry_stats = retry_scheduler.get_stats()
+        print(f"\nDownload Results:")
+        print(f"  - Successful downloads: {successful_downloads}")
+        print(f"  - Retries: {sum(retry_stats['retries_scheduled'].values())} across {retry_stats['rows_retried']} rows ({retry_stats['retry_after_honored']} honoring Retry-After)")
+        print(f"  - Failed rows: {len(error_details)} ({sum(retry_stats['budget_exhausted'].values())} after using up their retry budget)")
+        if len(retry_positions) > 0:
+            print(f"  - {len(retry_positions)} rows were still waiting for a retry when the shutdown was requested")
+
     # Cancel recovery task if it was started
     if recovery_task:
         recovery_task.cancel()
+    lag_task.cancel()
+    if metrics_task:
+        metrics_task.cancel()
+    if metrics:
+        metrics.close()
+    if validator:
+        validator.close()
+    if transformer:
+        transformer.close()
     
-    # Use the aggregated results
-    successful_downloads = total_successful_downloads
-    error_details = all_error_details
 
     total_time = time.monotonic() - start_time  # Total time taken
     total_downloaded = sum(total_bytes)  # Total bytes downloaded
     total_errors = len(error_details)
 
+    # Shards and row groups are closed before the overview so it lists every one of them
+    if output_mode in ["webdataset", "parquet"]:
+        writer.close()
+
+    mean_lag = lag_stats['total'] / lag_stats['samples'] if lag_stats['samples'] else 0.0
+    performance = {
+        "writer": writer.get_stats(),
+        "event_loop_lag_ms": {
+            "mean": round(mean_lag * 1000, 2),
+            "max": round(lag_stats['max'] * 1000, 2)
+        }
+    }
+    if host_scheduler:
+        performance["hosts"] = host_scheduler.get_stats()
+    performance["extension_cache"] = extension_cache.get_stats()
+    if manifest is not None:
+        performance["resume"] = manifest.get_stats()
+    if deduplicator:
+        performance["url_dedup"] = deduplicator.get_stats()
+    if validator:
+        performance["validation"] = validator.get_stats()
+    if transformer:
+        performance["transform"] = transformer.get_stats()
+    if metrics:
+        performance["requests"] = metrics.get_stats()
+    performance["retries"] = retry_stats
+    if output_mode in ["webdataset", "parquet"]:
+        performance[output_mode] = sink.get_stats()
+    extension_cache.save()
+
     print(f"\nDownload Summary:")
     print(f"  - Successful downloads: {successful_downloads}")
     print(f"  - Failed downloads: {total_errors}")
@@ -758,7 +3635,9 @@ async def main():
         total_downloaded,
         filtered_count,
         token_bucket,
-        enable_rate_limiting
+        enable_rate_limiting,
+        performance,
+        manifest.previously_completed if manifest is not None else None
     )
 
     if total_time > 0 and total_downloaded > 0:
@@ -768,14 +3647,43 @@ async def main():
         print(f"  - Avg Speed: {avg_speed / 1e6:.2f} MB/s")
     else:
         print("  - No successful downloads to compute bandwidth statistics.")
+    print(f"  - Event loop lag: mean {performance['event_loop_lag_ms']['mean']:.1f} ms, max {performance['event_loop_lag_ms']['max']:.1f} ms")
 
-    # Only create tar if we have successful downloads and no shutdown was requested
-    create_tar_archive(
-        output_path,
-        output_folder,
-        successful_downloads,
-        total_errors
-    )
+    # Only keep a tar if we have successful downloads (from this or an earlier attempt) and no shutdown was requested
+    stored_downloads = successful_downloads + (manifest.previously_completed if manifest is not None else 0)
+    if output_mode == "webdataset":
+        finalize_webdataset(
+            writer,
+            stored_downloads,
+            total_errors
+        )
+    elif output_mode == "parquet":
+        finalize_parquet_output(
+            output_path,
+            writer,
+            stored_downloads,
+            total_errors
+        )
+    elif output_mode == "tar_stream":
+        finalize_stream_archive(
+            output_path,
+            writer,
+            stored_downloads,
+            total_errors
+        )
+    else:
+        writer.close()
+        create_tar_archive(
+            output_path,
+            output_folder,
+            stored_downloads,
+            total_errors,
+            archive_compression
+        )
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    args = parse_args()
+    if args.processes > 1:
+        run_sharded(args)
+    else:
+        run_event_loop(main(args), args.event_loop)
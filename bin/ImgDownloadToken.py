@@ -12,48 +12,118 @@ from tqdm.asyncio import tqdm
 import argparse
 import mimetypes
 import time
+import collections
 
 class TokenBucket:
     """
     A token bucket implementation for rate limiting.
+    Waiters are served in FIFO order and sleep exactly until enough tokens have
+    accumulated (one timer for the whole queue) instead of polling. Tokens can stand
+    for requests or for bytes; acquire(n) takes n of them at once.
     """
     def __init__(self, rate, capacity):
         """
         Initialize the token bucket.
         :param rate: Number of tokens added per second.
+        
         :param capacity: Maximum number of tokens the bucket can hold.
         """
         self.rate = rate
         self.capacity = capacity
         self.tokens = capacity
-        self.last_refill = time.time()
+        self.last_refill = time.monotonic()
+        self.waiters = collections.deque()  # (amount, future) in arrival order
+        self.timer = None
 
-    async def acquire(self):
+    async def acquire(self, amount=1):
         """
-        Wait until a token is available and consume it.
+        Wait until amount tokens are available and consume them.
+        Requests larger than the capacity wait for a full bucket and leave it in debt.
         """
-        while True:
-            self._refill()
-            if self.tokens >= 1:
-                self.tokens -= 1
-                return
-            await asyncio.sleep(0.01)  # Wait a short time before checking again
+        self._refill()
+        if not self.waiters and self.tokens >= min(amount, self.capacity):
+            self.tokens -= amount
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append((amount, waiter))
+        self._schedule()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if not waiter.done() or waiter.cancelled():
+                self._forget(waiter)
+            else:
+                # Granted just as we were cancelled: hand the tokens back
+                self.tokens += amount
+                self._grant()
+            raise
+
+    def _forget(self, waiter):
+        for entry in self.waiters:
+            if entry[1] is waiter:
+                self.waiters.remove(entry)
+                break
+        self._schedule()
+
+    def _grant(self):
+        """
+        Hand out tokens to queued waiters in order, stopping at the first that cannot be served.
+        """
+        self._refill()
+        while self.waiters:
+            amount, waiter = self.waiters[0]
+            if waiter.done():
+                self.waiters.popleft()
+                continue
+            if self.tokens < min(amount, self.capacity):
+                break
+            self.waiters.popleft()
+            self.tokens -= amount
+            waiter.set_result(None)
+        self._schedule()
+
+    def _on_timer(self):
+        self.timer = None
+        self._grant()
+
+    def _schedule(self):
+        """
+        Arm a single timer for the moment the head waiter can be served.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.waiters:
+            return
+        amount = self.waiters[0][0]
+        missing = min(amount, self.capacity) - self.tokens
+        delay = max(0.0, missing / self.rate) if self.rate > 0 else 1.0
+        self.timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
 
     def _refill(self):
         """
         Refill the bucket with tokens based on the elapsed time.
         """
-        now = time.time()
+        now = time.monotonic()
         elapsed = now - self.last_refill
         new_tokens = elapsed * self.rate
         self.tokens = min(self.capacity, self.tokens + new_tokens)
         self.last_refill = now
 
+    def set_rate(self, new_rate):
+        """
+        Change the refill rate, crediting tokens earned at the old rate first.
+        """
+        self._refill()
+        self.rate = new_rate
+        if self.waiters:
+            self._schedule()
+
     def adjust_rate(self, new_rate):
         new_rate = max(10, new_rate)
         if new_rate != self.rate:
             print(f"[TokenBucket] Adjusting rate: {self.rate:.2f} -> {new_rate:.2f} tokens/sec")
-            self.rate = new_rate
+            self.set_rate(new_rate)
 
     def get_rate(self):
         return self.rate
@@ -3,11 +3,22 @@
 import argparse
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
+import sys
+import resource
 import sqlite3
 import json
+import heapq
+import hashlib
+import collections
 from math import ceil
 from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+
+# Partitioner cost models for --cost_model
+COST_MODELS = ["rows", "bytes", "hosts", "throughput"]
 
 @dataclass
 class FilterArguments:
@@ -30,6 +41,82 @@ class FilterArguments:
         default = None,
         metadata = {"help": "name of output folder"}
     )
+    refine_rounds: int = field(
+        default = 0,
+        metadata = {"help": "rounds of pairwise swaps to tighten the group balance"}
+    )
+    write_threads: int = field(
+        default = 8,
+        metadata = {"help": "threads writing group files concurrently"}
+    )
+    row_group_size: int = field(
+        default = 1024 * 1024,
+        metadata = {"help": "maximum rows per parquet row group"}
+    )
+    compression: str = field(
+        default = "snappy",
+        metadata = {"help": "parquet compression codec"}
+    )
+    streaming: bool = field(
+        default = False,
+        metadata = {"help": "split out of core in two streaming passes"}
+    )
+    batch_size: int = field(
+        default = 256 * 1024,
+        metadata = {"help": "rows per record batch in streaming mode"}
+    )
+    buffer_mb: int = field(
+        default = 512,
+        metadata = {"help": "memory budget for all group buffers in streaming mode"}
+    )
+    flush_mb: int = field(
+        default = 64,
+        metadata = {"help": "buffered megabytes at which a group is appended to its file in streaming mode"}
+    )
+    cost_model: str = field(
+        default = "rows",
+        metadata = {"help": "what groups are balanced on: rows, bytes, hosts or throughput"}
+    )
+    url_col: str = field(
+        default = "photo_url",
+        metadata = {"help": "name of the URL column"}
+    )
+    size_estimates: str = field(
+        default = None,
+        metadata = {"help": "per-URL size estimates (CalcDatasetSize.py --sizes_output)"}
+    )
+    host_throughput: list = field(
+        default = None,
+        metadata = {"help": "JSON files with historical rows per second per host"}
+    )
+    host_rate: float = field(
+        default = 20.0,
+        metadata = {"help": "rows per second assumed for hosts without history"}
+    )
+    worker_rate: float = field(
+        default = 100.0,
+        metadata = {"help": "rows per second one group's download can sustain overall"}
+    )
+    worker_bandwidth_mb: float = field(
+        default = 50.0,
+        metadata = {"help": "megabytes per second one group's download can sustain"}
+    )
+    split_report: bool = field(
+        default = False,
+        metadata = {"help": "also write the predicted runtime of every group to split_report.json"}
+    )
+    sharding: str = field(
+        default = "balanced",
+        metadata = {"help": "balanced groups, or stable hash shards written incrementally"}
+    )
+    hash_on: str = field(
+        default = "key",
+        metadata = {"help": "what hash sharding hashes: the grouping key or the URL"}
+    )
+    id_col: str = field(
+        default = None,
+        metadata = {"help": "column identifying a row across hash sharding runs (default: the URL column)"}
+    )
 
 def parse_args() -> argparse.Namespace:
     """
@@ -56,6 +143,123 @@ def parse_args() -> argparse.Namespace:
         type = str, 
         help = "name of output folder"
     )
+    parser.add_argument(
+        '--refine_rounds',
+        type = int,
+        default = 0,
+        help = "rounds of pairwise swaps to tighten the group balance (default: 0)"
+    )
+    parser.add_argument(
+        '--write_threads',
+        type = int,
+        default = 8,
+        help = "threads writing group files concurrently (default: 8)"
+    )
+    parser.add_argument(
+        '--row_group_size',
+        type = int,
+        default = 1024 * 1024,
+        help = "maximum rows per parquet row group (default: 1048576)"
+    )
+    parser.add_argument(
+        '--compression',
+        type = str,
+        default = "snappy",
+        choices = ["snappy", "zstd", "gzip", "brotli", "lz4", "none"],
+        help = "parquet compression codec (default: snappy)"
+    )
+    parser.add_argument(
+        '--streaming',
+        action = "store_true",
+        help = "split out of core in two streaming passes, for inputs larger than memory"
+    )
+    parser.add_argument(
+        '--batch_size',
+        type = int,
+        default = 256 * 1024,
+        help = "rows per record batch in streaming mode (default: 262144)"
+    )
+    parser.add_argument(
+        '--buffer_mb',
+        type = int,
+        default = 512,
+        help = "memory budget for all group buffers in streaming mode (default: 512)"
+    )
+    parser.add_argument(
+        '--flush_mb',
+        type = int,
+        default = 64,
+        help = "buffered megabytes at which a group is appended to its file in streaming mode (default: 64)"
+    )
+    parser.add_argument(
+        '--cost_model',
+        type = str,
+        default = "rows",
+        choices = COST_MODELS,
+        help = "what groups are balanced on: 'rows', expected 'bytes' (needs --size_estimates), 'hosts' to spread every host across groups, or 'throughput' from historical per-host rates (default: rows)"
+    )
+    parser.add_argument(
+        '--url_col',
+        type = str,
+        default = "photo_url",
+        help = "name of the URL column (default: photo_url)"
+    )
+    parser.add_argument(
+        '--size_estimates',
+        type = str,
+        default = None,
+        help = "parquet/CSV of per-URL size estimates with a size_kb column (CalcDatasetSize.py --sizes_output)"
+    )
+    parser.add_argument(
+        '--host_throughput',
+        type = str,
+        nargs = "+",
+        default = None,
+        help = "JSON files with historical rows per second per host: a {host: rate} mapping or ImgDownloadOptimized overviews"
+    )
+    parser.add_argument(
+        '--host_rate',
+        type = float,
+        default = 20.0,
+        help = "rows per second assumed for hosts without history (default: 20)"
+    )
+    parser.add_argument(
+        '--worker_rate',
+        type = float,
+        default = 100.0,
+        help = "rows per second one group's download can sustain overall (default: 100)"
+    )
+    parser.add_argument(
+        '--worker_bandwidth_mb',
+        type = float,
+        default = 50.0,
+        help = "megabytes per second one group's download can sustain (default: 50)"
+    )
+    parser.add_argument(
+        '--split_report',
+        action = "store_true",
+        help = "also write every group's predicted download time to split_report.json in the output folder (a one-line summary is always printed)"
+    )
+    parser.add_argument(
+        '--sharding',
+        type = str,
+        default = "balanced",
+        choices = ["balanced", "hash"],
+        help = "'balanced' groups, or 'hash' shards: a stable hash picks every row's shard and reruns into the same output folder only write the new rows, to a delta_<run> subfolder (default: balanced)"
+    )
+    parser.add_argument(
+        '--hash_on',
+        type = str,
+        default = "key",
+        choices = ["key", "url"],
+        help = "hash sharding input: the grouping 'key' keeps a class in one shard, the 'url' spreads rows evenly (default: key)"
+    )
+    parser.add_argument(
+        '--id_col',
+        type = str,
+        default = None,
+        help = "column identifying a row across hash sharding runs (default: the URL column)"
+    )
     args = parser.parse_args()
 
     
@@ -65,33 +269,109 @@ def parse_args() -> argparse.Namespace:
         parquet=args.parquet,
         grouping_col=args.grouping_col, 
         groups=args.groups, 
-        output_folder=args.output_folder
+        output_folder=args.output_folder,
+        refine_rounds=args.refine_rounds,
+        write_threads=args.write_threads,
+        row_group_size=args.row_group_size,
+        compression=args.compression,
+        streaming=args.streaming,
+        batch_size=args.batch_size,
+        buffer_mb=args.buffer_mb,
+        flush_mb=args.flush_mb,
+        cost_model=args.cost_model,
+        url_col=args.url_col,
+        size_estimates=args.size_estimates,
+        host_throughput=args.host_throughput,
+        host_rate=args.host_rate,
+        worker_rate=args.worker_rate,
+        worker_bandwidth_mb=args.worker_bandwidth_mb,
+        split_report=args.split_report,
+        sharding=args.sharding,
+        hash_on=args.hash_on,
+        id_col=args.id_col
     )
 
-def greedy_grouping(num_partitions, df, count, name):
+def lpt_partition(counts: np.ndarray, num_partitions: int, refine_rounds: int = 0) -> np.ndarray:
     """
-    Performs greedy grouping given a dataframe and number of partitions.
+    Longest-processing-time partitioning: items are placed largest first, each on the
+    currently lightest partition, kept in a heap. Returns the 1-based group id of every item.
     """
-    # Sort the dataframe by count in descending order to handle larger groups first
-    sorted_df = df.sort_values(by=count, ascending=False).reset_index(drop=True)
+    counts = np.asarray(counts)
+    group_ids = np.zeros(len(counts), dtype=np.int64)
+    if len(counts) == 0:
+        return group_ids
+    order = np.argsort(-counts, kind="stable")
 
-    # Initialize partition data structures
-    partitions = [[] for _ in range(num_partitions)]
-    partition_sums = [0 for _ in range(num_partitions)]
-    
-    for _, row in sorted_df.iterrows():
-        # Find the partition with the minimum sum that can accommodate the current row
-        min_partition_idx = np.argmin(partition_sums)
-        partitions[min_partition_idx].append(row)
-        partition_sums[min_partition_idx] += row[count]
+    # The largest num_partitions items always open one partition each
+    first = order[:num_partitions]
+    group_ids[first] = np.arange(1, len(first) + 1)
+    loads = np.zeros(num_partitions, dtype=np.int64)
+    loads[:len(first)] = counts[first]
 
-    # Flatten the partitions and create a new dataframe
-    new_rows = []
-    for group_id, partition in enumerate(partitions, 1):
-        for row in partition:
-            new_rows.append({name: row[name], count: row[count], "group": group_id})
+    heap = [(int(load), group) for group, load in enumerate(loads, 1)]
+    heapq.heapify(heap)
+    rest = order[num_partitions:]
+    assigned = np.empty(len(rest), dtype=np.int64)
+    for position, item_count in enumerate(counts[rest].tolist()):
+        load, group = heap[0]
+        heapq.heapreplace(heap, (load + item_count, group))
+        assigned[position] = group
+    group_ids[rest] = assigned
 
-    output_df = pd.DataFrame(new_rows)
+    if refine_rounds > 0:
+        group_ids = refine_partition(counts, group_ids, num_partitions, refine_rounds)
+    return group_ids
+
+def refine_partition(counts: np.ndarray, group_ids: np.ndarray, num_partitions: int, rounds: int) -> np.ndarray:
+    """
+    Tighten an existing partition: each round swaps one item of the heaviest group with a
+    smaller item (or nothing) of the lightest group, picking the pair whose difference is
+    closest to half the load gap. Stops early once no swap narrows the gap.
+    """
+    group_ids = group_ids.copy()
+    loads = np.bincount(group_ids, weights=counts, minlength=num_partitions + 1)[1:].astype(np.int64)
+    for _ in range(rounds):
+        heavy, light = int(np.argmax(loads)) + 1, int(np.argmin(loads)) + 1
+        gap = loads[heavy - 1] - loads[light - 1]
+        if gap <= 1:
+            break
+        heavy_items = np.flatnonzero(group_ids == heavy)
+        light_items = np.flatnonzero(group_ids == light)
+        # Moving nothing back is a swap with a zero-sized item
+        light_counts = np.concatenate([[0], counts[light_items]])
+        light_order = np.argsort(light_counts, kind="stable")
+        light_sorted = light_counts[light_order]
+
+        # For every heavy item, the light item that brings the difference closest to gap / 2
+        targets = counts[heavy_items] - gap / 2
+        candidates = np.zeros(len(heavy_items), dtype=np.int64)
+        if len(light_sorted) > 1:
+            above = np.clip(np.searchsorted(light_sorted, targets), 1, len(light_sorted) - 1)
+            closer_below = np.abs(light_sorted[above - 1] - targets) <= np.abs(light_sorted[above] - targets)
+            candidates = np.where(closer_below, above - 1, above)
+        deltas = counts[heavy_items] - light_sorted[candidates]
+        new_gaps = np.abs(gap - 2 * deltas)
+        best = int(np.argmin(new_gaps))
+        if deltas[best] <= 0 or new_gaps[best] >= gap:
+            break
+
+        group_ids[heavy_items[best]] = light
+        loads[heavy - 1] -= deltas[best]
+        loads[light - 1] += deltas[best]
+        swapped = light_order[candidates[best]]
+        if swapped > 0:
+            group_ids[light_items[swapped - 1]] = heavy
+    return group_ids
+
+def greedy_grouping(num_partitions, df, count, name, refine_rounds=0):
+    """
+    Performs greedy grouping given a dataframe and number of partitions.
+    """
+    group_ids = lpt_partition(df[count].to_numpy(), num_partitions, refine_rounds)
+
+    # Rows grouped by partition, larger counts first within each group
+    output_df = pd.DataFrame({name: df[name].to_numpy(), count: df[count].to_numpy(), "group": group_ids})
+    output_df = output_df.sort_values(by=["group", count], ascending=[True, False], kind="stable").reset_index(drop=True)
 
     return output_df
 
@@ -113,24 +393,425 @@ def partition_df(df, num_partitions, taxon_col):
 
     return sorted_df
 
+def write_groups(df: pd.DataFrame, group_col: str, output_folder: str, write_threads: int = 8,
+                 row_group_size: int = 1024 * 1024, compression: str = "snappy") -> list:
+    """
+    Write one parquet file per group in a single pass: the frame is sorted by group once,
+    converted to one Arrow table, and each group is a zero-copy slice of it. The files are
+    written from a thread pool since the parquet encoder releases the GIL.
+    Returns the written paths in order of first appearance of each group.
+    """
+    groups = df[group_col].to_numpy()
+    order = np.argsort(groups, kind="stable")
+    table = pa.Table.from_pandas(df.iloc[order], preserve_index=False)
+    sorted_groups = groups[order]
+
+    # Contiguous [start, end) range of every group in the sorted table
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]) if len(sorted_groups) else np.array([], dtype=np.int64)
+    ends = np.r_[starts[1:], len(sorted_groups)]
+    ranges = {sorted_groups[start]: (start, end) for start, end in zip(starts, ends)}
+
+    def write(group):
+        start, end = ranges[group]
+        path = f"{output_folder}/group_{group}.parquet"
+        pq.write_table(table.slice(start, end - start), path, row_group_size=row_group_size, compression=compression)
+        return path
+
+    with ThreadPoolExecutor(max_workers=max(1, write_threads)) as executor:
+        return list(executor.map(write, pd.unique(groups)))
+
+def count_keys_streaming(parquet_path: str, key_col: str, batch_size: int) -> dict:
+    """
+    First streaming pass: row counts per key, reading only the key column batch by batch.
+    """
+    counts = {}
+    for batch in pq.ParquetFile(parquet_path).iter_batches(batch_size=batch_size, columns=[key_col]):
+        value_counts = batch.column(0).value_counts()
+        for key, count in zip(value_counts.field("values").to_pylist(), value_counts.field("counts").to_pylist()):
+            counts[key] = counts.get(key, 0) + count
+    return counts
+
+def split_streaming(parquet_path: str, grouping_col: str, num_partitions: int, output_folder: str,
+                    refine_rounds: int = 0, batch_size: int = 256 * 1024, buffer_mb: int = 512,
+                    flush_mb: int = 64, row_group_size: int = 1024 * 1024, compression: str = "snappy") -> list:
+    """
+    Out-of-core version of partition_df + greedy_grouping + write_groups, in two passes.
+    The first pass counts the grouping column and derives the same "_N" chunk suffixes
+    partition_df gives by sorted position, plus the group of every suffixed key. The second
+    pass streams record batches and routes each row into a per-group buffer, which is
+    appended to that group's parquet file once it reaches flush_mb. When all buffers
+    together exceed buffer_mb the largest ones are flushed early, so peak memory is bounded
+    by the buffer budget and the batch size, not by the dataset.
+    Rows keep their input order within a group. Returns the written paths by group.
+    """
+    counts = count_keys_streaming(parquet_path, grouping_col, batch_size)
+    keys = sorted(counts)
+    key_counts = np.array([counts[key] for key in keys], dtype=np.int64)
+    key_starts = np.cumsum(key_counts) - key_counts
+    partition_size = max(1, ceil(int(key_counts.sum()) / num_partitions))
+
+    # Rows of a key that straddles a chunk boundary get one suffix per chunk, as in partition_df
+    suffixed_counts = {}
+    for key, start, count in zip(keys, key_starts.tolist(), key_counts.tolist()):
+        for chunk in range(start // partition_size, (start + count - 1) // partition_size + 1):
+            rows = min(start + count, (chunk + 1) * partition_size) - max(start, chunk * partition_size)
+            suffixed_counts[f"{key}_{chunk + 1}"] = rows
+    # Same row order as the groupby in main, so ties are placed the same way
+    count_df = pd.DataFrame({grouping_col: list(suffixed_counts), "Count": list(suffixed_counts.values())})
+    count_df = count_df.sort_values(by=grouping_col).reset_index(drop=True).sort_values(by='Count', ascending=False)
+    groups_df = greedy_grouping(num_partitions, count_df, "Count", grouping_col, refine_rounds)
+    suffixed_groups = groups_df.set_index(grouping_col)["group"]
+
+    # Chunk suffixes raise the open file count to one per group
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = num_partitions + 64
+        if soft != resource.RLIM_INFINITY and soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted if hard == resource.RLIM_INFINITY else min(wanted, hard), hard))
+    except (ValueError, OSError):
+        pass
+
+    key_index = {key: index for index, key in enumerate(keys)}
+    seen = np.zeros(len(keys), dtype=np.int64)  # Rows of each key routed so far
+    writers = {}
+    buffers = {}
+    buffer_bytes = {}
+
+    def flush(group):
+        table = pa.concat_tables(buffers.pop(group))
+        buffer_bytes.pop(group)
+        if group not in writers:
+            writers[group] = pq.ParquetWriter(f"{output_folder}/group_{group}.parquet", table.schema, compression=compression)
+        writers[group].write_table(table, row_group_size=row_group_size)
+
+    try:
+        for batch in pq.ParquetFile(parquet_path).iter_batches(batch_size=batch_size):
+            names = batch.column(grouping_col).to_pandas()
+            codes = names.map(key_index).to_numpy(dtype=np.int64)
+
+            # Position of every row within the sorted order, from its occurrence index within its key
+            occurrence = pd.Series(codes).groupby(codes).cumcount().to_numpy()
+            positions = key_starts[codes] + seen[codes] + occurrence
+            np.add.at(seen, codes, 1)
+            suffixed = names + "_" + (positions // partition_size + 1).astype(str)
+            row_groups = suffixed.map(suffixed_groups).to_numpy(dtype=np.int64)
+
+            table = pa.Table.from_batches([batch])
+            table = table.set_column(table.schema.get_field_index(grouping_col), grouping_col, pa.array(suffixed.to_numpy(), type=pa.string()))
+            table = table.append_column("group", pa.array(row_groups))
+
+            order = np.argsort(row_groups, kind="stable")
+            sorted_groups = row_groups[order]
+            starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]) if len(sorted_groups) else np.array([], dtype=np.int64)
+            for start, end in zip(starts, np.r_[starts[1:], len(sorted_groups)]):
+                group = int(sorted_groups[start])
+                # A take (not a slice) so the buffer does not pin the whole batch
+                part = table.take(pa.array(order[start:end]))
+                buffers.setdefault(group, []).append(part)
+                buffer_bytes[group] = buffer_bytes.get(group, 0) + part.nbytes
+                if buffer_bytes[group] >= flush_mb * 1024 * 1024:
+                    flush(group)
+
+            # Over budget: flush the largest buffers until half the budget is free again
+            if sum(buffer_bytes.values()) > buffer_mb * 1024 * 1024:
+                for group in sorted(buffer_bytes, key=buffer_bytes.get, reverse=True):
+                    flush(group)
+                    if sum(buffer_bytes.values()) <= buffer_mb * 1024 * 1024 / 2:
+                        break
+
+        for group in list(buffers):
+            flush(group)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return [f"{output_folder}/group_{group}.parquet" for group in sorted(writers)]
+
+def url_hosts(urls: pd.Series) -> pd.Series:
+    """Host (netloc) of every URL, the unit ImgDownloadOptimized schedules and rate-limits by"""
+    return urls.astype(str).str.extract(r"^[A-Za-z][A-Za-z0-9+.-]*://([^/?#]*)", expand=False).fillna("").str.lower()
+
+def load_size_estimates(path: str, url_col: str) -> pd.Series:
+    """
+    Expected bytes per URL from a size estimate file (CalcDatasetSize.py --sizes_output):
+    a parquet or CSV with the URL column and size_kb. Unresolved (0) sizes are left out.
+    """
+    sizes = pd.read_parquet(path) if path.endswith(".parquet") else pd.read_csv(path)
+    if "size_kb" not in sizes.columns:
+        raise ValueError(f"{path} has no size_kb column")
+    url_column = url_col if url_col in sizes.columns else sizes.columns[0]
+    sizes = sizes[sizes["size_kb"] > 0].drop_duplicates(subset=url_column)
+    if sizes.empty:
+        raise ValueError(f"{path} has no resolved sizes")
+    return pd.Series(sizes["size_kb"].to_numpy() * 1024, index=sizes[url_column].to_numpy())
+
+def expected_row_bytes(urls: pd.Series, sizes: pd.Series) -> np.ndarray:
+    """
+    Expected bytes of every row; URLs without an estimate get the median of those that matched.
+    """
+    row_bytes = urls.map(sizes)
+    if row_bytes.isna().all():
+        raise ValueError("none of the URLs have a size estimate, check --size_estimates and --url_col")
+    return row_bytes.fillna(row_bytes.median()).to_numpy()
+
+def load_host_throughput(paths: list) -> dict:
+    """
+    Historical rows per second per host, from JSON files that are either a {host: rate}
+    mapping or ImgDownloadOptimized overviews (the final per-host rate of each shard).
+    """
+    rates = {}
+    for path in paths or []:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if "performance" not in data:
+            rates.update({host.lower(): float(rate) for host, rate in data.items()})
+            continue
+        performances = [data["performance"]] + [shard.get("performance", {}) for shard in data["performance"].get("shards", [])]
+        for performance in performances:
+            for host, stats in performance.get("hosts", {}).get("hosts", {}).items():
+                rates[host.lower()] = float(stats["final_rate"])
+    return rates
+
+def cost_aware_partition(key_rows: np.ndarray, key_bytes: np.ndarray, key_hosts: list, host_rates: np.ndarray,
+                         num_partitions: int, worker_rate: float, worker_bandwidth: float, candidates: int = 8) -> tuple:
+    """
+    Greedy partitioning against a runtime model: a group takes as long as the slowest of
+    its rows at worker_rate, its bytes at worker_bandwidth and, for every host, that host's
+    rows at the host's rate (hosts are rate limited on their own). Keys are placed largest
+    first; each goes to whichever of the `candidates` currently fastest groups ends up with
+    the lowest predicted time, which spreads every host's URLs across groups.
+    key_hosts holds a list of (host index, rows) per key. Returns 1-based group ids and
+    the predicted seconds of every group.
+    """
+    group_rows = np.zeros(num_partitions)
+    group_bytes = np.zeros(num_partitions)
+    group_host_rows = [collections.Counter() for _ in range(num_partitions)]
+    group_host_time = np.zeros(num_partitions)
+    group_time = np.zeros(num_partitions)
+
+    def alone(key):
+        host_time = max((rows / host_rates[host] for host, rows in key_hosts[key]), default=0.0)
+        return max(key_rows[key] / worker_rate, key_bytes[key] / worker_bandwidth, host_time)
+
+    order = sorted(range(len(key_rows)), key=alone, reverse=True)
+    group_ids = np.zeros(len(key_rows), dtype=np.int64)
+    heap = [(0.0, group) for group in range(num_partitions)]
+    width = max(1, min(candidates, num_partitions))
+    for key in order:
+        options = [heapq.heappop(heap) for _ in range(width)]
+        best = None
+        for current, group in options:
+            host_time = group_host_time[group]
+            for host, rows in key_hosts[key]:
+                host_time = max(host_time, (group_host_rows[group][host] + rows) / host_rates[host])
+            predicted = max((group_rows[group] + key_rows[key]) / worker_rate, (group_bytes[group] + key_bytes[key]) / worker_bandwidth, host_time)
+            if best is None or (predicted, current) < best[:2]:
+                best = (predicted, current, group, host_time)
+        predicted, _, group, host_time = best
+        group_ids[key] = group + 1
+        group_rows[group] += key_rows[key]
+        group_bytes[group] += key_bytes[key]
+        for host, rows in key_hosts[key]:
+            group_host_rows[group][host] += rows
+        group_host_time[group] = host_time
+        group_time[group] = predicted
+        for current, option in options:
+            heapq.heappush(heap, (group_time[option], option))
+    return group_ids, group_time
+
+def predict_group_times(df: pd.DataFrame, url_col: str, host_rates: dict, default_host_rate: float,
+                        worker_rate: float, worker_bandwidth: float, sizes: pd.Series = None) -> pd.DataFrame:
+    """
+    Predicted runtime of every group under the same model as cost_aware_partition, for the split summary and report.
+    """
+    report = df.groupby("group").size().rename("rows").to_frame()
+    report["seconds_rows"] = report["rows"] / worker_rate
+    report["seconds"] = report["seconds_rows"]
+    if sizes is not None:
+        row_bytes = pd.Series(expected_row_bytes(df[url_col], sizes), index=df.index)
+        report["bytes"] = row_bytes.groupby(df["group"]).sum()
+        report["seconds"] = np.maximum(report["seconds"], report["bytes"] / worker_bandwidth)
+    if url_col in df.columns:
+        host_rows = df.groupby(["group", url_hosts(df[url_col]).rename("host")]).size().rename("rows").reset_index()
+        host_rows["seconds"] = host_rows["rows"] / host_rows["host"].map(host_rates).fillna(default_host_rate)
+        slowest = host_rows.loc[host_rows.groupby("group")["seconds"].idxmax()].set_index("group")
+        report["slowest_host"] = slowest["host"]
+        report["seconds"] = np.maximum(report["seconds"], slowest["seconds"])
+    return report.reset_index()
+
+def cost_model_grouping(total_df: pd.DataFrame, inputs, sizes: pd.Series = None, host_rates: dict = None) -> pd.DataFrame:
+    """
+    Group the (suffixed) keys of total_df with the chosen cost model instead of plain row counts.
+    Host rates are only used by the throughput model; the hosts model treats every host alike.
+    """
+    key_col = inputs.grouping_col
+    host_rates = host_rates if inputs.cost_model == "throughput" else {}
+    codes, keys = pd.factorize(total_df[key_col])
+    key_rows = np.bincount(codes, minlength=len(keys)).astype(float)
+
+    if inputs.cost_model == "bytes":
+        if sizes is None:
+            raise ValueError("--cost_model bytes needs --size_estimates")
+        row_bytes = expected_row_bytes(total_df[inputs.url_col], sizes)
+        key_bytes = np.bincount(codes, weights=row_bytes, minlength=len(keys))
+        group_ids = lpt_partition(np.round(key_bytes).astype(np.int64), int(inputs.groups), inputs.refine_rounds)
+    else:
+        hosts = url_hosts(total_df[inputs.url_col])
+        host_codes, host_names = pd.factorize(hosts)
+        rates = np.array([host_rates.get(host, inputs.host_rate) for host in host_names], dtype=float)
+        pairs = pd.DataFrame({"key": codes, "host": host_codes}).value_counts().reset_index(name="rows")
+        key_hosts = [[] for _ in range(len(keys))]
+        for key, host, rows in zip(pairs["key"].tolist(), pairs["host"].tolist(), pairs["rows"].tolist()):
+            key_hosts[key].append((host, rows))
+        key_bytes = np.zeros(len(keys))
+        if sizes is not None:
+            row_bytes = expected_row_bytes(total_df[inputs.url_col], sizes)
+            key_bytes = np.bincount(codes, weights=row_bytes, minlength=len(keys))
+        group_ids, _ = cost_aware_partition(key_rows, key_bytes, key_hosts, rates, int(inputs.groups), inputs.worker_rate, inputs.worker_bandwidth_mb * 1e6)
+
+    return pd.DataFrame({key_col: keys, "Count": key_rows.astype(np.int64), "group": group_ids})
+
+def stable_hash(values: pd.Series) -> np.ndarray:
+    """
+    64-bit BLAKE2b digest of every value's string form. Unlike hash() or pandas' object
+    hashing this does not depend on the process, platform or library version, so a key
+    hashes the same in every run. Each distinct value is hashed once.
+    """
+    codes, uniques = pd.factorize(values.astype(str))
+    digests = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little") for value in uniques),
+        dtype=np.uint64, count=len(uniques)
+    )
+    return digests[codes]
+
+def jump_hash(digests: np.ndarray, num_buckets: int) -> np.ndarray:
+    """
+    Jump consistent hash (Lamping & Veach) of every digest into [0, num_buckets), vectorized.
+    Growing the bucket count from n to n + 1 only moves 1/(n + 1) of the keys.
+    """
+    keys = digests.astype(np.uint64).copy()
+    buckets = np.full(len(keys), -1, dtype=np.int64)
+    jumps = np.zeros(len(keys), dtype=np.int64)
+    active = np.flatnonzero(jumps < num_buckets)
+    with np.errstate(over="ignore"):
+        while len(active):
+            buckets[active] = jumps[active]
+            keys[active] = keys[active] * np.uint64(2862933555777941757) + np.uint64(1)
+            step = (buckets[active] + 1) * (float(1 << 31) / ((keys[active] >> np.uint64(33)).astype(np.float64) + 1))
+            jumps[active] = np.minimum(step, num_buckets).astype(np.int64)
+            active = active[jumps[active] < num_buckets]
+    return buckets
+
+def split_hashed(df: pd.DataFrame, hash_col: str, id_col: str, num_shards: int, output_folder: str,
+                 write_threads: int = 8, row_group_size: int = 1024 * 1024, compression: str = "snappy") -> list:
+    """
+    Incremental split: every row goes to the shard given by a stable hash of hash_col, so
+    the same key or URL always lands in the same shard no matter what else is in the input.
+    A run only writes the rows not seen before: group_N.parquet in output_folder on the first
+    run, and in output_folder/delta_<run> afterwards for the shards that received new rows,
+    so the TaskVine drivers can be pointed at exactly the new work. The digests of id_col
+    already written and a manifest pinning the shard count and columns, which must not change
+    between runs, are kept in output_folder/shard_state, out of sight of the drivers.
+    """
+    state_folder = f"{output_folder}/shard_state"
+    manifest_path = f"{state_folder}/manifest.json"
+    rows_path = f"{state_folder}/rows.parquet"
+    layout = {"shards": num_shards, "hash_col": hash_col, "id_col": id_col, "hash": "blake2b64+jump"}
+    manifest = {**layout, "runs": []}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        changed = [name for name, value in layout.items() if manifest.get(name) != value]
+        if changed:
+            raise ValueError(f"{output_folder} was sharded with different {', '.join(changed)} ({', '.join(str(manifest.get(name)) for name in changed)}); use a new output folder")
+
+    row_digests = stable_hash(df[id_col])
+    seen = pq.read_table(rows_path).column("digest").to_numpy() if os.path.exists(rows_path) else np.array([], dtype=np.uint64)
+    new_rows = ~np.isin(row_digests, seen)
+    delta = df[new_rows]
+    run = len(manifest["runs"])
+    print(f"{int(new_rows.sum())} new rows, {len(df) - int(new_rows.sum())} already in {output_folder}")
+    if not len(delta):
+        return []
+
+    delta = delta.assign(group=jump_hash(stable_hash(delta[hash_col]), num_shards) + 1)
+    run_folder = output_folder if run == 0 else f"{output_folder}/delta_{run}"
+    os.makedirs(run_folder, exist_ok=True)
+    os.makedirs(state_folder, exist_ok=True)
+    paths = write_groups(delta, "group", run_folder, write_threads, row_group_size, compression)
+
+    # Record the new rows only once their shard files are written
+    pq.write_table(pa.table({"digest": np.concatenate([seen, np.unique(row_digests[new_rows])])}), rows_path)
+    manifest["runs"].append({
+        "run": run,
+        "folder": os.path.relpath(run_folder, output_folder),
+        "rows": len(delta),
+        "files": sorted(os.path.basename(path) for path in paths)
+    })
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return paths
+
 def main():
     inputs = parse_args()
     parquet_path = inputs.parquet
+
+    if inputs.streaming and inputs.cost_model != "rows":
+        print("Error: --streaming only supports --cost_model rows")
+        sys.exit(1)
+
+    if inputs.sharding == "hash":
+        if inputs.streaming or inputs.cost_model != "rows":
+            print("Error: --sharding hash does not combine with --streaming or --cost_model")
+            sys.exit(1)
+        os.makedirs(inputs.output_folder, exist_ok=True)
+        hash_col = inputs.grouping_col if inputs.hash_on == "key" else inputs.url_col
+        try:
+            paths = split_hashed(
+                pd.read_parquet(parquet_path), hash_col, inputs.id_col or inputs.url_col, int(inputs.groups),
+                inputs.output_folder, inputs.write_threads, inputs.row_group_size, inputs.compression
+            )
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        for path in paths:
+            print(path)
+        return
+
+    if inputs.streaming:
+        os.makedirs(inputs.output_folder, exist_ok=True)
+        paths = split_streaming(
+            parquet_path, inputs.grouping_col, int(inputs.groups), inputs.output_folder, inputs.refine_rounds,
+            inputs.batch_size, inputs.buffer_mb, inputs.flush_mb, inputs.row_group_size, inputs.compression
+        )
+        for path in paths:
+            print(path)
+        return
+
     total_df = pd.read_parquet(parquet_path)
 
     # Partition the DataFrame
     total_df = partition_df(total_df, int(inputs.groups), inputs.grouping_col)
 
     # Group by specific row and count
-    count_df = total_df.groupby(inputs.grouping_col).size().reset_index(name="Count").sort_values(by='Count', ascending=False)
-    groups_df = greedy_grouping(int(inputs.groups), count_df, "Count", inputs.grouping_col)
+    try:
+        sizes = load_size_estimates(inputs.size_estimates, inputs.url_col) if inputs.size_estimates else None
+        host_rates = load_host_throughput(inputs.host_throughput)
+        if inputs.cost_model == "rows":
+            count_df = total_df.groupby(inputs.grouping_col).size().reset_index(name="Count").sort_values(by='Count', ascending=False)
+            groups_df = greedy_grouping(int(inputs.groups), count_df, "Count", inputs.grouping_col, inputs.refine_rounds)
+        else:
+            groups_df = cost_model_grouping(total_df, inputs, sizes, host_rates)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
 
     #print("test")
     #print(groups_df.head())
 
-    # Merge total_df with groups_df
+    # Look up each row's group (a left merge on the grouping column, without the join)
     total_df = total_df.drop(columns=['group'], errors='ignore')
-    total_df_merged = total_df.merge(groups_df[[inputs.grouping_col, "group"]], on=inputs.grouping_col, how="left")
+    total_df_merged = total_df.assign(group=total_df[inputs.grouping_col].map(groups_df.set_index(inputs.grouping_col)["group"]))
     #print("test2")
     #print(total_df_merged.head())
     # Create output directory
@@ -142,10 +823,29 @@ def main():
     #     print(f"{inputs.output_folder}/group_{group}.csv")
     #     subset_df.to_csv(f"{inputs.output_folder}/group_{group}.csv", index=False)
 
-    for group in total_df_merged["group"].unique():
-        subset_df = total_df_merged[total_df_merged["group"] == group]
-        print(f"{inputs.output_folder}/group_{group}.parquet")
-        subset_df.to_parquet(f"{inputs.output_folder}/group_{group}.parquet", index=False)
+    for path in write_groups(total_df_merged, "group", inputs.output_folder, inputs.write_threads, inputs.row_group_size, inputs.compression):
+        print(path)
+
+    # Predicted runtime per group, whatever the groups were balanced on
+    try:
+        report = predict_group_times(total_df_merged, inputs.url_col, host_rates, inputs.host_rate, inputs.worker_rate, inputs.worker_bandwidth_mb * 1e6, sizes)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    slowest = float(report["seconds"].max())
+    mean = float(report["seconds"].mean())
+    imbalance = slowest / mean if mean > 0 else 1.0
+    print(f"Predicted group time ({inputs.cost_model} model): {slowest:.1f}s max, {mean:.1f}s mean, imbalance {imbalance:.2f}x")
+
+    if inputs.split_report:
+        with open(f"{inputs.output_folder}/split_report.json", 'w') as f:
+            json.dump({
+                "cost_model": inputs.cost_model,
+                "predicted_makespan_seconds": round(slowest, 2),
+                "mean_group_seconds": round(mean, 2),
+                "imbalance_ratio": round(imbalance, 3),
+                "groups": json.loads(report.round(3).to_json(orient="records"))
+            }, f, indent=2)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
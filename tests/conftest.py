@@ -0,0 +1,27 @@
+import io
+import os
+import sys
+
+import pytest
+
+# The scripts in bin/ import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bin"))
+
+
+@pytest.fixture
+def make_jpeg():
+    """JPEG bytes of the given size, optionally tagged with an EXIF orientation."""
+    from PIL import Image
+
+    def make(width=64, height=48, orientation=None):
+        image = Image.new("RGB", (width, height), (200, 10, 10))
+        output = io.BytesIO()
+        if orientation is None:
+            image.save(output, "JPEG")
+        else:
+            exif = Image.Exif()
+            exif[0x0112] = orientation
+            image.save(output, "JPEG", exif=exif)
+        return output.getvalue()
+
+    return make
@@ -0,0 +1,83 @@
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from CalcDatasetSize import ExtensionCache, try_different_extensions
+
+
+class ImageHost:
+    """Local stand-in host: /fresh/<n>.jpg exist as named, /stale/<n>.jpg only resolve as .png."""
+
+    def __init__(self):
+        self.requests = []
+
+    async def handle(self, request):
+        self.requests.append((request.method, request.path))
+        folder, name = request.path.strip("/").split("/")
+        exists = name.endswith(".jpg") if folder == "fresh" else name.endswith(".png")
+        if not exists:
+            return web.Response(status=404)
+        return web.Response(body=b"x" * 2048, content_type="image/jpeg")
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+
+def estimate(urls, extension_cache):
+    async def run():
+        async with ImageHost() as host, aiohttp.ClientSession() as session:
+            sizes = []
+            for path in urls:
+                host.requests.clear()
+                sizes.append((await try_different_extensions(session, host.base + path, [], extension_cache), list(host.requests)))
+            return sizes
+    return asyncio.run(run())
+
+
+def test_fresh_url_costs_one_head():
+    [(size_kb, requests)] = estimate(["/fresh/1.jpg"], ExtensionCache())
+    assert size_kb == 2.0
+    assert requests == [("HEAD", "/fresh/1.jpg")]
+
+
+def test_stale_url_races_head_probes_only():
+    [(size_kb, requests)] = estimate(["/stale/1.jpg"], ExtensionCache())
+    assert size_kb == 2.0
+    # The original gets a HEAD and a ranged GET, the other extensions are only ever HEADed once
+    fallback = requests[2:]
+    assert requests[:2] == [("HEAD", "/stale/1.jpg"), ("GET", "/stale/1.jpg")]
+    assert all(method == "HEAD" for method, _ in fallback)
+    assert len(fallback) == len(set(fallback)) <= 6
+
+
+def test_learned_extension_goes_first_only_for_stale_patterns():
+    cache = ExtensionCache()
+    results = estimate(["/stale/1.jpg", "/stale/2.jpg", "/fresh/1.jpg", "/fresh/2.jpg"], cache)
+    # Once the stale pattern has a record, the learned .png is tried before the original
+    assert results[1][1] == [("HEAD", "/stale/2.png")]
+    assert cache.hits == 1
+    # A pattern whose originals resolve never pays for a learned-extension attempt
+    assert results[3][1] == [("HEAD", "/fresh/2.jpg")]
+
+
+def test_cache_round_trip(tmp_path):
+    path = str(tmp_path / "extensions.json")
+    cache = ExtensionCache(path)
+    estimate(["/stale/1.jpg"], cache)
+    cache.save()
+    reloaded = ExtensionCache(path)
+    assert reloaded.patterns == cache.patterns
+    assert reloaded.originals == cache.originals
+    [pattern] = reloaded.originals
+    assert pattern.endswith("/stale/#") and reloaded.originals[pattern] == [0, 1]
@@ -0,0 +1,89 @@
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from ImgDownloadOptimized import ExtensionCache, FolderWriter, WriterPool, download_image_with_extensions
+
+
+class ImageHost:
+    """Local stand-in host: /fresh/<n>/img.jpg exist as named, /stale/<n>/img.jpg only resolve as .png."""
+
+    def __init__(self):
+        self.requests = []
+
+    async def handle(self, request):
+        self.requests.append((request.method, request.path))
+        folder = request.path.strip("/").split("/")[0]
+        exists = request.path.endswith(".jpg") if folder == "fresh" else request.path.endswith(".png")
+        if not exists:
+            return web.Response(status=404)
+        return web.Response(body=b"x" * 2048, content_type="image/jpeg")
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+
+def download(tmp_path, paths, extension_cache, seed=None):
+    async def run():
+        writer = WriterPool(FolderWriter(str(tmp_path)), threads=1)
+        results = []
+        async with ImageHost() as host, aiohttp.ClientSession() as session:
+            if seed is not None:
+                seed(host.base)
+            for path in paths:
+                host.requests.clear()
+                url = host.base + path
+                result = await download_image_with_extensions(
+                    path, url, ".jpg", [".jpg", ".jpeg", ".png"], "species", session, 5,
+                    url[:-len(".jpg")], writer, 10_000_000, [], extension_cache=extension_cache
+                )
+                results.append((result[3], list(host.requests)))
+        writer.close()
+        return results
+    return asyncio.run(run())
+
+
+def test_learned_extension_is_not_tried_first_for_fresh_patterns(tmp_path):
+    cache = ExtensionCache()
+
+    def seed(base):
+        # .png is the learned winner, but nothing says this pattern's originals go stale
+        cache.patterns[cache.pattern(base + "/fresh/1/img.jpg")] = {".png": 5}
+
+    results = download(tmp_path, ["/fresh/1/img.jpg", "/fresh/2/img.jpg"], cache, seed)
+    assert results == [(None, [("GET", "/fresh/1/img.jpg")]), (None, [("GET", "/fresh/2/img.jpg")])]
+    assert cache.hits == cache.misses == 0
+
+
+def test_learned_extension_goes_first_once_originals_go_stale(tmp_path):
+    cache = ExtensionCache()
+    [(error, first), (second_error, second)] = download(tmp_path, ["/stale/1/img.jpg", "/stale/2/img.jpg"], cache)
+    # The original 404s, the HEAD race finds .png, then one GET stores it
+    assert error is None
+    assert first[0] == ("GET", "/stale/1/img.jpg") and first[-1] == ("GET", "/stale/1/img.png")
+    # Now the pattern is known to go stale, so the learned extension is the only request
+    assert second_error is None and second == [("GET", "/stale/2/img.png")]
+    assert cache.hits == 1 and cache.misses == 0
+
+
+def test_originals_are_persisted(tmp_path):
+    path = str(tmp_path / "extensions.json")
+    cache = ExtensionCache(path)
+    cache.record_original("https://a.org/photos/1/original.jpg", False)
+    cache.record_original("https://a.org/photos/2/original.jpg", False)
+    cache.record_original("https://a.org/photos/3/original.jpg", True)
+    cache.save()
+    reloaded = ExtensionCache(path)
+    assert reloaded.originals == cache.originals
+    assert reloaded.goes_stale("https://a.org/photos/4/original.jpg")
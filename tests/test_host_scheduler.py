@@ -0,0 +1,53 @@
+import asyncio
+
+import numpy as np
+
+import ImgDownloadOptimized
+from ImgDownloadOptimized import HostScheduler, download_batch_with_retries
+
+
+def test_has_room_follows_the_window_and_an_open_circuit():
+    async def run():
+        scheduler = HostScheduler(rate=1000, capacity=1000, max_window=2)
+        url = "https://slow.org/1.jpg"
+        assert scheduler.has_room(url)
+        async with scheduler.slot(url):
+            assert not scheduler.has_room(url)
+            assert scheduler.has_room("https://fast.org/1.jpg")
+            scheduler.hosts["slow.org"].open_until = float("inf")
+            # Rows for a parked host are taken right away and parked, not held back
+            assert scheduler.has_room(url)
+        assert scheduler.has_room(url)
+
+    asyncio.run(run())
+
+
+def test_full_host_does_not_hold_workers(monkeypatch):
+    finished = {}
+
+    async def fake_download_image(session, key, url, label, writer, total_bytes, timeout, max_file_size,
+                                  token_bucket, chunk_size, host_scheduler, byte_bucket, extension_cache):
+        async with host_scheduler.slot(url):
+            await asyncio.sleep(0.05 if "slow" in url else 0.001)
+        finished[key] = asyncio.get_running_loop().time()
+        return key, f"{key}.jpg", "class", None, 200
+
+    monkeypatch.setattr(ImgDownloadOptimized, "download_image", fake_download_image)
+    # The slow host dominates the input and comes first
+    urls = [f"https://slow.org/{i}.jpg" for i in range(10)] + [f"https://fast.org/{i}.jpg" for i in range(10)]
+    keys = [f"k{i}" for i in range(len(urls))]
+
+    async def run():
+        scheduler = HostScheduler(rate=1000, capacity=1000, max_window=2)
+        return await download_batch_with_retries(
+            None, keys, urls, ["class"] * len(urls), np.arange(len(urls)), None, [0], 5, 0, None, False, 4,
+            host_scheduler=scheduler
+        )
+
+    successful, errors, retry_positions = asyncio.run(run())
+    assert successful == len(urls)
+    assert errors == [] and len(retry_positions) == 0
+    # With one slot on the slow host, the other workers get through every fast row
+    # before the slow host has finished its second row
+    second_slow = sorted(finished[f"k{i}"] for i in range(10))[1]
+    assert max(finished[f"k{i}"] for i in range(10, 20)) < second_slow
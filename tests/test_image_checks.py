@@ -0,0 +1,66 @@
+import io
+import os
+
+import pytest
+
+pytest.importorskip("PIL")
+
+from ImgDownloadOptimized import INVALID_IMAGE_ERROR, inspect_image, transform_image
+
+
+def test_valid_jpeg_passes(make_jpeg):
+    assert inspect_image(make_jpeg()) is None
+
+
+def test_jpeg_with_trailer_after_eoi_passes(make_jpeg):
+    # Motion photos and camera maker data append more than 1 KB after the end-of-image marker
+    assert inspect_image(make_jpeg() + os.urandom(4096)) is None
+
+
+def test_truncated_jpeg_is_rejected(make_jpeg):
+    assert inspect_image(make_jpeg()[:300]) == f"{INVALID_IMAGE_ERROR}: truncated"
+
+
+def test_empty_html_and_unknown_bodies_are_rejected():
+    assert inspect_image(b"") == f"{INVALID_IMAGE_ERROR}: empty body"
+    assert inspect_image(b"<!DOCTYPE html><html>nope</html>") == f"{INVALID_IMAGE_ERROR}: HTML/XML page"
+    assert inspect_image(b"not an image at all") == f"{INVALID_IMAGE_ERROR}: unknown format"
+
+
+def test_minimum_size(make_jpeg):
+    assert inspect_image(make_jpeg(64, 48), min_width=100) == f"{INVALID_IMAGE_ERROR}: below minimum size"
+    assert inspect_image(make_jpeg(64, 48), min_width=64, min_height=48) is None
+
+
+def test_magic_level_skips_the_decode(make_jpeg):
+    assert inspect_image(make_jpeg()[:300], level="magic") is None
+
+
+def test_transform_downscales_and_keeps_aspect(make_jpeg):
+    from PIL import Image
+
+    content, error, _ = transform_image(make_jpeg(2400, 1800), max_side=299)
+    assert error is None
+    assert Image.open(io.BytesIO(content)).size == (299, 224)
+
+
+def test_transform_keeps_original_bytes_when_nothing_changes(make_jpeg):
+    source = make_jpeg(64, 48)
+    content, error, _ = transform_image(source, max_side=299)
+    assert error is None and content == source
+
+
+def test_transform_bakes_rotated_orientation_before_resizing(make_jpeg):
+    from PIL import Image
+
+    # Orientation 6 is a 90 degree turn: the 2400x1800 pixels display as 1800x2400
+    content, error, _ = transform_image(make_jpeg(2400, 1800, orientation=6), max_side=299, strip_exif=True)
+    assert error is None
+    image = Image.open(io.BytesIO(content))
+    assert image.size == (224, 299)
+    assert 0x0112 not in image.getexif()
+
+
+def test_transform_rejects_corrupt_bodies(make_jpeg):
+    content, error, _ = transform_image(make_jpeg()[:300], max_side=32)
+    assert content is None and error.startswith(INVALID_IMAGE_ERROR)
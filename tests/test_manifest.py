@@ -0,0 +1,54 @@
+import json
+import os
+
+from ImgDownloadOptimized import MANIFEST_NAME, CompletionManifest, restore_previous_output
+
+
+def test_records_survive_reopen_and_torn_lines_are_skipped(tmp_path):
+    path = str(tmp_path / MANIFEST_NAME)
+    manifest = CompletionManifest(path, sync_every=1)
+    manifest.open()
+    manifest.record(1, "sp/1.jpg", 10, "aa")
+    manifest.record(2, "sp/2.jpg", 20, "bb")
+    manifest.close()
+    # A crash mid-write leaves a partial last line
+    with open(path, 'a') as f:
+        f.write('{"key": 3, "file": "sp/3')
+
+    reloaded = CompletionManifest(path)
+    reloaded.load_file()
+    assert reloaded.completed_keys() == {"1", "2"}
+    assert reloaded.entries["2"] == {"key": 2, "file": "sp/2.jpg", "bytes": 20, "sha256": "bb"}
+
+
+def test_open_rewrites_only_retained_entries(tmp_path):
+    path = str(tmp_path / MANIFEST_NAME)
+    manifest = CompletionManifest(path)
+    manifest.load([json.dumps({"key": key, "file": f"sp/{key}.jpg", "bytes": 1, "sha256": ""}) for key in range(4)])
+    manifest.retain(lambda entry: entry["key"] % 2 == 0)
+    manifest.open()
+    manifest.close()
+    with open(path) as f:
+        assert [json.loads(line)["key"] for line in f] == [0, 2]
+    assert manifest.previously_completed == 2
+
+
+def test_folder_resume_keeps_only_files_that_match_the_manifest(tmp_path):
+    output_folder = str(tmp_path / "group_1")
+    os.makedirs(os.path.join(output_folder, "sp"))
+    manifest = CompletionManifest(os.path.join(output_folder, MANIFEST_NAME), sync_every=1)
+    manifest.open()
+    for key, content in [(1, b"complete"), (2, b"complete"), (3, b"complete")]:
+        with open(os.path.join(output_folder, "sp", f"{key}.jpg"), 'wb') as f:
+            f.write(content)
+        manifest.record(key, f"sp/{key}.jpg", len(content), "")
+    manifest.close()
+    # The previous attempt was killed while rewriting 2.jpg, and 3.jpg never made it to disk
+    with open(os.path.join(output_folder, "sp", "2.jpg"), 'wb') as f:
+        f.write(b"comp")
+    os.remove(os.path.join(output_folder, "sp", "3.jpg"))
+
+    resumed = CompletionManifest(os.path.join(output_folder, MANIFEST_NAME))
+    completed = restore_previous_output("folder", output_folder, None, resumed, None)
+    assert completed == {"1"}
+    assert resumed.previously_completed == 1
@@ -0,0 +1,24 @@
+import hashlib
+
+import pyarrow.parquet as pq
+
+from ImgDownloadOptimized import ParquetSampleWriter
+
+
+def test_rows_carry_sample_metadata_and_roll_row_groups(tmp_path):
+    path = str(tmp_path / "group_1.parquet")
+    sources = {n: (f"https://example.org/{n}.jpg", f"species {n % 2}") for n in range(5)}
+    sink = ParquetSampleWriter(path, sources, row_group_size=2500)
+    for n in range(5):
+        content = bytes([n]) * 1000
+        sink.write(f"species_{n % 2}", f"{n}.jpg", content, key=n, checksum=hashlib.sha256(content).hexdigest())
+    sink.close()
+
+    parquet = pq.ParquetFile(path)
+    assert parquet.schema_arrow.names == ["image", "label", "class", "url", "key", "size", "sha256"]
+    # 1000-byte images into 2500-byte row groups: 3 + 2 rows
+    assert [parquet.metadata.row_group(n).num_rows for n in range(parquet.num_row_groups)] == [3, 2]
+    rows = parquet.read().to_pylist()
+    assert rows[4]["image"] == {"bytes": bytes([4]) * 1000, "path": "4.jpg"}
+    assert (rows[4]["label"], rows[4]["url"], rows[4]["key"], rows[4]["size"]) == ("species 0", "https://example.org/4.jpg", "4", 1000)
+    assert rows[4]["sha256"] == hashlib.sha256(bytes([4]) * 1000).hexdigest()
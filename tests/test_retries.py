@@ -0,0 +1,107 @@
+import asyncio
+import email.utils
+import time
+
+import pytest
+
+from ImgDownloadOptimized import (
+    HOST_PARKED_ERROR,
+    INVALID_IMAGE_ERROR,
+    RETRY_CLASSES,
+    RetryScheduler,
+    classify_retry,
+    parse_retry_after,
+    parse_retry_budgets,
+)
+
+
+def test_parse_retry_after_seconds_dates_and_garbage():
+    assert parse_retry_after("7") == 7.0
+    assert parse_retry_after("-3") == 0.0
+    in_a_minute = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 <= parse_retry_after(in_a_minute) <= 60
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+
+
+def test_classify_retry():
+    assert classify_retry(429, "HTTP 429") == "throttled"
+    assert classify_retry(503, "HTTP 503") == "server_error"
+    assert classify_retry(0, "Timeout") == "timeout"
+    assert classify_retry(0, HOST_PARKED_ERROR) == "host_parked"
+    assert classify_retry(200, f"{INVALID_IMAGE_ERROR}: truncated") == "invalid_image"
+    # Retrying would not change these
+    assert classify_retry(200, f"{INVALID_IMAGE_ERROR}: below minimum size") is None
+    assert classify_retry(404, "HTTP 404") is None
+
+
+def test_parse_retry_budgets_defaults_and_overrides():
+    budgets = parse_retry_budgets(["throttled=10", "invalid_image=0"], 3)
+    assert budgets == {**{retry_class: 2 for retry_class in RETRY_CLASSES}, "throttled": 10, "invalid_image": 0}
+    with pytest.raises(ValueError):
+        parse_retry_budgets(["teapot=1"], 3)
+    with pytest.raises(ValueError):
+        parse_retry_budgets(["timeout=-1"], 3)
+
+
+def test_each_error_class_has_its_own_budget():
+    scheduler = RetryScheduler({"throttled": 2, "timeout": 1}, base_delay=0.0)
+    assert scheduler.schedule(0, "https://a.org/1.jpg", "throttled")
+    assert scheduler.schedule(0, "https://a.org/1.jpg", "throttled")
+    assert not scheduler.schedule(0, "https://a.org/1.jpg", "throttled")
+    # A different class still has its budget, an unknown class has none
+    assert scheduler.schedule(0, "https://a.org/1.jpg", "timeout")
+    assert not scheduler.schedule(0, "https://a.org/1.jpg", "server_error")
+    assert scheduler.attempt(0) == 4
+    stats = scheduler.get_stats()
+    assert stats["retries_scheduled"] == {"throttled": 2, "timeout": 1}
+    assert stats["budget_exhausted"] == {"throttled": 1, "server_error": 1}
+    assert stats["rows_retried"] == 1
+
+
+def test_backoff_grows_per_row_with_jitter_and_caps():
+    scheduler = RetryScheduler({"timeout": 10}, base_delay=2.0, max_delay=5.0)
+    delays = []
+    for _ in range(4):
+        before = time.monotonic()
+        scheduler.schedule(0, "https://a.org/1.jpg", "timeout")
+        delays.append(scheduler.heap[-1][0] - before)
+        scheduler.drain()
+    # Backoffs 2, 4, 8 -> 5 (capped), each jittered into [backoff / 2, backoff]
+    for delay, backoff in zip(delays, [2.0, 4.0, 5.0, 5.0]):
+        assert backoff / 2 - 0.01 <= delay <= backoff + 0.01
+
+
+def test_retry_after_is_a_floor_capped_at_max_delay():
+    scheduler = RetryScheduler({"throttled": 5}, base_delay=0.1, max_delay=30.0)
+    before = time.monotonic()
+    scheduler.schedule(0, "https://a.org/1.jpg", "throttled", retry_after=12.0)
+    scheduler.schedule(1, "https://a.org/2.jpg", "throttled", retry_after=3600.0)
+    ready = sorted(entry[0] - before for entry in scheduler.heap)
+    assert 12.0 <= ready[0] < 12.1
+    assert 30.0 <= ready[1] < 30.1
+    assert scheduler.get_stats()["retry_after_honored"] == 2
+
+
+def test_parked_hosts_hold_their_retries():
+    class ParkedHosts:
+        def parked_for(self, url):
+            return 20.0 if "parked" in url else 0.0
+
+    scheduler = RetryScheduler({"host_parked": 1}, base_delay=0.0, host_scheduler=ParkedHosts())
+    before = time.monotonic()
+    scheduler.schedule(0, "https://parked.org/1.jpg", "host_parked")
+    assert scheduler.heap[0][0] - before >= 20.0
+
+
+def test_ready_rows_pop_in_time_order():
+    async def run():
+        scheduler = RetryScheduler({"timeout": 1}, base_delay=0.0)
+        scheduler.schedule(0, "https://a.org/1.jpg", "timeout", retry_after=0.05)
+        scheduler.schedule(1, "https://a.org/2.jpg", "timeout")
+        first = scheduler.pop_ready()
+        assert scheduler.pop_ready() is None
+        await scheduler.wait()
+        return first, scheduler.pop_ready(), scheduler.pending
+
+    assert asyncio.run(run()) == (1, 0, 0)
@@ -0,0 +1,43 @@
+import pyarrow.parquet as pq
+
+from ImgDownloadOptimized import ParquetSampleWriter, WebDatasetWriter, merge_shard_samples
+
+
+def write_manifest(shard_output, lines):
+    with open(shard_output[:-len(".tar")] + "_manifest.jsonl", "w") as f:
+        f.write("".join(line + "\n" for line in lines))
+
+
+def test_parquet_shards_merge_into_one_file(tmp_path):
+    shard_outputs = [str(tmp_path / f"out_shard{shard}.tar") for shard in (0, 2)]
+    for shard, shard_output in zip((0, 2), shard_outputs):
+        sources = {key: (f"https://host{shard}.org/{key}.jpg", "species") for key in range(3)}
+        sink = ParquetSampleWriter(shard_output[:-len(".tar")] + ".parquet", sources, row_group_size=150)
+        for key in range(3):
+            sink.write("species", f"{key}.jpg", bytes([shard]) * 100, key=key, checksum="c")
+        sink.close()
+        write_manifest(shard_output, [f'{{"shard": {shard}}}'])
+
+    files = merge_shard_samples("parquet", str(tmp_path / "out.parquet"), shard_outputs)
+
+    assert files == [str(tmp_path / "out.parquet")]
+    merged = pq.ParquetFile(files[0])
+    # Row groups are copied as they are, 2 + 1 rows from each shard
+    assert [merged.metadata.row_group(n).num_rows for n in range(merged.num_row_groups)] == [2, 1, 2, 1]
+    assert [row["url"] for row in merged.read().to_pylist()][::3] == ["https://host0.org/0.jpg", "https://host2.org/0.jpg"]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["out.parquet", "out_manifest.jsonl"]
+    assert (tmp_path / "out_manifest.jsonl").read_text() == '{"shard": 0}\n{"shard": 2}\n'
+
+
+def test_webdataset_shards_are_renumbered_into_one_sequence(tmp_path):
+    shard_outputs = [str(tmp_path / f"out_shard{shard}.tar") for shard in (0, 1)]
+    for shard_output, samples in zip(shard_outputs, (3, 1)):
+        sink = WebDatasetWriter(shard_output, {}, max_samples=2)
+        for key in range(samples):
+            sink.write("species", f"{key}.jpg", b"x" * 10, key=key, checksum="c")
+        sink.close()
+
+    files = merge_shard_samples("webdataset", str(tmp_path / "out.tar"), shard_outputs)
+
+    assert files == [str(tmp_path / f"out-{index:06d}.tar") for index in range(3)]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["out-000000.tar", "out-000001.tar", "out-000002.tar"]
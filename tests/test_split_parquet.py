@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from SplitParquet import (
+    cost_aware_partition,
+    expected_row_bytes,
+    greedy_grouping,
+    jump_hash,
+    load_size_estimates,
+    lpt_partition,
+    refine_partition,
+    split_hashed,
+    stable_hash,
+)
+
+
+def jump_hash_reference(key, num_buckets):
+    """Scalar jump consistent hash from the Lamping & Veach paper."""
+    bucket, jump = -1, 0
+    while jump < num_buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) % 2 ** 64
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def observations(start, stop):
+    return pd.DataFrame({
+        "photo_url": [f"https://h{n % 7}.example.org/{n}.jpg" for n in range(start, stop)],
+        "species_name": [f"species {n % 13}" for n in range(start, stop)],
+    })
+
+
+def test_stable_hash_is_fixed_and_equal_for_equal_values():
+    digests = stable_hash(pd.Series(["a", "b", "a"]))
+    assert digests.dtype == np.uint64
+    assert digests[0] == digests[2] != digests[1]
+    # Pinned to BLAKE2b: shard assignment must not change between runs, machines or library versions
+    assert int(stable_hash(pd.Series(["a"]))[0]) == int.from_bytes(hashlib.blake2b(b"a", digest_size=8).digest(), "little")
+
+
+def test_jump_hash_matches_reference():
+    digests = stable_hash(pd.Series([str(n) for n in range(2000)]))
+    buckets = jump_hash(digests, 37)
+    assert [jump_hash_reference(int(key), 37) for key in digests] == buckets.tolist()
+
+
+def test_jump_hash_moves_few_keys_when_growing():
+    digests = stable_hash(pd.Series([str(n) for n in range(50000)]))
+    before, after = jump_hash(digests, 50), jump_hash(digests, 51)
+    moved = before != after
+    assert (after[moved] == 50).all()
+    assert moved.mean() == pytest.approx(1 / 51, abs=0.005)
+
+
+def test_split_hashed_writes_only_new_rows(tmp_path):
+    output = str(tmp_path)
+    first = split_hashed(observations(0, 900), "species_name", "photo_url", 5, output, write_threads=2)
+    assert sorted(os.path.basename(path) for path in first) == [f"group_{n}.parquet" for n in range(1, 6)]
+
+    # Existing rows plus 100 new ones: only the new rows are written, to their own folder
+    second = split_hashed(observations(0, 1000), "species_name", "photo_url", 5, output, write_threads=2)
+    assert all(os.path.dirname(path) == f"{output}/delta_1" for path in second)
+    delta = pd.concat([pd.read_parquet(path) for path in second])
+    assert sorted(delta["photo_url"]) == sorted(observations(900, 1000)["photo_url"])
+
+    # Nothing new: nothing written
+    assert split_hashed(observations(0, 1000), "species_name", "photo_url", 5, output) == []
+
+    # Every species lives in exactly one shard across the base and delta files
+    shards = pd.concat(
+        pd.read_parquet(path).assign(shard=os.path.basename(path)) for path in first + second
+    )
+    assert shards.groupby("species_name")["shard"].nunique().max() == 1
+
+    # The drivers submit every *.parquet of a folder: the run state must not be one of them
+    assert sorted(name for name in os.listdir(output) if name.endswith(".parquet")) == [f"group_{n}.parquet" for n in range(1, 6)]
+    with open(f"{output}/shard_state/manifest.json") as f:
+        manifest = json.load(f)
+    assert [(run["folder"], run["rows"]) for run in manifest["runs"]] == [(".", 900), ("delta_1", 100)]
+
+
+def test_split_hashed_refuses_a_different_layout(tmp_path):
+    split_hashed(observations(0, 100), "species_name", "photo_url", 5, str(tmp_path))
+    with pytest.raises(ValueError, match="shards"):
+        split_hashed(observations(0, 100), "species_name", "photo_url", 6, str(tmp_path))
+
+
+def test_expected_row_bytes_fills_missing_with_the_median_and_rejects_no_match():
+    sizes = pd.Series([1000.0, 3000.0, 8000.0], index=["a", "b", "c"])
+    assert expected_row_bytes(pd.Series(["a", "b", "zzz", "c"]), sizes).tolist() == [1000.0, 3000.0, 3000.0, 8000.0]
+    with pytest.raises(ValueError, match="size estimate"):
+        expected_row_bytes(pd.Series(["x", "y"]), sizes)
+
+
+def test_load_size_estimates_rejects_files_without_resolved_sizes(tmp_path):
+    path = str(tmp_path / "sizes.parquet")
+    pd.DataFrame({"photo_url": ["a", "b"], "size_kb": [0.0, 0.0]}).to_parquet(path)
+    with pytest.raises(ValueError, match="no resolved sizes"):
+        load_size_estimates(path, "photo_url")
+
+
+def test_cost_aware_partition_spreads_a_rate_limited_host():
+    # Four equal keys on one slow host and four on fast hosts: each group should get one slow key
+    key_rows = np.full(8, 100.0)
+    key_hosts = [[(0, 100)]] * 4 + [[(n, 100)] for n in range(1, 5)]
+    rates = np.array([1.0, 100.0, 100.0, 100.0, 100.0])
+    group_ids, group_time = cost_aware_partition(key_rows, np.zeros(8), key_hosts, rates, 4, 1000.0, 1e9)
+    assert sorted(group_ids[:4].tolist()) == [1, 2, 3, 4]
+    assert group_time.tolist() == [100.0] * 4
+
+
+def test_lpt_places_largest_first_on_the_lightest_group():
+    counts = np.array([5, 9, 1, 7, 3, 3])
+    group_ids = lpt_partition(counts, 3)
+    loads = np.bincount(group_ids, weights=counts, minlength=4)[1:]
+    assert sorted(loads.tolist()) == [9.0, 9.0, 10.0]
+    assert set(group_ids.tolist()) == {1, 2, 3}
+
+
+def test_lpt_handles_fewer_items_than_groups_and_no_items():
+    assert sorted(lpt_partition(np.array([4, 2]), 5).tolist()) == [1, 2]
+    assert lpt_partition(np.array([], dtype=np.int64), 3).tolist() == []
+
+
+def test_refine_fixes_the_lpt_counterexample():
+    # LPT puts 3+2+2 against 3+2; the optimum is 3+3 against 2+2+2
+    counts = np.array([3, 3, 2, 2, 2])
+    loads = lambda ids: sorted(np.bincount(ids, weights=counts, minlength=3)[1:].tolist())
+    assert loads(lpt_partition(counts, 2)) == [5.0, 7.0]
+    assert loads(lpt_partition(counts, 2, refine_rounds=10)) == [6.0, 6.0]
+    assert loads(refine_partition(counts, lpt_partition(counts, 2), 2, 10)) == [6.0, 6.0]
+
+
+def test_greedy_grouping_keeps_its_output_frame():
+    df = pd.DataFrame({"species_name": ["a_1", "b_1", "c_1", "d_1"], "Count": [10, 7, 5, 2]})
+    grouped = greedy_grouping(2, df, "Count", "species_name")
+    assert grouped.columns.tolist() == ["species_name", "Count", "group"]
+    assert grouped.groupby("group")["Count"].sum().sort_values().tolist() == [12, 12]
+    # Grouped by partition, larger counts first within each group
+    assert grouped.sort_values(["group", "Count"], ascending=[True, False]).index.tolist() == list(range(4))
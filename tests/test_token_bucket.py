@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+import pytest
+
+from ImgDownloadOptimized import TokenBucket
+
+
+def test_waiters_are_served_in_arrival_order():
+    async def run():
+        bucket = TokenBucket(rate=100, capacity=10)
+        await bucket.acquire(10)  # Empty the bucket
+        order = []
+
+        async def take(name, amount):
+            await bucket.acquire(amount)
+            order.append(name)
+
+        # The large request arrives first; later small ones must not jump ahead of it
+        tasks = [asyncio.create_task(take("large", 8))]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(take(f"small{n}", 1)) for n in range(3)]
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["large", "small0", "small1", "small2"]
+
+
+def test_acquire_paces_to_the_rate():
+    async def run():
+        bucket = TokenBucket(rate=50, capacity=1)
+        start = time.monotonic()
+        await asyncio.gather(*[bucket.acquire() for _ in range(11)])
+        return time.monotonic() - start
+
+    # One token up front, then ten more at 50 per second
+    assert asyncio.run(run()) == pytest.approx(0.2, abs=0.08)
+
+
+def test_cancelled_waiter_does_not_block_the_queue():
+    async def run():
+        bucket = TokenBucket(rate=20, capacity=1)
+        await bucket.acquire()
+        stuck = asyncio.create_task(bucket.acquire(1))
+        await asyncio.sleep(0)
+        behind = asyncio.create_task(bucket.acquire(1))
+        await asyncio.sleep(0)
+        stuck.cancel()
+        start = time.monotonic()
+        await behind
+        return time.monotonic() - start, len(bucket.waiters)
+
+    waited, waiting = asyncio.run(run())
+    assert waited < 0.1
+    assert waiting == 0
+
+
+def test_requests_over_capacity_wait_for_a_full_bucket_and_go_into_debt():
+    async def run():
+        bucket = TokenBucket(rate=1000, capacity=10)
+        await bucket.acquire(25)
+        return bucket.tokens
+
+    assert asyncio.run(run()) == pytest.approx(-15, abs=1)
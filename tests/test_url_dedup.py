@@ -0,0 +1,37 @@
+import asyncio
+
+import numpy as np
+
+from ImgDownloadOptimized import UrlDeduplicator, canonical_url
+
+
+class LinkRecorder:
+    def __init__(self):
+        self.links = []
+
+    async def link(self, class_name, file_name, target, key):
+        self.links.append((class_name, file_name, target, key))
+        return 1000
+
+
+def test_canonical_url_ignores_case_of_scheme_and_host_whitespace_and_fragment():
+    assert canonical_url("  HTTPS://Example.ORG/a/B.jpg#x ") == "https://example.org/a/B.jpg"
+    assert canonical_url("https://example.org/a.jpg?size=2") == "https://example.org/a.jpg?size=2"
+
+
+def test_only_rows_filled_from_a_stored_download_count_as_saved():
+    urls = np.array(["https://a.org/1.jpg", "https://A.org/1.jpg", "https://a.org/2.jpg", "https://a.org/2.jpg#f", "https://a.org/2.jpg"], dtype=object)
+    keys = np.array([10, 11, 12, 13, 14])
+    labels = np.array(["sp one", "sp two", "sp one", "sp one", "sp one"], dtype=object)
+    deduplicator = UrlDeduplicator(urls)
+    assert deduplicator.primary_positions.tolist() == [0, 2]
+    assert deduplicator.duplicate_keys(2, keys) == [13, 14]
+
+    # URL 1 was stored and fans out to its duplicate; URL 2 failed, so its duplicates fail with it
+    writer = LinkRecorder()
+    assert asyncio.run(deduplicator.fan_out(0, "1.jpg", "sp_one", keys, labels, writer)) == 1
+    assert writer.links == [("sp_two", "1.jpg", "sp_one/1.jpg", 11)]
+    stats = deduplicator.get_stats()
+    assert stats["duplicate_url_rows"] == 3
+    assert stats["requests_saved"] == 1
+    assert stats["download_bytes_saved"] == 1000
@@ -0,0 +1,28 @@
+import json
+import shlex
+import sys
+import tarfile
+
+from ImgDownloadOptimized import WebDatasetWriter
+
+
+def test_shards_roll_and_close_command_gets_the_path_as_one_argument(tmp_path):
+    folder = tmp_path / "with space"
+    folder.mkdir()
+    log = tmp_path / "closed.jsonl"
+    # The inline script has braces of its own, which must survive the {path} substitution
+    script = f"import sys, json; open({str(log)!r}, 'a').write(json.dumps({{'args': sys.argv[1:]}}) + '\\n')"
+    command = f"{shlex.quote(sys.executable)} -c {shlex.quote(script)} {{path}} --done"
+
+    sources = {n: (f"https://example.org/{n}.jpg", "species") for n in range(3)}
+    sink = WebDatasetWriter(str(folder / "group_1.tar"), sources, max_samples=2, close_command=command)
+    for n in range(3):
+        sink.write("species", f"{n}.jpg", b"x" * 100, key=n, checksum="c")
+    sink.close()
+
+    shards = [shard["path"] for shard in sink.get_stats()["shards"]]
+    assert len(shards) == 2
+    with tarfile.open(shards[0]) as tar:
+        assert sorted(tar.getnames()) == ["0.jpg", "0.json", "1.jpg", "1.json"]
+    with open(log) as f:
+        assert sorted(json.loads(line)["args"] for line in f) == [[path, "--done"] for path in shards]
@@ -0,0 +1,37 @@
+import asyncio
+import threading
+import time
+
+from ImgDownloadBW import WriterPool, monitor_event_loop_lag
+
+
+def test_pending_writes_never_exceed_the_queue_size():
+    async def run():
+        pool = WriterPool(threads=2, queue_size=3)
+        release = threading.Event()
+        tasks = [asyncio.create_task(pool.run(release.wait)) for _ in range(10)]
+        await asyncio.sleep(0.05)
+        queued = pool.pending
+        release.set()
+        await asyncio.gather(*tasks)
+        pool.shutdown()
+        return queued, pool.get_stats()
+
+    queued, stats = asyncio.run(run())
+    assert queued == 3
+    assert stats == {"threads": 2, "queue_size": 3, "max_pending": 3}
+
+
+def test_lag_monitor_sees_a_blocked_loop():
+    async def run():
+        lag_stats = {'samples': 0, 'total': 0.0, 'max': 0.0}
+        monitor = asyncio.create_task(monitor_event_loop_lag(lag_stats, interval=0.01))
+        await asyncio.sleep(0.02)
+        time.sleep(0.2)  # Blocks the loop the way a write on it would
+        await asyncio.sleep(0.05)
+        monitor.cancel()
+        return lag_stats
+
+    lag_stats = asyncio.run(run())
+    assert lag_stats['samples'] > 1
+    assert lag_stats['max'] >= 0.15